@@ -4,6 +4,11 @@ import 'package:flutter_map/flutter_map.dart';
 import 'package:latlong2/latlong.dart';
 import 'package:localizador_app/services/api_service.dart';
 
+// Simplificación que se pide al servidor: el suavizado de después multiplica
+// los puntos por 4, así que con esto el mapa no pasa de unos 6000.
+const int maxPuntosRuta = 1500;
+const double toleranciaRutaM = 5.0;
+
 class RutaScreen extends StatefulWidget {
   const RutaScreen({super.key});
 
@@ -61,7 +66,8 @@ class _RutaScreenState extends State<RutaScreen> with SingleTickerProviderStateM
   Future<void> cargarRuta() async {
     setState(() => cargando = true);
     try {
-      final datos = await api.getRutaPorFechas(fechaInicio!, fechaFin!);
+      final datos = await api.getRutaPorFechas(fechaInicio!, fechaFin!,
+          maxPuntos: maxPuntosRuta, toleranciaM: toleranciaRutaM);
       final rawPoints = datos.map<LatLng>((p) => LatLng(p.latitud, p.longitud)).toList();
       final rutaSuavizada = suavizarRuta(rawPoints, iteraciones: 2);
 
@@ -96,7 +96,10 @@ class ApiService {
     }
   }
 
-  Future<List<Ubicacion>> getRutaPorFechas(DateTime fechaInicio, DateTime fechaFin) async {
+  // maxPuntos / toleranciaM: el servidor simplifica la ruta (Douglas-Peucker)
+  // antes de enviarla. Sin ellos llega completa.
+  Future<List<Ubicacion>> getRutaPorFechas(DateTime fechaInicio, DateTime fechaFin,
+      {int? maxPuntos, double? toleranciaM}) async {
     final prefs = await SharedPreferences.getInstance();
     final token = prefs.getString('token');
 
@@ -109,6 +112,8 @@ class ApiService {
       body: json.encode({
         'fecha_inicio': fechaInicio.toIso8601String(),
         'fecha_fin': fechaFin.toIso8601String(),
+        if (maxPuntos != null) 'max_puntos': maxPuntos,
+        if (toleranciaM != null) 'tolerancia_m': toleranciaM,
       }),
     );
 
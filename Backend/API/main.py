@@ -1,21 +1,49 @@
 # main_postgres.py
-from fastapi import FastAPI, HTTPException, Depends, Form, Security, Body
+from fastapi import FastAPI, HTTPException, Depends, Form, Security, Body, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi import Response, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import List
-from math import radians, cos, sin, asin, sqrt
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import numpy as np
 from passlib.hash import bcrypt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from jose import jwt, JWTError
 
-app = FastAPI()
+# Módulos compartidos con el consumidor MQTT (Backend/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache_lru import CacheLRU
+from distancias import km_ultimos_dias
+from escucha_pg import EscuchaPostgres
+from estado_reciente import CANAL_ESTADO, ESTADO_MOVIMIENTO, ESTADO_REPOSO, EstadosRecientes, estado_de_aviso
+from movimiento import segundos_del_dia
+from tiempos import COLUMNAS_RESUMEN, VENTANA_S, leer_flota
+import geo
+import historico
+import metricas
 
-app.add_middleware(
-    CORS_CONFIG
-)
+log = logging.getLogger(__name__)
 
 POSTGRES_CONFIG = {
     "host": "IPHOST",
@@ -25,18 +53,336 @@ POSTGRES_CONFIG = {
     "database": "DBNAME"
 }
 
+# Pool de conexiones compartido por todas las peticiones
+DB_POOL_MIN = 2
+DB_POOL_MAX = 20
+DB_POOL_TIMEOUT_S = 5  # espera máxima por una conexión libre antes de responder 503
+
 SECRET_KEY = "SECRETKEY"
 ALGORITHM = "ALGORITHM"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 14
 
+# Tokens ya verificados (cada app hace polling con el mismo token durante días)
+TOKENS_CACHE_MAX = 10000
+
+# bcrypt tarda cientos de ms por login: va a su propio pool de hilos para que
+# una avalancha de logins no se quede con los hilos de los endpoints de polling.
+# Con BCRYPT_MAX_PENDIENTES en cola o en curso, los demás reciben 503.
+BCRYPT_HILOS = 2
+BCRYPT_MAX_PENDIENTES = 32
+
+# Fallos de login permitidos por usuario y por IP en la ventana; después, 429
+LOGIN_VENTANA_S = 300
+LOGIN_MAX_FALLOS_USUARIO = 5
+LOGIN_MAX_FALLOS_IP = 50
+# Si la API va detrás de un proxy, la cabecera con la IP del cliente (p. ej. "X-Forwarded-For")
+LOGIN_CABECERA_IP = None
+
+# /stream: posición y estado en directo por Server-Sent Events
+SSE_MAX_SUSCRIPTORES = 10000   # por proceso; las demás reciben 503
+SSE_PING_S = 15                # comentario para que los proxies no corten y detectar clientes caídos
+SSE_REINTENTO_MS = 5000        # lo que espera el cliente antes de reconectar
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
+# --------------------------
+# Pool de conexiones
+# --------------------------
+class PoolDB:
+    """ThreadedConnectionPool con espera acotada.
+
+    psycopg2 lanza PoolError en cuanto se agota el pool; aquí las peticiones
+    esperan hasta `timeout_s` a que quede una conexión libre.
+    """
+
+    def __init__(self, minconn, maxconn, timeout_s, **config):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **config)
+        self.libres = threading.BoundedSemaphore(maxconn)
+        self.timeout_s = timeout_s
+
+    def obtener(self):
+        if not self.libres.acquire(timeout=self.timeout_s):
+            raise HTTPException(status_code=503, detail="Base de datos saturada, inténtalo de nuevo")
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.libres.release()
+            raise
+
+    def devolver(self, conn):
+        try:
+            # Deja la conexión limpia aunque el endpoint no hiciera commit
+            if not conn.closed:
+                conn.rollback()
+            self.pool.putconn(conn, close=bool(conn.closed))
+        except psycopg2.Error:
+            self.pool.putconn(conn, close=True)
+        finally:
+            self.libres.release()
+
+    def cerrar(self):
+        self.pool.closeall()
+
+pool_db = None
+
+# --------------------------
+# Autenticación
+# --------------------------
+class CacheTokens:
+    """LRU de tokens ya verificados -> payload, cada uno hasta su `exp`."""
+
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, token):
+        with self._lock:
+            payload = self._datos.get(token)
+            if payload is None or payload["exp"] <= time.time():
+                if payload is not None:
+                    del self._datos[token]
+                self.fallos += 1
+                return None
+            self._datos.move_to_end(token)
+            self.aciertos += 1
+            return payload
+
+    def poner(self, token, payload):
+        with self._lock:
+            self._datos[token] = payload
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def resumen_metricas(self):
+        with self._lock:
+            return {"aciertos": self.aciertos, "fallos": self.fallos, "entradas": len(self._datos)}
+
+
+class LimitadorFallos:
+    """Fallos recientes por clave (nombre de usuario o IP) en una ventana deslizante."""
+
+    def __init__(self, maximo, ventana_s, max_claves=100000):
+        self.maximo = maximo
+        self.ventana_s = ventana_s
+        self.max_claves = max_claves
+        self._fallos = OrderedDict()   # clave -> deque de instantes
+        self._lock = threading.Lock()
+
+    def espera(self, clave):
+        """Segundos que faltan para poder intentarlo de nuevo; 0 si ya se puede."""
+        ahora = time.monotonic()
+        with self._lock:
+            fallos = self._fallos.get(clave)
+            if fallos is None:
+                return 0
+            while fallos and fallos[0] <= ahora - self.ventana_s:
+                fallos.popleft()
+            if not fallos:
+                del self._fallos[clave]
+                return 0
+            if len(fallos) < self.maximo:
+                return 0
+            return fallos[0] + self.ventana_s - ahora
+
+    def fallo(self, clave):
+        with self._lock:
+            fallos = self._fallos.get(clave)
+            if fallos is None:
+                fallos = self._fallos[clave] = deque(maxlen=self.maximo)
+            fallos.append(time.monotonic())
+            self._fallos.move_to_end(clave)
+            while len(self._fallos) > self.max_claves:
+                self._fallos.popitem(last=False)
+
+    def limpiar(self, clave):
+        with self._lock:
+            self._fallos.pop(clave, None)
+
+
+cache_tokens = CacheTokens(TOKENS_CACHE_MAX)
+metricas.fuente("cache_tokens", cache_tokens.resumen_metricas)
+fallos_usuario = LimitadorFallos(LOGIN_MAX_FALLOS_USUARIO, LOGIN_VENTANA_S)
+fallos_ip = LimitadorFallos(LOGIN_MAX_FALLOS_IP, LOGIN_VENTANA_S)
+
+ejecutor_bcrypt = ThreadPoolExecutor(BCRYPT_HILOS, thread_name_prefix="bcrypt")
+huecos_bcrypt = threading.BoundedSemaphore(BCRYPT_MAX_PENDIENTES)
+
+LOGIN_RECHAZADOS = metricas.contador("login_rechazados_total", "Logins rechazados antes de comprobar la contraseña",
+                                     ("motivo",))
+DURACION_BCRYPT = metricas.histograma("bcrypt_segundos", "Hash o verificación bcrypt, sin la espera en cola")
+
+def encolar_bcrypt(funcion, *args):
+    """Future de funcion(*args) en el pool de bcrypt; 503 si ya está lleno."""
+    if not huecos_bcrypt.acquire(blocking=False):
+        LOGIN_RECHAZADOS.inc(motivo="bcrypt_saturado")
+        raise HTTPException(status_code=503, detail="Demasiados inicios de sesión, inténtalo en unos segundos",
+                            headers={"Retry-After": "5"})
+
+    def cronometrada():
+        with DURACION_BCRYPT.cronometrar():
+            return funcion(*args)
+
+    futuro = ejecutor_bcrypt.submit(cronometrada)
+    futuro.add_done_callback(lambda _: huecos_bcrypt.release())
+    return futuro
+
+def contraseña_valida(contraseña, hash_guardado):
+    try:
+        return bcrypt.verify(contraseña, hash_guardado)
+    except ValueError:
+        # Usuarios creados por el consumidor MQTT con contraseña "default": no es un hash
+        return False
+
+# Rutas simplificadas ya calculadas, por (usuario, rango, simplificación, último fix)
+RUTA_CACHE_MAX = 256
+RUTA_CACHE_TTL_S = 300
+cache_rutas = CacheLRU(RUTA_CACHE_MAX, RUTA_CACHE_TTL_S)
+metricas.fuente("cache_rutas", cache_rutas.resumen_metricas)
+
+# Cuerpos ya serializados de /ruta, /ruta/fechas, /ruta/resumen y /distancia,
+# por (usuario, endpoint, parámetros, formato, último fix). Las respuestas más
+# grandes que RESPUESTA_CACHE_MAX_BYTES (y las que van en streaming) no entran.
+RESPUESTA_CACHE_MAX = 200
+RESPUESTA_CACHE_TTL_S = 300
+RESPUESTA_CACHE_MAX_BYTES = 1024 * 1024
+cache_respuestas = CacheLRU(RESPUESTA_CACHE_MAX, RESPUESTA_CACHE_TTL_S)
+metricas.fuente("cache_respuestas", cache_respuestas.resumen_metricas)
+
+# Los datos son de cada usuario: que ningún proxy los guarde y que la app
+# pregunte siempre, con If-None-Match, si siguen valiendo
+CACHE_CONTROL = "private, no-cache"
+
+# Último estado de cada usuario, lo escribe el consumidor MQTT (ver estado_reciente.py)
+estados = EstadosRecientes()
+
+class Suscripcion:
+    """Un cliente de /stream. Guarda solo el último evento: si el cliente va
+    lento se salta los intermedios en vez de acumularlos."""
+
+    def __init__(self):
+        self.evento = None
+        self.hay = asyncio.Event()
+
+    def poner(self, evento):
+        self.evento = evento
+        self.hay.set()
+
+    async def siguiente(self, timeout):
+        try:
+            await asyncio.wait_for(self.hay.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.hay.clear()
+        return self.evento
+
+class DifusorEstados:
+    """Reparte el estado de cada usuario entre sus suscripciones de /stream.
+
+    publicar() se llama desde el hilo del LISTEN y codifica el evento allí,
+    una vez por NOTIFY y no una por suscriptor; la entrega se hace en el
+    bucle de asyncio, que es el único que toca las suscripciones.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._suscripciones = {}   # usuario_id -> set de Suscripcion
+        self.total = 0
+        self.eventos = 0
+
+    def suscribir(self, usuario_id):
+        suscripcion = Suscripcion()
+        self._suscripciones.setdefault(usuario_id, set()).add(suscripcion)
+        self.total += 1
+        return suscripcion
+
+    def cancelar(self, usuario_id, suscripcion):
+        propias = self._suscripciones.get(usuario_id)
+        if propias and suscripcion in propias:
+            propias.discard(suscripcion)
+            self.total -= 1
+            if not propias:
+                del self._suscripciones[usuario_id]
+
+    def usuarios(self):
+        return list(self._suscripciones)
+
+    def publicar(self, usuario_id, estado):
+        if self.loop is None or usuario_id not in self._suscripciones:
+            return
+        self.loop.call_soon_threadsafe(self._entregar, usuario_id, evento_estado(estado))
+
+    def _entregar(self, usuario_id, evento):
+        for suscripcion in self._suscripciones.get(usuario_id, ()):
+            suscripcion.poner(evento)
+            self.eventos += 1
+
+    def resumen_metricas(self):
+        return {"suscriptores": self.total, "usuarios": len(self._suscripciones), "eventos": self.eventos}
+
+difusor = DifusorEstados()
+metricas.fuente("sse", difusor.resumen_metricas)
+
+def al_notificar_estado(canal, payload):
+    # El aviso trae la fila entera: ni pool ni consulta en el hilo del LISTEN
+    estado = estados.aplicar(estado_de_aviso(payload))
+    difusor.publicar(estado["usuario_id"], estado)
+
+def reenviar_estado(usuario_id):
+    conn = pool_db.obtener()
+    try:
+        estado = estados.refrescar(conn, usuario_id)
+    finally:
+        pool_db.devolver(conn)
+    if estado is not None:
+        difusor.publicar(usuario_id, estado)
+
+def al_reconectar_estado():
+    # Sin LISTEN no sabemos qué ha cambiado: se vacía la cache y a quien esté
+    # suscrito se le manda el estado actual por si se perdió algún NOTIFY
+    estados.vaciar()
+    for usuario_id in difusor.usuarios():
+        try:
+            reenviar_estado(usuario_id)
+        except Exception as e:
+            log.warning("No se pudo reenviar el estado de %s: %s", usuario_id, e)
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool_db
+    pool_db = PoolDB(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT_S, **POSTGRES_CONFIG)
+    metricas.fuente("pg_pool", metricas.metricas_pool(pool_db.pool))
+    difusor.loop = asyncio.get_running_loop()
+    escucha = EscuchaPostgres(lambda: psycopg2.connect(**POSTGRES_CONFIG), [CANAL_ESTADO],
+                              al_notificar_estado, al_reconectar=al_reconectar_estado)
+    escucha.start()
+    yield
+    escucha.detener()
+    pool_db.cerrar()
+    ejecutor_bcrypt.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORS_CONFIG
+)
+# Latencia por endpoint, en /metrics. El último añadido es el más externo:
+# cuenta también lo que tarda CORS.
+app.add_middleware(metricas.MiddlewareMetricas)
+
 # --------------------------
 # Utilidades
 # --------------------------
 def get_db():
-    conn = psycopg2.connect(**POSTGRES_CONFIG)
-    return conn
+    # Dependencia de FastAPI: una conexión del pool por petición, que vuelve
+    # al pool aunque el endpoint lance una excepción.
+    conn = pool_db.obtener()
+    try:
+        yield conn
+    finally:
+        pool_db.devolver(conn)
 
 def crear_token_acceso(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -44,12 +390,19 @@ def crear_token_acceso(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def verificar_token(token: str = Security(oauth2_scheme)):
+async def verificar_token(token: str = Security(oauth2_scheme)):
+    # async: con la cache es un diccionario, no merece un salto al threadpool.
+    # El payload cacheado es compartido, los endpoints solo lo leen.
+    payload = cache_tokens.obtener(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
     except JWTError:
         raise HTTPException(status_code=401, detail="Token inválido o expirado")
+    if "exp" in payload:
+        cache_tokens.poner(token, payload)
+    return payload
     
 def formatear_fecha(fecha: datetime):
     ahora = datetime.utcnow()
@@ -64,32 +417,6 @@ def formatear_fecha(fecha: datetime):
     else:
         return fecha.strftime("%H:%M:%S")
     
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371.0  # Radio de la Tierra en km
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    return 2 * R * asin(sqrt(a))
-
-def calcular_distancia(conn, usuario_id: int, dias: int):
-    cur = conn.cursor()
-    fecha_inicio = (datetime.utcnow() - timedelta(days=dias)).strftime('%Y-%m-%d %H:%M:%S')
-    cur.execute('''
-        SELECT latitud, longitud
-        FROM ubicaciones
-        WHERE usuario_id = %s AND recibido_en >= %s
-        ORDER BY recibido_en ASC
-    ''', (usuario_id, fecha_inicio))
-
-    puntos = cur.fetchall()
-    total = 0.0
-    for i in range(1, len(puntos)):
-        lat1, lon1 = puntos[i - 1]
-        lat2, lon2 = puntos[i]
-        total += haversine(lat1, lon1, lat2, lon2)
-
-    return round(total, 2)
-
 # --------------------------
 # Modelos
 # --------------------------
@@ -105,85 +432,218 @@ class Ubicacion(BaseModel):
 class TokenFCM(BaseModel):
     fcm_token: str
 
+class Viaje(BaseModel):
+    inicio: str
+    fin: str
+    duracion_s: int
+    km: float
+    puntos: int
+    latitud_inicio: float
+    longitud_inicio: float
+    latitud_fin: float
+    longitud_fin: float
+    # (lat_min, lon_min, lat_max, lon_max), como en /ruta/resumen
+    bbox: List[float]
+    en_curso: bool
+
+class EstadisticaTiempo(BaseModel):
+    n: int
+    media_s: float | None = None
+    desviacion_s: float | None = None
+    p50_s: float | None = None
+    p95_s: float | None = None
+
+class Tiempos(BaseModel):
+    desfase: EstadisticaTiempo
+    intervalo: EstadisticaTiempo
+    ultimo_fix: str | None = None
+
+class TiemposUsuario(BaseModel):
+    dispositivo: Tiempos | None
+    flota: Tiempos | None
+
+ADAPTADOR_RUTA = TypeAdapter(List[Ubicacion])
+ADAPTADOR_VIAJES = TypeAdapter(List[Viaje])
+
+# --------------------------
+# Peticiones condicionales
+# --------------------------
+# Todo lo que devuelven /ubicacion_actual, /estado_actual, /ruta y /distancia
+# cambia solo cuando llega un fix del usuario, así que su versión es el
+# recibido_en del último (el de EstadosRecientes, que está en memoria). Se
+# lee antes que los datos: lo que se sirva o se cachee con una versión
+# nunca es más antiguo que ella.
+def version_usuario(conn, usuario_id):
+    estado = estados.obtener(conn, usuario_id)
+    return estado["recibido_en"] if estado else None
+
+def validadores(usuario_id, version, dia=None):
+    """Cabeceras de caché de una respuesta con esa versión; sin versión (usuario
+    sin estado todavía) solo Cache-Control. Con `dia` (UTC) la respuesta
+    cambia también al empezar el día siguiente."""
+    cabeceras = {"Cache-Control": CACHE_CONTROL}
+    if version is not None:
+        etag = f"{usuario_id}-{round(version.timestamp() * 1000000)}"
+        if dia is not None:
+            etag += f"-{dia:%Y%m%d}"
+            version = max(version, datetime(dia.year, dia.month, dia.day, tzinfo=timezone.utc))
+        cabeceras["ETag"] = f'W/"{etag}"'
+        cabeceras["Last-Modified"] = format_datetime(version.astimezone(timezone.utc), usegmt=True)
+    return cabeceras
+
+def no_modificado(request, cabeceras):
+    """Un 304 si el cliente ya tiene esta versión, si no None."""
+    etag = cabeceras.get("ETag")
+    if etag is None:
+        return None
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Si viene If-None-Match se ignora If-Modified-Since (RFC 9110)
+        etiquetas = {e.strip().removeprefix("W/") for e in if_none_match.split(",")}
+        vigente = "*" in etiquetas or etag.removeprefix("W/") in etiquetas
+    else:
+        try:
+            desde = parsedate_to_datetime(request.headers.get("if-modified-since", ""))
+            vigente = parsedate_to_datetime(cabeceras["Last-Modified"]) <= desde
+        except (TypeError, ValueError):
+            vigente = False
+    return Response(status_code=304, headers=cabeceras) if vigente else None
+
+def con_cabeceras(resultado, response, cabeceras):
+    (resultado if isinstance(resultado, Response) else response).headers.update(cabeceras)
+    return resultado
+
+def respuesta_cacheada(clave, calcular, adaptador=None):
+    """La respuesta de `calcular(response)` desde cache_respuestas.
+
+    `clave` tiene que llevar la versión del usuario; con None no se cachea.
+    Lo que devuelva calcular se serializa aquí como lo haría FastAPI (con
+    `adaptador` si el endpoint tiene response_model), y las cabeceras que
+    ponga en `response` se guardan con el cuerpo.
+    """
+    if clave is not None:
+        guardada = cache_respuestas.obtener(clave)
+        if guardada is not None:
+            cuerpo, tipo, cabeceras = guardada
+            return Response(cuerpo, media_type=tipo, headers=cabeceras)
+
+    generacion = cache_respuestas.generacion()
+    response = Response()
+    del response.headers["content-length"]
+    resultado = calcular(response)
+    if isinstance(resultado, StreamingResponse):
+        return resultado
+    if isinstance(resultado, Response):
+        cuerpo, tipo = resultado.body, resultado.media_type
+        cabeceras = {k: v for k, v in resultado.headers.items() if k not in ("content-length", "content-type")}
+    else:
+        if adaptador is not None:
+            cuerpo = adaptador.dump_json(adaptador.validate_python(resultado))
+        else:
+            cuerpo = JSONResponse(jsonable_encoder(resultado)).body
+        tipo = "application/json"
+        cabeceras = dict(response.headers)
+
+    if clave is not None and len(cuerpo) <= RESPUESTA_CACHE_MAX_BYTES:
+        cache_respuestas.poner(clave, (cuerpo, tipo, cabeceras), generacion)
+    return Response(cuerpo, media_type=tipo, headers=cabeceras)
+
 # --------------------------
 # Endpoints
 # --------------------------
+def buscar_credenciales(nombre):
+    conn = pool_db.obtener()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, contraseña FROM usuarios WHERE nombre = %s", (nombre,))
+            return cur.fetchone()
+    finally:
+        pool_db.devolver(conn)
+
 @app.post("/token")
-def login_token(nombre: str = Form(...), contraseña: str = Form(...)):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM usuarios WHERE nombre = %s", (nombre,))
-    user = cur.fetchone()
-    conn.close()
+async def login_token(request: Request, nombre: str = Form(...), contraseña: str = Form(...)):
+    # async y sin get_db: la conexión vuelve al pool antes de bcrypt, y bcrypt
+    # corre en su propio pool de hilos, no en el de los endpoints
+    ip = (LOGIN_CABECERA_IP and request.headers.get(LOGIN_CABECERA_IP, "").split(",")[0].strip()) \
+        or (request.client.host if request.client else "")
+    espera = max(fallos_usuario.espera(nombre), fallos_ip.espera(ip))
+    if espera:
+        LOGIN_RECHAZADOS.inc(motivo="demasiados_fallos")
+        raise HTTPException(status_code=429, detail="Demasiados intentos fallidos, inténtalo más tarde",
+                            headers={"Retry-After": str(int(espera) + 1)})
 
-    if not user or not bcrypt.verify(contraseña, user["contraseña"]):
+    user = await run_in_threadpool(buscar_credenciales, nombre)
+    if not user or not await asyncio.wrap_future(encolar_bcrypt(contraseña_valida, contraseña, user[1])):
+        fallos_usuario.fallo(nombre)
+        fallos_ip.fallo(ip)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
-    token = crear_token_acceso({"sub": str(user["id"])})
+    fallos_usuario.limpiar(nombre)
+    token = crear_token_acceso({"sub": str(user[0])})
     return {"access_token": token, "token_type": "bearer"}
 
 @app.post("/registrar_token")
 def registrar_token(
     token_data: TokenFCM,
-    usuario: dict = Depends(verificar_token)
+    usuario: dict = Depends(verificar_token),
+    conn=Depends(get_db)
 ):
     usuario_id = int(usuario["sub"])
     fcm_token = token_data.fcm_token
 
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("""
-        UPDATE usuarios SET fcm_token = %s WHERE id = %s
+        UPDATE usuarios SET fcm_token = %s WHERE id = %s RETURNING nombre
     """, (fcm_token, usuario_id))
+    fila = cur.fetchone()
+    if fila:
+        # El consumidor MQTT cachea (usuario_id, fcm_token) por nombre de
+        # dispositivo; el NOTIFY se entrega al hacer commit y lo invalida.
+        cur.execute("SELECT pg_notify('usuarios_cambios', %s)", (fila[0],))
     conn.commit()
-    conn.close()
     return {"mensaje": "Token FCM registrado correctamente"}
 
 
 @app.get("/estado_actual")
-def estado_actual(usuario: dict = Depends(verificar_token)):
+def estado_actual(request: Request, response: Response, usuario: dict = Depends(verificar_token),
+                  conn=Depends(get_db)):
     usuario_id = int(usuario["sub"])
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cur.execute("""
-        SELECT * FROM ubicaciones 
-        WHERE usuario_id = %s 
-        ORDER BY recibido_en DESC LIMIT 1
-    """, (usuario_id,))
-    ultima = cur.fetchone()
-    if not ultima:
+    estado = estados.obtener(conn, usuario_id)
+    cabeceras = validadores(usuario_id, estado and estado["recibido_en"])
+    no_cambia = no_modificado(request, cabeceras)
+    if no_cambia:
+        return no_cambia
+    if estado is None:
+        estado = estado_desde_ubicaciones(conn, usuario_id)
+    if estado is None:
         raise HTTPException(status_code=404, detail="No se encontró ubicación")
+    return con_cabeceras(resumen_estado(estado), response, cabeceras)
 
-    # Evaluar estado actual (últimos 3 registros)
-    cur.execute("""
-        SELECT recibido_en, en_movimiento, hdop FROM ubicaciones 
-        WHERE usuario_id = %s 
-        ORDER BY recibido_en DESC LIMIT 3
-    """, (usuario_id,))
-    ultimos_3 = cur.fetchall()
+def resumen_estado(estado):
+    ultima_vez_mov = estado["ultima_vez_en_movimiento"]
+    return {
+        "estado": estado["estado"],
+        "ultima_actualizacion": formatear_fecha(estado["recibido_en"]),
+        "ultima_vez_en_movimiento": formatear_fecha(ultima_vez_mov) if ultima_vez_mov else "--:--:--"
+    }
 
-    estado = "Reposo"
-    if (
-        len(ultimos_3) == 3 and
-        all(r["en_movimiento"] == 1 and r["hdop"] is not None and r["hdop"] < 5.5 for r in ultimos_3)
-    ):
-        try:
-            t1 = ultimos_3[0]["recibido_en"]
-            t3 = ultimos_3[2]["recibido_en"]
-            if abs((t1 - t3).total_seconds()) <= 180:
-                estado = "Movimiento"
-        except:
-            pass
+def estado_desde_ubicaciones(conn, usuario_id: int):
+    # Arranque en frío: el usuario aún no tiene fila en estado_dispositivo
+    # (el consumidor no ha recibido ningún fix suyo desde que existe la tabla).
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    # Buscar la última vez con movimiento válido
     cur.execute("""
         SELECT recibido_en, en_movimiento, hdop FROM ubicaciones 
         WHERE usuario_id = %s 
         ORDER BY recibido_en DESC LIMIT 50
     """, (usuario_id,))
     registros = cur.fetchall()
+    if not registros:
+        return None
 
+    # Evaluar estado actual (últimos 3 registros) y la última vez con movimiento válido
+    estado = ESTADO_REPOSO
     ultima_vez_mov = None
     for i in range(len(registros) - 2):
         r1, r2, r3 = registros[i], registros[i+1], registros[i+2]
@@ -195,146 +655,658 @@ def estado_actual(usuario: dict = Depends(verificar_token)):
                 t1 = r1["recibido_en"]
                 t3 = r3["recibido_en"]
                 if abs((t1 - t3).total_seconds()) <= 180:
+                    if i == 0:
+                        estado = ESTADO_MOVIMIENTO
                     ultima_vez_mov = t1
                     break
             except:
                 pass
 
-    conn.close()
-
     return {
         "estado": estado,
-        "ultima_actualizacion": formatear_fecha(ultima["recibido_en"]),
-        "ultima_vez_en_movimiento": formatear_fecha(ultima_vez_mov) if ultima_vez_mov else "--:--:--"
+        "recibido_en": registros[0]["recibido_en"],
+        "ultima_vez_en_movimiento": ultima_vez_mov,
     }
 
 @app.get("/ubicacion_actual", response_model=Ubicacion)
-def ubicacion_actual(usuario: dict = Depends(verificar_token)):
+def ubicacion_actual(request: Request, response: Response, usuario: dict = Depends(verificar_token),
+                     conn=Depends(get_db)):
     usuario_id = int(usuario["sub"])
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""
-        SELECT * FROM ubicaciones 
-        WHERE usuario_id = %s 
-        ORDER BY recibido_en DESC LIMIT 1
-    """, (usuario_id,))
-    ubic = cur.fetchone()
-    conn.close()
+
+    ubic = estados.obtener(conn, usuario_id)
+    cabeceras = validadores(usuario_id, ubic and ubic["recibido_en"])
+    no_cambia = no_modificado(request, cabeceras)
+    if no_cambia:
+        return no_cambia
+    if ubic is None:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(f"""
+            SELECT {COLUMNAS_RUTA} FROM ubicaciones
+            WHERE usuario_id = %s
+            ORDER BY ubicaciones.recibido_en DESC LIMIT 1
+        """, (usuario_id,))
+        ubic = cur.fetchone()
 
     if not ubic:
         raise HTTPException(status_code=404, detail="No se encontró ubicación")
+    return con_cabeceras(ubicacion_de_estado(ubic), response, cabeceras)
 
+def ubicacion_de_estado(ubic):
+    ubic = {campo: ubic[campo] for campo in CAMPOS_UBICACION}
     if isinstance(ubic["recibido_en"], datetime):
         ubic["recibido_en"] = ubic["recibido_en"].strftime("%Y-%m-%d %H:%M:%S")
+    return ubic
 
-    return dict(ubic)
+def evento_estado(estado):
+    """(recibido_en, evento SSE) con la ubicación y el estado de movimiento,
+    lo mismo que /ubicacion_actual y /estado_actual. El id es recibido_en en
+    segundos epoch."""
+    datos = {"ubicacion": ubicacion_de_estado(estado), "estado": resumen_estado(estado)}
+    return estado["recibido_en"], (f"event: estado\nid: {estado['recibido_en'].timestamp():.6f}\n"
+                                   f"data: {json.dumps(datos)}\n\n").encode()
 
-@app.get("/ruta", response_model=List[Ubicacion])
-def obtener_ruta(limite: int = 5000, usuario: dict = Depends(verificar_token)):
-    usuario_id = int(usuario["sub"])
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+def estado_inicial(usuario_id):
+    conn = pool_db.obtener()
+    try:
+        return estados.obtener(conn, usuario_id)
+    finally:
+        pool_db.devolver(conn)
+
+async def emitir_estados(usuario_id, caduca):
+    # Se suscribe antes de leer el estado inicial para no perder un NOTIFY
+    # que llegue entremedias; lo que sea más antiguo que lo ya enviado se salta
+    suscripcion = difusor.suscribir(usuario_id)
+    try:
+        yield f"retry: {SSE_REINTENTO_MS}\n\n".encode()
+        estado = await run_in_threadpool(estado_inicial, usuario_id)
+        enviado = None
+        if estado is not None:
+            enviado, evento = evento_estado(estado)
+            yield evento
+        # Al caducar el token se cierra: el cliente vuelve con uno nuevo
+        while caduca is None or time.time() < caduca:
+            espera = SSE_PING_S if caduca is None else min(SSE_PING_S, caduca - time.time())
+            evento = await suscripcion.siguiente(max(espera, 0))
+            if evento is None:
+                # También sirve para enterarse de que el cliente se fue
+                yield b": ping\n\n"
+            elif enviado is None or evento[0] > enviado:
+                enviado = evento[0]
+                yield evento[1]
+    finally:
+        difusor.cancelar(usuario_id, suscripcion)
+
+@app.get("/stream")
+async def stream(usuario: dict = Depends(verificar_token)):
+    """Ubicación y estado en directo (text/event-stream) en lugar de hacer
+    polling: un evento "estado" al conectar y otro cada vez que el consumidor
+    guarda un fix del dispositivo."""
+    if difusor.total >= SSE_MAX_SUSCRIPTORES:
+        raise HTTPException(status_code=503, detail="Demasiadas conexiones en directo, usa el polling",
+                            headers={"Retry-After": "30"})
+    return StreamingResponse(emitir_estados(int(usuario["sub"]), usuario.get("exp")),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Columnas de Ubicacion, en su orden y con recibido_en ya formateado por
+# Postgres, más recibido_en en segundos epoch para el formato binario.
+# Ojo: el alias tapa la columna, hay que ordenar por ubicaciones.recibido_en
+# o Postgres ordena el texto y no usa el índice. hora_utc es TIME y puede
+# ser NULL (hora mal formada): sale como cadena vacía.
+COLUMNAS_RUTA = """
+    COALESCE(hora_utc::text, '') AS hora_utc, latitud, longitud, altitud, hdop, en_movimiento,
+    to_char(recibido_en, 'YYYY-MM-DD HH24:MI:SS') AS recibido_en,
+    EXTRACT(EPOCH FROM recibido_en)::float8 AS recibido_epoch
+"""
+CAMPOS_UBICACION = ("hora_utc", "latitud", "longitud", "altitud", "hdop", "en_movimiento", "recibido_en")
+
+# Formatos alternativos de /ruta y /ruta/fechas, según la cabecera Accept:
+#
+#   application/x-ndjson      un objeto Ubicacion JSON por línea
+#   application/vnd.loc.columnas
+#       bloques binarios little-endian; cada uno empieza con uint32 n y
+#       sigue con n valores de cada columna: hora_utc (int32, segundos del
+#       día, -1 si falta), latitud y longitud (float64), altitud y hdop
+#       (float32, NaN si faltan), en_movimiento (int8, -1 si falta) y
+#       recibido_en (float64, segundos epoch). Un bloque con n = 0 cierra.
+#
+# Sin simplificación se envían en streaming con un cursor de servidor, así
+# que la memoria no crece con el tamaño del rango.
+TIPO_NDJSON = "application/x-ndjson"
+TIPO_COLUMNAS = "application/vnd.loc.columnas"
+TAM_BLOQUE_RUTA = 2000
+
+def formato_ruta(accept):
+    for tipo in (TIPO_NDJSON, TIPO_COLUMNAS):
+        if accept and tipo in accept:
+            return tipo
+    return None
+
+def codificar_ndjson(filas):
+    return "".join(json.dumps(dict(zip(CAMPOS_UBICACION, f))) + "\n" for f in filas).encode()
+
+def codificar_columnas(filas):
+    if not filas:
+        return struct.pack("<I", 0)
+    hora, lat, lon, alt, hdop, mov, _, recibido = zip(*filas)
+    segundos = (segundos_del_dia(h) for h in hora)
+    return b"".join((
+        struct.pack("<I", len(filas)),
+        np.array([-1 if x is None else x for x in segundos], dtype="<i4").tobytes(),
+        np.array(lat, dtype="<f8").tobytes(),
+        np.array(lon, dtype="<f8").tobytes(),
+        np.array(alt, dtype="<f4").tobytes(),
+        np.array(hdop, dtype="<f4").tobytes(),
+        np.array([-1 if m is None else m for m in mov], dtype="<i1").tobytes(),
+        np.array(recibido, dtype="<f8").tobytes(),
+    ))
+
+CODIFICADORES = {TIPO_NDJSON: codificar_ndjson, TIPO_COLUMNAS: codificar_columnas}
+
+class FlujoRuta:
+    """Cursor de servidor sobre la ruta que va entregando bloques codificados.
+
+    Usa su propia conexión: la de get_db vuelve al pool antes de que se envíe
+    el cuerpo de una StreamingResponse. La consulta se lanza al crearlo, así
+    que un fallo de BD o un pool saturado salen como error normal y no como
+    una respuesta cortada a medias.
+    """
+
+    def __init__(self, consulta, params, formato):
+        self.codificar = CODIFICADORES[formato]
+        self.formato = formato
+        self.lock = threading.Lock()
+        self.conn = pool_db.obtener()
+        try:
+            self.cur = self.conn.cursor(name="ruta_stream")
+            self.cur.execute(consulta, params)
+        except Exception:
+            pool_db.devolver(self.conn)
+            raise
+        self.cerrado = False
+
+    def siguiente(self):
+        with self.lock:
+            if self.cerrado:
+                return None
+            filas = self.cur.fetchmany(TAM_BLOQUE_RUTA)
+            if filas:
+                return self.codificar(filas)
+        self.cerrar()
+        return codificar_columnas([]) if self.formato == TIPO_COLUMNAS else None
+
+    def cerrar(self):
+        # Idempotente. El lock espera a un fetchmany que siga en marcha en otro
+        # hilo si el cliente se desconecta a mitad.
+        with self.lock:
+            if self.cerrado:
+                return
+            self.cerrado = True
+        try:
+            self.cur.close()
+        except psycopg2.Error:
+            pass
+        pool_db.devolver(self.conn)
+
+    def __iter__(self):
+        while True:
+            bloque = self.siguiente()
+            if bloque is None:
+                return
+            yield bloque
+            if self.cerrado:
+                return
+
+def leer_ruta(conn, usuario_id, rango, consulta, params, tolerancia_m=None, max_puntos=None, archivadas=None):
+    """Filas de la ruta, simplificadas con Douglas-Peucker si se pide.
+
+    `archivadas`, si se da, devuelve las filas del archivo en disco que van
+    delante de las de la consulta.
+
+    Las simplificadas se cachean; la clave lleva el recibido_en del último fix
+    del usuario, así que en cuanto llega uno nuevo la entrada deja de usarse.
+    """
+    def consultar():
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(consulta, params)
+        filas = cur.fetchall()
+        return archivadas() + filas if archivadas else filas
+
+    if tolerancia_m is None and max_puntos is None:
+        return consultar()
+
+    estado = estados.obtener(conn, usuario_id)
+    clave = (usuario_id, rango, tolerancia_m, max_puntos, estado["recibido_en"] if estado else None)
+    generacion = cache_rutas.generacion()
+    ruta = cache_rutas.obtener(clave)
+    if ruta is None:
+        filas = consultar()
+        lat = np.fromiter((f["latitud"] for f in filas), dtype=np.float64, count=len(filas))
+        lon = np.fromiter((f["longitud"] for f in filas), dtype=np.float64, count=len(filas))
+        ruta = [filas[i] for i in geo.simplificar(lat, lon, tolerancia_m, max_puntos)]
+        cache_rutas.poner(clave, ruta, generacion)
+    return ruta
+
+# Paginación por cursor (keyset) sobre (recibido_en, id), con el índice
+# (usuario_id, recibido_en, id) de BD/migraciones/0001: cada página cuesta
+# lo mismo por profunda que sea. El cursor de la página siguiente va en la
+# cabecera X-Siguiente-Cursor; si no viene, no hay más.
+RUTA_MAX_PAGINA = 5000
+RUTA_MAX_PAGINA_STREAM = 50000  # NDJSON y columnas no cargan la página en memoria
+CABECERA_CURSOR = "X-Siguiente-Cursor"
+CLAVE_RUTA = "(ubicaciones.recibido_en, ubicaciones.id)"
+# recibido_en viaja en el cursor como microsegundos epoch: exacto y sin zonas
+VALOR_CLAVE = "(TIMESTAMPTZ 'epoch' + %s * INTERVAL '1 microsecond', %s)"
+
+def codificar_cursor(recibido_us, id_fila):
+    return base64.urlsafe_b64encode(f"{recibido_us}.{id_fila}".encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor):
+    try:
+        texto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        recibido_us, id_fila = texto.split(".")
+        return int(recibido_us), int(id_fila)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+def paginar(conn, filtro, params, descendente, cursor, limite, fuente="ubicaciones"):
+    """Acota `filtro` a una página: (filtro, params, cursor siguiente o None).
+
+    Primero se busca la última fila de la página (un recorrido de `limite`
+    entradas del índice) y la página se pide como el rango entre el cursor y
+    esa fila, sin LIMIT. Así un fix que llegue entre las dos consultas no
+    desplaza la página ni hace que se salte una fila.
+    """
+    op, op_hasta, orden = ("<", ">=", "DESC") if descendente else (">", "<=", "ASC")
+    params = list(params)
+    if cursor:
+        filtro += f" AND {CLAVE_RUTA} {op} {VALOR_CLAVE}"
+        params += decodificar_cursor(cursor)
+
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint, id FROM {fuente}
+        WHERE {filtro}
+        ORDER BY recibido_en {orden}, id {orden}
+        OFFSET %s LIMIT 2
+    """, params + [limite - 1])
+    limites = cur.fetchall()
+    if not limites:
+        return filtro, params, None
+
+    ultima = limites[0]
+    filtro += f" AND {CLAVE_RUTA} {op_hasta} {VALOR_CLAVE}"
+    params += ultima
+    return filtro, params, codificar_cursor(*ultima) if len(limites) == 2 else None
+
+class TramoArchivado:
+    """Parte de un rango de /ruta/fechas anterior a historico_cortes.resumido_desde,
+    que se lee de los ficheros del archivo (ver historico.py). Fechas con zona."""
+
+    def __init__(self, usuario_id, desde, hasta, corte):
+        self.usuario_id = usuario_id
+        self.desde = desde
+        # BETWEEN incluye el final; leer_archivo no
+        self.hasta = min(hasta + timedelta(microseconds=1), corte)
+        self.sigue_en_bd = hasta >= corte
+
+    def leer(self, despues=None, limite=None):
+        return historico.leer_archivo(self.usuario_id, self.desde, self.hasta, despues, limite)
+
+def niveles_rango(conn, usuario_id, inicio, fin):
+    """(fuente, tramo archivado o None) para leer el rango [inicio, fin].
+
+    Las fechas se pasan por Postgres para compararlas con los cortes tal como
+    las entiende él (sin zona, en la de la sesión).
+    """
+    cur = conn.cursor()
     cur.execute("""
-        SELECT * FROM ubicaciones 
-        WHERE usuario_id = %s 
-        ORDER BY recibido_en DESC LIMIT %s
-    """, (usuario_id, limite))
-    ubicaciones = cur.fetchall()
-    conn.close()
+        SELECT %s::timestamptz, %s::timestamptz, resumido_desde, completo_desde FROM historico_cortes
+    """, (inicio, fin))
+    inicio, fin, resumido_desde, completo_desde = cur.fetchone()
+    fuente = historico.FUENTE_RUTA if completo_desde and inicio < completo_desde else "ubicaciones"
+    archivo = None
+    if resumido_desde and inicio < resumido_desde:
+        archivo = TramoArchivado(usuario_id, inicio, fin, resumido_desde)
+    return fuente, archivo
+
+def responder_filas(filas, formato, cabeceras=None):
+    # Filas ya en memoria (dicts en el orden de COLUMNAS_RUTA) en NDJSON o columnas
+    filas = [tuple(f.values()) for f in filas]
+    cuerpo = CODIFICADORES[formato](filas)
+    if formato == TIPO_COLUMNAS and filas:
+        cuerpo += codificar_columnas([])
+    return Response(cuerpo, media_type=formato, headers=cabeceras)
 
-    for ubic in ubicaciones:
-        if isinstance(ubic["recibido_en"], datetime):
-            ubic["recibido_en"] = ubic["recibido_en"].strftime("%Y-%m-%d %H:%M:%S")
+def responder_ruta(conn, response, usuario_id, rango, filtro, params, descendente,
+                   limite, cursor, tolerancia_m, max_puntos, accept, fuente="ubicaciones", archivo=None):
+    formato = formato_ruta(accept)
+    orden = "DESC" if descendente else "ASC"
+    orden_sql = f"ORDER BY ubicaciones.recibido_en {orden}, ubicaciones.id {orden}"
 
-    return ubicaciones
+    if tolerancia_m is not None or max_puntos is not None:
+        # Se simplifica el rango entero (o las `limite` últimas filas) de una
+        # vez; la salida ya queda acotada por max_puntos, sin páginas.
+        if cursor:
+            raise HTTPException(status_code=400, detail="La ruta simplificada no se pagina")
+        max_puntos = min(max_puntos or RUTA_MAX_PAGINA, RUTA_MAX_PAGINA)
+        consulta = f"SELECT {COLUMNAS_RUTA} FROM {fuente} WHERE {filtro} {orden_sql}"
+        tope = min(limite, RUTA_MAX_PAGINA_STREAM) if limite else None
+        if tope:
+            consulta += " LIMIT %s"
+            params = list(params) + [tope]
+        archivadas = (lambda: archivo.leer(limite=tope)[1]) if archivo else None
+        filas = leer_ruta(conn, usuario_id, rango, consulta, params, tolerancia_m, max_puntos, archivadas)
+        if formato is None:
+            return filas
+        return responder_filas(filas, formato)
+
+    maximo = RUTA_MAX_PAGINA if formato is None else RUTA_MAX_PAGINA_STREAM
+    tope = min(limite or maximo, maximo)
+
+    if archivo is not None:
+        # Las páginas no mezclan archivo y BD: mientras queden filas archivadas
+        # después del cursor se sirven solas, y la página siguiente sigue por
+        # donde toque con el mismo cursor.
+        claves, filas = archivo.leer(decodificar_cursor(cursor) if cursor else None, tope + 1)
+        if filas:
+            hay_mas = len(filas) > tope or archivo.sigue_en_bd
+            filas = filas[:tope]
+            cabeceras = {CABECERA_CURSOR: codificar_cursor(*claves[len(filas) - 1])} if hay_mas else {}
+            if formato is None:
+                response.headers.update(cabeceras)
+                return filas
+            return responder_filas(filas, formato, cabeceras)
+
+    filtro, params, siguiente = paginar(conn, filtro, params, descendente, cursor, tope, fuente)
+    consulta = f"SELECT {COLUMNAS_RUTA} FROM {fuente} WHERE {filtro} {orden_sql}"
+    cabeceras = {CABECERA_CURSOR: siguiente} if siguiente else {}
+
+    if formato is None:
+        response.headers.update(cabeceras)
+        return leer_ruta(conn, usuario_id, rango, consulta, params)
+
+    # La tarea de fondo se ejecuta también si el cliente se desconecta a
+    # mitad; así la conexión vuelve al pool sin esperar al recolector.
+    flujo = FlujoRuta(consulta, params, formato)
+    return StreamingResponse(iter(flujo), media_type=formato, headers=cabeceras,
+                             background=BackgroundTask(flujo.cerrar))
+
+@app.get("/ruta", response_model=List[Ubicacion])
+def obtener_ruta(
+    request: Request,
+    response: Response,
+    limite: int | None = Query(None, ge=1),
+    cursor: str | None = None,
+    tolerancia_m: float | None = Query(None, ge=0),
+    max_puntos: int | None = Query(None, ge=2),
+    accept: str | None = Header(None),
+    usuario: dict = Depends(verificar_token),
+    conn=Depends(get_db)
+):
+    # Los fixes más recientes primero; `limite` se recorta a la página máxima
+    usuario_id = int(usuario["sub"])
+    limite = limite or RUTA_MAX_PAGINA
+    version = version_usuario(conn, usuario_id)
+    cabeceras = {**validadores(usuario_id, version), "Vary": "Accept"}
+    no_cambia = no_modificado(request, cabeceras)
+    if no_cambia:
+        return no_cambia
+
+    clave = version and (usuario_id, "/ruta", limite, cursor, tolerancia_m, max_puntos, formato_ruta(accept), version)
+    resultado = respuesta_cacheada(clave, lambda r: responder_ruta(
+        conn, r, usuario_id, ("ultimos", limite), "usuario_id = %s", (usuario_id,),
+        True, limite, cursor, tolerancia_m, max_puntos, accept), ADAPTADOR_RUTA)
+    return con_cabeceras(resultado, response, cabeceras)
 
 class RangoFechas(BaseModel):
     fecha_inicio: datetime
     fecha_fin: datetime
+    # Opcionales: simplificación de la ruta en el servidor (ver geo.simplificar)
+    tolerancia_m: float | None = Field(None, ge=0)
+    max_puntos: int | None = Field(None, ge=2)
+    # Opcionales: paginación (sin simplificar)
+    limite: int | None = Field(None, ge=1)
+    cursor: str | None = None
 
 @app.post("/ruta/fechas", response_model=List[Ubicacion])
 def obtener_ruta_por_fechas(
+    response: Response,
     rango: RangoFechas = Body(...),
-    usuario: dict = Depends(verificar_token)
+    accept: str | None = Header(None),
+    usuario: dict = Depends(verificar_token),
+    conn=Depends(get_db)
 ):
+    # El rango puede caer en cualquiera de los niveles del histórico (ver
+    # historico.py): ubicaciones, ubicaciones_resumidas o el archivo en disco.
     usuario_id = int(usuario["sub"])
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    version = version_usuario(conn, usuario_id)
+    fuente, archivo = niveles_rango(conn, usuario_id, rango.fecha_inicio, rango.fecha_fin)
+    # Los cortes del histórico van en la clave: la retención cambia la respuesta
+    clave = version and (usuario_id, "/ruta/fechas", tuple(rango.model_dump().values()), formato_ruta(accept),
+                         fuente, archivo and (archivo.hasta, archivo.sigue_en_bd), version)
+    return respuesta_cacheada(clave, lambda r: responder_ruta(
+        conn, r, usuario_id, (rango.fecha_inicio, rango.fecha_fin),
+        "usuario_id = %s AND recibido_en BETWEEN %s AND %s",
+        (usuario_id, rango.fecha_inicio, rango.fecha_fin), False,
+        rango.limite, rango.cursor, rango.tolerancia_m, rango.max_puntos, accept,
+        fuente, archivo), ADAPTADOR_RUTA)
 
-    cur.execute("""
-        SELECT * FROM ubicaciones
+@app.post("/ruta/resumen")
+def resumen_ruta(
+    rango: RangoFechas = Body(...),
+    usuario: dict = Depends(verificar_token),
+    conn=Depends(get_db)
+):
+    # Km del rango (con el mismo filtro de jitter que los cubos diarios) y
+    # bbox para encuadrar el mapa sin tener que descargar la ruta entera.
+    usuario_id = int(usuario["sub"])
+    version = version_usuario(conn, usuario_id)
+    fuente, archivo = niveles_rango(conn, usuario_id, rango.fecha_inicio, rango.fecha_fin)
+    clave = version and (usuario_id, "/ruta/resumen", rango.fecha_inicio, rango.fecha_fin,
+                         fuente, archivo and (archivo.hasta, archivo.sigue_en_bd), version)
+    return respuesta_cacheada(clave, lambda r: calcular_resumen(conn, usuario_id, rango, fuente, archivo))
+
+def calcular_resumen(conn, usuario_id, rango, fuente, archivo):
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT latitud, longitud, hdop FROM {fuente}
         WHERE usuario_id = %s
         AND recibido_en BETWEEN %s AND %s
-        ORDER BY recibido_en ASC
+        ORDER BY ubicaciones.recibido_en ASC
     """, (usuario_id, rango.fecha_inicio, rango.fecha_fin))
+    filas = cur.fetchall()
+    if archivo:
+        filas = [(f["latitud"], f["longitud"], f["hdop"]) for f in archivo.leer()[1]] + filas
+    if not filas:
+        return {"puntos": 0, "km": 0.0, "bbox": None}
 
-    ubicaciones = cur.fetchall()
-    conn.close()
+    datos = np.array(filas, dtype=np.float64)
+    km, _ = geo.distancias_filtradas(datos[:, 0], datos[:, 1], datos[:, 2])
+    return {"puntos": len(filas), "km": round(float(km.sum()), 2), "bbox": geo.bbox(datos[:, 0], datos[:, 1])}
 
-    for ubic in ubicaciones:
-        if isinstance(ubic["recibido_en"], datetime):
-            ubic["recibido_en"] = ubic["recibido_en"].strftime("%Y-%m-%d %H:%M:%S")
+@app.get("/distancia")
+def distancia(request: Request, response: Response, dias: int = Query(7, ge=1, le=366),
+              usuario: dict = Depends(verificar_token), conn=Depends(get_db)):
+    # Suma de los cubos diarios que acumula el consumidor MQTT (ver distancias.py):
+    # los últimos `dias` días naturales UTC, hoy incluido. Los cubos se
+    # escriben en la misma transacción que el estado, así que la versión es la
+    # del último fix más el día: a medianoche la ventana se mueve sola.
+    usuario_id = int(usuario["sub"])
+    version = version_usuario(conn, usuario_id)
+    hoy = datetime.now(timezone.utc).date()
+    cabeceras = validadores(usuario_id, version, hoy)
+    no_cambia = no_modificado(request, cabeceras)
+    if no_cambia:
+        return no_cambia
 
-    return ubicaciones
+    clave = version and (usuario_id, "/distancia", dias, hoy, version)
+    resultado = respuesta_cacheada(clave, lambda r: {"km_recorridos": km_ultimos_dias(conn, usuario_id, dias),
+                                                     "dias": dias})
+    return con_cabeceras(resultado, response, cabeceras)
 
 @app.get("/distancia_7_dias")
-def distancia_7_dias(usuario: dict = Depends(verificar_token)):
-    usuario_id = int(usuario["sub"])
-    conn = get_db()
-    distancia = calcular_distancia(conn, usuario_id, 7)
-    conn.close()
-    return {"km_recorridos": distancia, "dias": 7}
+def distancia_7_dias(request: Request, response: Response, usuario: dict = Depends(verificar_token),
+                     conn=Depends(get_db)):
+    return distancia(request, response, 7, usuario, conn)
 
 @app.get("/distancia_30_dias")
-def distancia_30_dias(usuario: dict = Depends(verificar_token)):
-    usuario_id = int(usuario["sub"])
-    conn = get_db()
-    distancia = calcular_distancia(conn, usuario_id, 30)
-    conn.close()
-    return {"km_recorridos": distancia, "dias": 30}
+def distancia_30_dias(request: Request, response: Response, usuario: dict = Depends(verificar_token),
+                      conn=Depends(get_db)):
+    return distancia(request, response, 30, usuario, conn)
 
-@app.post("/registrar")
-def registrar(
-    email: str = Form(...),
-    nombre: str = Form(...),
-    contraseña: str = Form(...),
-    codigo: str = Form(...)
+# Viajes que segmenta la ingesta (ver viajes.py), los más recientes primero:
+# una semana son unas decenas de filas en vez de miles de puntos. Las
+# paradas son los huecos entre un viaje y el siguiente. Se pagina con el
+# mismo cursor que /ruta (el id no se usa: inicio ya es único por usuario).
+VIAJES_PAGINA = 50
+VIAJES_MAX_PAGINA = 500
+
+@app.get("/viajes", response_model=List[Viaje])
+def listar_viajes(
+    request: Request,
+    response: Response,
+    desde: datetime | None = None,
+    hasta: datetime | None = None,
+    limite: int = Query(VIAJES_PAGINA, ge=1, le=VIAJES_MAX_PAGINA),
+    cursor: str | None = None,
+    usuario: dict = Depends(verificar_token),
+    conn=Depends(get_db)
 ):
-    conn = get_db()
+    # Los que se solapan con [desde, hasta]. El viaje en curso sale con
+    # en_curso hasta que llega el fix que confirma la parada.
+    usuario_id = int(usuario["sub"])
+    version = version_usuario(conn, usuario_id)
+    cabeceras = validadores(usuario_id, version)
+    no_cambia = no_modificado(request, cabeceras)
+    if no_cambia:
+        return no_cambia
+
+    clave = version and (usuario_id, "/viajes", desde, hasta, limite, cursor, version)
+    resultado = respuesta_cacheada(clave, lambda r: leer_viajes(conn, r, usuario_id, desde, hasta, limite, cursor),
+                                   ADAPTADOR_VIAJES)
+    return con_cabeceras(resultado, response, cabeceras)
+
+def leer_viajes(conn, response, usuario_id, desde, hasta, limite, cursor):
+    filtro, params = "usuario_id = %s", [usuario_id]
+    if desde is not None:
+        filtro += " AND fin >= %s"
+        params.append(desde)
+    if hasta is not None:
+        filtro += " AND inicio <= %s"
+        params.append(hasta)
+    if cursor:
+        filtro += " AND inicio < TIMESTAMPTZ 'epoch' + %s * INTERVAL '1 microsecond'"
+        params.append(decodificar_cursor(cursor)[0])
+
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(f"""
+        SELECT to_char(inicio, 'YYYY-MM-DD HH24:MI:SS') AS inicio, to_char(fin, 'YYYY-MM-DD HH24:MI:SS') AS fin,
+               EXTRACT(EPOCH FROM fin - inicio)::integer AS duracion_s, km, puntos,
+               latitud_inicio, longitud_inicio, latitud_fin, longitud_fin,
+               latitud_min, longitud_min, latitud_max, longitud_max, en_curso,
+               (EXTRACT(EPOCH FROM inicio) * 1000000)::bigint AS inicio_us
+        FROM viajes
+        WHERE {filtro}
+        ORDER BY inicio DESC
+        LIMIT %s
+    """, params + [limite + 1])
+    filas = cur.fetchall()
+    if len(filas) > limite:
+        filas = filas[:limite]
+        response.headers[CABECERA_CURSOR] = codificar_cursor(filas[-1]["inicio_us"], 0)
 
-    cur.execute("SELECT codigo, generado_en, usuario FROM codigos_verificacion WHERE email = %s", (email,))
-    row = cur.fetchone()
+    for fila in filas:
+        fila["km"] = round(fila["km"], 2)
+        fila["bbox"] = [fila.pop("latitud_min"), fila.pop("longitud_min"), fila.pop("latitud_max"),
+                        fila.pop("longitud_max")]
+    return filas
+
+# Desfase del reloj del dispositivo (recibido_en - hora_utc) y segundos entre
+# sus fixes en la última ventana, con los de la flota para comparar: un
+# desfase que crece es el módem acumulando retraso, uno de horas es la hora
+# GNSS mal. Los resume la ingesta (ver tiempos.py) y los guarda cada minuto.
+@app.get("/tiempos", response_model=TiemposUsuario)
+def obtener_tiempos(usuario: dict = Depends(verificar_token), conn=Depends(get_db)):
+    usuario_id = int(usuario["sub"])
+    cur = conn.cursor()
+    # Sin fixes en la ventana el resumen se ha quedado en la última vez que
+    # emitió: como si no hubiera, igual que la flota en leer_flota
+    cur.execute(f"""
+        SELECT {', '.join(COLUMNAS_RESUMEN)}, ultimo_fix FROM tiempos_dispositivo
+        WHERE usuario_id = %s AND ultimo_fix > NOW() - %s * INTERVAL '1 second'
+    """, (usuario_id, VENTANA_S))
+    fila = cur.fetchone()
+    flota = leer_flota(cur)
+    return {
+        "dispositivo": formatear_tiempos(fila[:-1], fila[-1]) if fila else None,
+        "flota": formatear_tiempos(*flota) if flota else None,
+    }
+
+def formatear_tiempos(resumen, ultimo_fix):
+    datos = {"ultimo_fix": ultimo_fix.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S") if ultimo_fix else None}
+    for i, magnitud in enumerate(("desfase", "intervalo")):
+        datos[magnitud] = dict(zip(("n", "media_s", "desviacion_s", "p50_s", "p95_s"), resumen[i * 5:i * 5 + 5]))
+    return datos
+
+def comprobar_codigo(email, nombre, codigo):
+    conn = pool_db.obtener()
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("SELECT codigo, generado_en, usuario FROM codigos_verificacion WHERE email = %s", (email,))
+            row = cur.fetchone()
+    finally:
+        pool_db.devolver(conn)
 
     if not row:
-        conn.close()
         raise HTTPException(status_code=400, detail="Correo no encontrado en la lista de verificación")
 
     if row["codigo"] != codigo:
-        conn.close()
         raise HTTPException(status_code=400, detail="Código de verificación incorrecto")
 
     if row["usuario"] != nombre:
-        conn.close()
         raise HTTPException(status_code=400, detail="El nombre de usuario no coincide con el asignado")
 
-    # Hashear contraseña
-    contraseña_hash = bcrypt.hash(contraseña)
-
+def crear_usuario(email, nombre, contraseña_hash):
+    conn = pool_db.obtener()
     try:
-        cur.execute(
-            "INSERT INTO usuarios (nombre, contraseña, correo) VALUES (%s, %s, %s)",
-            (nombre, contraseña_hash, email)
-        )
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "INSERT INTO usuarios (nombre, contraseña, correo) VALUES (%s, %s, %s)",
+                (nombre, contraseña_hash, email)
+            )
+            conn.commit()
+        except psycopg2.IntegrityError:
+            conn.rollback()
+            raise HTTPException(status_code=400, detail="El nombre o correo ya está registrado")
+
+        # Eliminar el código usado
+        cur.execute("DELETE FROM codigos_verificacion WHERE email = %s", (email,))
         conn.commit()
-    except psycopg2.IntegrityError:
-        conn.rollback()
-        conn.close()
-        raise HTTPException(status_code=400, detail="El nombre o correo ya está registrado")
+    finally:
+        pool_db.devolver(conn)
 
-    # Eliminar el código usado
-    cur.execute("DELETE FROM codigos_verificacion WHERE email = %s", (email,))
-    conn.commit()
-    conn.close()
+@app.post("/registrar")
+async def registrar(
+    email: str = Form(...),
+    nombre: str = Form(...),
+    contraseña: str = Form(...),
+    codigo: str = Form(...)
+):
+    # Como /token: async y sin get_db, para no tener un hilo de los endpoints
+    # (ni una conexión) parado mientras bcrypt hashea
+    await run_in_threadpool(comprobar_codigo, email, nombre, codigo)
+
+    # Hashear contraseña
+    contraseña_hash = await asyncio.wrap_future(encolar_bcrypt(bcrypt.hash, contraseña))
+
+    await run_in_threadpool(crear_usuario, email, nombre, contraseña_hash)
 
     return {"mensaje": "Usuario registrado correctamente"}
+
+@app.get("/metrics", include_in_schema=False)
+def exponer_metricas():
+    # Sin token, para que Prometheus pueda leerlas: se limita el acceso en el proxy.
+    # Con varios workers de uvicorn cada uno da las suyas.
+    return Response(metricas.exponer(), media_type=metricas.TIPO_CONTENIDO)
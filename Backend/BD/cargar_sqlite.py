@@ -0,0 +1,521 @@
+# Carga datos_mqtt.db (SQLite) en Postgres. Sustituye a migracion.load
+# (pgloader), que lo hacía todo de una vez y con "include drop".
+#
+#   python cargar_sqlite.py --crear-tablas   # crea las tablas que falten, como pgloader
+#   python cargar_sqlite.py                  # carga (o reanuda) lo que falte
+#   python cargar_sqlite.py --delta          # solo lo nuevo desde la última pasada, y lo verifica
+#   python cargar_sqlite.py --verificar      # sin cargar: compara todos los trozos con SQLite
+#   python cargar_sqlite.py --estado         # qué hay cargado y qué falta
+#
+# ubicaciones, que solo crece, se lee por trozos de rowid y la cargan varios
+# procesos con COPY. Cada trozo va en una transacción junto con su apunte en
+# carga_sqlite (rango, filas y suma md5 de lo copiado), así que si se corta se
+# relanza y sigue por donde iba. usuarios es pequeña y puede cambiar: se
+# sincroniza entera en cada pasada (INSERT ... ON CONFLICT; las bajas no se
+# propagan).
+#
+# Para el cambio con el mínimo corte: carga inicial con el sistema viejo en
+# marcha, unas cuantas pasadas --delta para acercarse, parar el sistema viejo,
+# una última --delta y arrancar el consumidor contra Postgres.
+#
+# Orden con una BD vacía: --crear-tablas, migrar.py (así ubicaciones ya está
+# particionada y hora_utc es TIME) y luego la carga. Las conversiones siguen el
+# tipo de la columna en Postgres: hora_utc mal formada queda a NULL (la misma
+# regla que la migración 0002) y las fechas de SQLite, sin zona, se toman en
+# ZONA_SQLITE. Después conviene lanzar Utils/reconstruir_distancias.py.
+import argparse
+import hashlib
+import io
+import os
+import sqlite3
+import sys
+import time as reloj
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, time, timezone
+
+import psycopg2
+import psycopg2.sql
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import historico
+from cache_usuarios import CANAL_USUARIOS
+from movimiento import segundos_del_dia
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+RUTA_SQLITE = "/mnt/disk2/../../datos_mqtt.db"  # la de migracion.load
+# En este orden: ubicaciones.usuario_id apunta a usuarios
+TABLAS = ("usuarios", "ubicaciones")
+POR_TROZOS = {"ubicaciones"}
+TAM_TROZO = 100000
+WORKERS = 4
+# CURRENT_TIMESTAMP de SQLite va en UTC
+ZONA_SQLITE = timezone.utc
+# Clave de pg_advisory_lock: dos cargas a la vez no se pisan
+CLAVE_BLOQUEO = 460120
+
+# nombre, columnas comunes a SQLite y Postgres, tipo en Postgres de cada una y
+# la columna que es el rowid en SQLite (INTEGER PRIMARY KEY)
+Tabla = namedtuple("Tabla", "nombre columnas tipos clave")
+
+ESCAPES_COPY = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def a_entero(v):
+    return None if v is None else int(v)
+
+
+def a_real(v):
+    return None if v is None else float(v)
+
+
+def a_texto(v):
+    return None if v is None else str(v)
+
+
+def a_hora(v):
+    s = segundos_del_dia(v)
+    return None if s is None else time(s // 3600, s // 60 % 60, s % 60)
+
+
+def a_fecha(v):
+    if v is None:
+        return None
+    if isinstance(v, (int, float)):
+        return datetime.fromtimestamp(v, ZONA_SQLITE)
+    fecha = datetime.fromisoformat(v)
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=ZONA_SQLITE)
+
+
+CONVERSIONES = {
+    "smallint": a_entero,
+    "integer": a_entero,
+    "bigint": a_entero,
+    "real": a_real,
+    "double precision": a_real,
+    "time without time zone": a_hora,
+    "timestamp with time zone": a_fecha,
+}
+
+
+def a_copy(v):
+    """Valor en formato texto de COPY. Se usa también al leer de Postgres para
+    verificar, así que las fechas van siempre en UTC."""
+    if v is None:
+        return "\\N"
+    if isinstance(v, float):
+        return repr(v)
+    if isinstance(v, datetime):
+        return v.astimezone(timezone.utc).isoformat()
+    if isinstance(v, time):
+        return v.isoformat()
+    return str(v).translate(ESCAPES_COPY)
+
+
+def suma(lineas):
+    h = hashlib.md5()
+    for linea in lineas:
+        h.update(linea.encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def abrir_sqlite(ruta):
+    # Solo lectura: el sistema viejo puede seguir escribiendo mientras tanto
+    return sqlite3.connect(f"file:{ruta}?mode=ro", uri=True)
+
+
+def comillas(nombre):
+    return '"' + nombre.replace('"', '""') + '"'
+
+
+def crear_tabla_carga(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS carga_sqlite (
+            tabla TEXT NOT NULL,
+            desde BIGINT NOT NULL,
+            hasta BIGINT NOT NULL,
+            filas INTEGER NOT NULL,
+            suma TEXT NOT NULL,
+            cargado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (tabla, desde)
+        )
+    ''')
+
+
+def describir(cur, conn_sqlite, nombre):
+    info = conn_sqlite.execute(f"PRAGMA table_info({comillas(nombre)})").fetchall()
+    if not info:
+        raise SystemExit(f"La tabla {nombre} no está en SQLite")
+    cur.execute('''
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    ''', (nombre,))
+    tipos_pg = dict(cur.fetchall())
+    if not tipos_pg:
+        raise SystemExit(f"La tabla {nombre} no existe en Postgres (¿falta --crear-tablas?)")
+    columnas = [c[1] for c in info if c[1] in tipos_pg]
+    # Solo INTEGER PRIMARY KEY es alias del rowid
+    claves = [c for c in info if c[5]]
+    clave = claves[0][1] if len(claves) == 1 and claves[0][2].upper() == "INTEGER" else None
+    if clave not in columnas:
+        raise SystemExit(f"{nombre}: hace falta una columna INTEGER PRIMARY KEY que exista en las dos BD")
+    return Tabla(nombre, tuple(columnas), tuple(tipos_pg[c] for c in columnas), clave)
+
+
+def tipo_pg(tipo_sqlite):
+    tipo = tipo_sqlite.upper()
+    if tipo in ("DATETIME", "TIMESTAMP"):
+        return "TIMESTAMPTZ"
+    if "INT" in tipo:
+        return "BIGINT"
+    if "REAL" in tipo or "FLOA" in tipo or "DOUB" in tipo:
+        return "DOUBLE PRECISION"
+    return "TEXT"
+
+
+def crear_tablas(conn, conn_sqlite):
+    """Crea en Postgres las tablas de TABLAS que no existan, con sus índices."""
+    identificador = psycopg2.sql.Identifier
+    with conn.cursor() as cur:
+        for nombre in TABLAS:
+            cur.execute("SELECT to_regclass(%s)", (nombre,))
+            if cur.fetchone()[0]:
+                print(f"{nombre}: ya existe", flush=True)
+                continue
+            definiciones = []
+            for _, columna, tipo, no_nula, _, pk in conn_sqlite.execute(f"PRAGMA table_info({comillas(nombre)})"):
+                if pk and tipo.upper() == "INTEGER":
+                    definicion = "{} BIGSERIAL PRIMARY KEY"
+                else:
+                    definicion = "{} " + tipo_pg(tipo) + (" NOT NULL" if no_nula else "")
+                definiciones.append(psycopg2.sql.SQL(definicion).format(identificador(columna)))
+            cur.execute(psycopg2.sql.SQL("CREATE TABLE {} ({})").format(
+                identificador(nombre), psycopg2.sql.SQL(", ").join(definiciones)))
+
+            for _, indice, unico, origen, _ in conn_sqlite.execute(f"PRAGMA index_list({comillas(nombre)})"):
+                if origen == "pk":
+                    continue
+                columnas = [i[2] for i in conn_sqlite.execute(f"PRAGMA index_info({comillas(indice)})")]
+                if origen == "u":
+                    cur.execute(psycopg2.sql.SQL("ALTER TABLE {} ADD UNIQUE ({})").format(
+                        identificador(nombre), psycopg2.sql.SQL(", ").join(map(identificador, columnas))))
+                else:
+                    cur.execute(psycopg2.sql.SQL("CREATE {} INDEX {} ON {} ({})").format(
+                        psycopg2.sql.SQL("UNIQUE" if unico else ""), identificador(indice), identificador(nombre),
+                        psycopg2.sql.SQL(", ").join(map(identificador, columnas))))
+            print(f"{nombre}: creada", flush=True)
+    conn.commit()
+
+
+def leer_trozo(conn_sqlite, tabla, desde, hasta):
+    """Filas con desde <= rowid < hasta, convertidas y como líneas de COPY."""
+    conversiones = [CONVERSIONES.get(t, a_texto) for t in tabla.tipos]
+    cur = conn_sqlite.execute(
+        f"SELECT rowid, {', '.join(map(comillas, tabla.columnas))} FROM {comillas(tabla.nombre)} "
+        "WHERE rowid >= ? AND rowid < ? ORDER BY rowid", (desde, hasta))
+    lineas = []
+    for fila in cur:
+        try:
+            valores = [f(v) for f, v in zip(conversiones, fila[1:])]
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"{tabla.nombre}, rowid {fila[0]}: {e}") from None
+        lineas.append("\t".join(map(a_copy, valores)))
+    return lineas
+
+
+def sql_copy(tabla, destino=None):
+    return psycopg2.sql.SQL("COPY {} ({}) FROM STDIN").format(
+        psycopg2.sql.Identifier(destino or tabla.nombre),
+        psycopg2.sql.SQL(", ").join(map(psycopg2.sql.Identifier, tabla.columnas)))
+
+
+def rango_rowid(conn_sqlite, nombre):
+    return conn_sqlite.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {comillas(nombre)}").fetchone()
+
+
+# --- Procesos de carga: cada uno con sus dos conexiones ---
+
+_sqlite = None
+_pg = None
+
+
+def iniciar_proceso(ruta_sqlite, config):
+    global _sqlite, _pg
+    _sqlite = abrir_sqlite(ruta_sqlite)
+    _pg = psycopg2.connect(**config)
+
+
+def cargar_trozo(tabla, desde, hasta):
+    inicio = reloj.monotonic()
+    lineas = leer_trozo(_sqlite, tabla, desde, hasta)
+    try:
+        with _pg.cursor() as cur:
+            cur.copy_expert(sql_copy(tabla).as_string(_pg), io.StringIO("".join(l + "\n" for l in lineas)))
+            cur.execute("INSERT INTO carga_sqlite (tabla, desde, hasta, filas, suma) VALUES (%s, %s, %s, %s, %s)",
+                        (tabla.nombre, desde, hasta, len(lineas), suma(lineas)))
+        _pg.commit()
+    except psycopg2.Error as e:
+        _pg.rollback()
+        # Los errores de psycopg2 no siempre vuelven bien al proceso principal
+        raise RuntimeError(f"{tabla.nombre} [{desde}, {hasta}): {e}") from None
+    return len(lineas), reloj.monotonic() - inicio
+
+
+def verificar_trozo(tabla, desde, hasta, suma_carga=None):
+    """Compara las filas del rango en SQLite y en Postgres; devuelve los problemas."""
+    origen = leer_trozo(_sqlite, tabla, desde, hasta)
+    clave = psycopg2.sql.Identifier(tabla.clave)
+    with _pg.cursor() as cur:
+        cur.execute(psycopg2.sql.SQL("SELECT {} FROM {} WHERE {} >= %s AND {} < %s ORDER BY {}").format(
+            psycopg2.sql.SQL(", ").join(map(psycopg2.sql.Identifier, tabla.columnas)),
+            psycopg2.sql.Identifier(tabla.nombre), clave, clave, clave), (desde, hasta))
+        destino = ["\t".join(map(a_copy, fila)) for fila in cur]
+    _pg.rollback()
+
+    problemas = []
+    if len(origen) != len(destino):
+        problemas.append(f"{len(origen)} filas en SQLite y {len(destino)} en Postgres")
+    elif suma(origen) != suma(destino):
+        distintas = sum(1 for a, b in zip(origen, destino) if a != b)
+        problemas.append(f"{distintas} filas distintas")
+    if suma_carga and suma(origen) != suma_carga:
+        problemas.append("SQLite ha cambiado desde que se cargó")
+    return len(origen), problemas
+
+
+# --- Proceso principal ---
+
+def pendientes(cur, conn_sqlite, tabla, delta):
+    """Trozos (desde, hasta) de rowid que aún no están en carga_sqlite."""
+    minimo, maximo = rango_rowid(conn_sqlite, tabla.nombre)
+    if minimo is None:
+        return []
+    cur.execute("SELECT desde, hasta FROM carga_sqlite WHERE tabla = %s ORDER BY desde", (tabla.nombre,))
+    huecos = []
+    pos = minimo
+    for desde, hasta in cur.fetchall():
+        if desde > pos:
+            huecos.append((pos, desde))
+        pos = max(pos, hasta)
+    if delta and huecos:
+        raise SystemExit(f"{tabla.nombre}: la carga inicial no está completa; lánzala antes sin --delta")
+    if pos <= maximo:
+        huecos.append((pos, maximo + 1))
+    return [(i, min(i + TAM_TROZO, fin)) for ini, fin in huecos for i in range(ini, fin, TAM_TROZO)]
+
+
+def asegurar_particiones(cur, conn_sqlite, trozos):
+    """Crea las particiones mensuales (migración 0003) de lo que se va a cargar,
+    para que nada caiga en ubicaciones_default."""
+    cur.execute("SELECT to_regproc('crear_particion_ubicaciones')")
+    if not cur.fetchone()[0] or not trozos:
+        return
+    primero, ultimo = conn_sqlite.execute(
+        "SELECT MIN(recibido_en), MAX(recibido_en) FROM ubicaciones WHERE rowid >= ?", (trozos[0][0],)).fetchone()
+    if primero is None:
+        return
+    for mes in historico.meses(a_fecha(primero), a_fecha(ultimo)):
+        cur.execute("SELECT crear_particion_ubicaciones(%s)", (mes.date(),))
+
+
+def sincronizar(conn, conn_sqlite, tabla):
+    """Copia la tabla entera a una temporal y de ahí actualiza o inserta por la clave."""
+    minimo, maximo = rango_rowid(conn_sqlite, tabla.nombre)
+    if minimo is None:
+        return 0
+    lineas = leer_trozo(conn_sqlite, tabla, minimo, maximo + 1)
+    identificador = psycopg2.sql.Identifier
+    columnas = psycopg2.sql.SQL(", ").join(map(identificador, tabla.columnas))
+    with conn.cursor() as cur:
+        cur.execute(psycopg2.sql.SQL("CREATE TEMP TABLE carga_tmp (LIKE {}) ON COMMIT DROP")
+                    .format(identificador(tabla.nombre)))
+        cur.copy_expert(sql_copy(tabla, "carga_tmp").as_string(conn), io.StringIO("".join(l + "\n" for l in lineas)))
+        cur.execute(psycopg2.sql.SQL('''
+            INSERT INTO {tabla} ({columnas}) SELECT {columnas} FROM carga_tmp
+            ON CONFLICT ({clave}) DO UPDATE SET {cambios}
+        ''').format(tabla=identificador(tabla.nombre), columnas=columnas, clave=identificador(tabla.clave),
+                    cambios=psycopg2.sql.SQL(", ").join(
+                        psycopg2.sql.SQL("{0} = EXCLUDED.{0}").format(identificador(c))
+                        for c in tabla.columnas if c != tabla.clave)))
+        if tabla.nombre == "usuarios":
+            # Payload vacío: el consumidor vacía su cache de usuarios entera
+            cur.execute("SELECT pg_notify(%s, '')", (CANAL_USUARIOS,))
+    conn.commit()
+    return len(lineas)
+
+
+def ajustar_secuencias(conn, tabla):
+    # Lo que hacía "reset sequences": las filas llegan con su id, la secuencia no se entera
+    with conn.cursor() as cur:
+        cur.execute('''
+            SELECT column_name, pg_get_serial_sequence(quote_ident(table_name), column_name)
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_default LIKE 'nextval(%%'
+        ''', (tabla.nombre,))
+        for columna, secuencia in cur.fetchall():
+            if secuencia is None:
+                continue
+            cur.execute(psycopg2.sql.SQL('''
+                SELECT setval(%s, GREATEST(MAX({}), pg_sequence_last_value(%s::regclass), 1)) FROM {}
+            ''').format(psycopg2.sql.Identifier(columna), psycopg2.sql.Identifier(tabla.nombre)),
+                (secuencia, secuencia))
+    conn.commit()
+
+
+def repartir(ruta_sqlite, workers, funcion, tareas):
+    """Lanza funcion(*tarea) en `workers` procesos; devuelve pares (tarea, resultado)
+    según van acabando. Al primer error se cancela el resto."""
+    with ProcessPoolExecutor(workers, initializer=iniciar_proceso,
+                             initargs=(ruta_sqlite, POSTGRES_CONFIG)) as pool:
+        futuros = {pool.submit(funcion, *tarea): tarea for tarea in tareas}
+        try:
+            for futuro in as_completed(futuros):
+                yield futuros[futuro], futuro.result()
+        except BaseException:
+            for futuro in futuros:
+                futuro.cancel()
+            raise
+
+
+def cargar(conn, conn_sqlite, ruta_sqlite, workers, delta):
+    inicio = reloj.monotonic()
+    cargados = []
+    for nombre in TABLAS:
+        with conn.cursor() as cur:
+            tabla = describir(cur, conn_sqlite, nombre)
+            if nombre not in POR_TROZOS:
+                conn.commit()
+                n = sincronizar(conn, conn_sqlite, tabla)
+                print(f"{nombre}: {n} filas sincronizadas", flush=True)
+                ajustar_secuencias(conn, tabla)
+                continue
+            trozos = pendientes(cur, conn_sqlite, tabla, delta)
+            if nombre == "ubicaciones":
+                asegurar_particiones(cur, conn_sqlite, trozos)
+        conn.commit()
+
+        print(f"{nombre}: {len(trozos)} trozos pendientes", flush=True)
+        filas = 0
+        t0 = reloj.monotonic()
+        for (_, desde, hasta), (n, segundos) in repartir(ruta_sqlite, workers, cargar_trozo,
+                                                         [(tabla, d, h) for d, h in trozos]):
+            filas += n
+            print(f"{nombre} [{desde}, {hasta}): {n} filas en {segundos:.1f} s", flush=True)
+        if trozos:
+            t = reloj.monotonic() - t0
+            print(f"{nombre}: {filas} filas en {t:.1f} s ({filas / max(t, 1e-9):.0f} filas/s)", flush=True)
+            ajustar_secuencias(conn, tabla)
+            cargados.append((tabla, trozos))
+
+    if cargados and not delta:
+        # Para los index-only scans de la ruta hace falta el mapa de visibilidad
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for tabla, _ in cargados:
+                    print(f"VACUUM (ANALYZE) {tabla.nombre}...", flush=True)
+                    cur.execute(psycopg2.sql.SQL("VACUUM (ANALYZE) {}").format(
+                        psycopg2.sql.Identifier(tabla.nombre)))
+        finally:
+            conn.autocommit = False
+    print(f"Carga terminada en {reloj.monotonic() - inicio:.1f} s.", flush=True)
+    return cargados
+
+
+def verificar(conn, conn_sqlite, ruta_sqlite, workers, solo=None):
+    """Compara con SQLite los trozos cargados (o solo los de `solo`: {tabla: trozos}).
+    Devuelve cuántos tienen problemas."""
+    tareas = []
+    with conn.cursor() as cur:
+        for nombre in TABLAS:
+            tabla = describir(cur, conn_sqlite, nombre)
+            if nombre not in POR_TROZOS:
+                minimo, maximo = rango_rowid(conn_sqlite, nombre)
+                if minimo is not None:
+                    tareas.append((tabla, minimo, maximo + 1, None))
+                continue
+            cur.execute("SELECT desde, hasta, suma FROM carga_sqlite WHERE tabla = %s ORDER BY desde", (nombre,))
+            for desde, hasta, s in cur.fetchall():
+                if solo is None or (desde, hasta) in solo.get(nombre, ()):
+                    tareas.append((tabla, desde, hasta, s))
+    conn.commit()
+
+    malos = filas = 0
+    for (tabla, desde, hasta, _), (n, problemas) in repartir(ruta_sqlite, workers, verificar_trozo, tareas):
+        filas += n
+        if problemas:
+            malos += 1
+            print(f"{tabla.nombre} [{desde}, {hasta}): {'; '.join(problemas)}", flush=True)
+    print(f"Verificados {len(tareas)} trozos ({filas} filas): {malos} con diferencias.", flush=True)
+    return malos
+
+
+def estado(conn, conn_sqlite):
+    with conn.cursor() as cur:
+        for nombre in TABLAS:
+            total = conn_sqlite.execute(f"SELECT COUNT(*) FROM {comillas(nombre)}").fetchone()[0]
+            if nombre not in POR_TROZOS:
+                print(f"{nombre}: {total} filas en SQLite, se sincroniza entera en cada pasada")
+                continue
+            cur.execute("SELECT COUNT(*), COALESCE(SUM(filas), 0), MAX(cargado_en) FROM carga_sqlite WHERE tabla = %s",
+                        (nombre,))
+            trozos, filas, ultimo = cur.fetchone()
+            faltan = pendientes(cur, conn_sqlite, describir(cur, conn_sqlite, nombre), False)
+            print(f"{nombre}: {filas} de {total} filas cargadas en {trozos} trozos "
+                  f"(último {ultimo or '-'}), {len(faltan)} trozos pendientes")
+    conn.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga la BD SQLite del sistema viejo en Postgres")
+    parser.add_argument("--sqlite", default=RUTA_SQLITE, help=f"fichero SQLite (por defecto {RUTA_SQLITE})")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="procesos de carga en paralelo")
+    parser.add_argument("--delta", action="store_true", help="solo lo nuevo desde la última pasada, y verificarlo")
+    grupo = parser.add_mutually_exclusive_group()
+    grupo.add_argument("--crear-tablas", action="store_true", help="crear las tablas que falten y salir")
+    grupo.add_argument("--verificar", action="store_true", help="comparar lo cargado con SQLite, sin cargar")
+    grupo.add_argument("--estado", action="store_true", help="listar lo cargado y lo pendiente")
+    args = parser.parse_args()
+    if not os.path.exists(args.sqlite):
+        raise SystemExit(f"No existe {args.sqlite}")
+
+    conn_sqlite = abrir_sqlite(args.sqlite)
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (CLAVE_BLOQUEO,))
+            if not cur.fetchone()[0]:
+                raise SystemExit("Ya hay otra carga en marcha")
+            crear_tabla_carga(cur)
+        conn.commit()
+
+        if args.crear_tablas:
+            crear_tablas(conn, conn_sqlite)
+        elif args.estado:
+            estado(conn, conn_sqlite)
+        elif args.verificar:
+            if verificar(conn, conn_sqlite, args.sqlite, args.workers):
+                sys.exit(1)
+        else:
+            cargados = cargar(conn, conn_sqlite, args.sqlite, args.workers, args.delta)
+            if args.delta and verificar(conn, conn_sqlite, args.sqlite, args.workers,
+                                        {t.nombre: set(trozos) for t, trozos in cargados}):
+                sys.exit(1)
+    except (psycopg2.Error, RuntimeError, ValueError) as e:
+        print(f"Error en la carga: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+        conn_sqlite.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+-- sin transaccion
+-- Índice de la paginación por cursor de /ruta y /ruta/fechas: (recibido_en, id)
+-- dentro de cada usuario. El mismo índice sirve para recorrerlo en los dos
+-- sentidos. Si una ejecución anterior falló a medias puede haber quedado un
+-- índice INVALID con este nombre, por eso se borra antes.
+DROP INDEX CONCURRENTLY IF EXISTS ubicaciones_usuario_recibido_id_idx;
+CREATE INDEX CONCURRENTLY ubicaciones_usuario_recibido_id_idx ON ubicaciones (usuario_id, recibido_en, id);
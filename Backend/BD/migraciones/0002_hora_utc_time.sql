@@ -0,0 +1,7 @@
+-- hora_utc pasa de TEXT a TIME. Es la hora que manda el GPS ("HH:MM:SS");
+-- lo que no tenga esa forma queda a NULL, igual que lo trata
+-- movimiento.segundos_del_dia. Reescribe la tabla: el consumidor espera con
+-- sus lotes en cola mientras dura.
+ALTER TABLE ubicaciones
+    ALTER COLUMN hora_utc TYPE TIME
+    USING CASE WHEN hora_utc ~ '^([01]?[0-9]|2[0-3]):[0-5]?[0-9]:[0-5]?[0-9]$' THEN hora_utc::time END;
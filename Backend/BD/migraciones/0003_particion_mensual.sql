@@ -0,0 +1,108 @@
+-- ubicaciones pasa a estar particionada por mes (UTC) de recibido_en, con el
+-- índice cubriente de las consultas calientes en el padre:
+--
+--   (usuario_id, recibido_en, id) INCLUDE (hora_utc, latitud, longitud, altitud, hdop, en_movimiento)
+--
+-- Sirve a la paginación de /ruta y /ruta/fechas, a /ruta/resumen, al estado
+-- en frío de la API y a la carga de ventanas y anclas del consumidor sin ir
+-- al heap. Sustituye al índice de 0001.
+--
+-- Las particiones las crea asegurar_particiones_ubicaciones(), que el
+-- consumidor llama al arrancar y cada pocas horas. Lo que caiga fuera de
+-- ellas va a ubicaciones_default y se mueve a su partición cuando esta se crea.
+--
+-- El VACUUM que necesitan las particiones recién copiadas va aparte, en 0004.
+-- Copia la tabla entera dentro de la transacción: bloquea escrituras mientras
+-- dura y necesita espacio para una segunda copia.
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM ubicaciones WHERE recibido_en IS NULL) THEN
+        RAISE EXCEPTION 'Hay filas de ubicaciones sin recibido_en: revisarlas antes de particionar';
+    END IF;
+END $$;
+
+ALTER TABLE ubicaciones RENAME TO ubicaciones_antigua;
+
+-- Los índices viejos conservan su nombre: se renombran para poder reutilizarlos
+DO $$
+DECLARE r record;
+BEGIN
+    FOR r IN SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+             WHERE i.indrelid = 'ubicaciones_antigua'::regclass LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', r.relname, left(r.relname, 50) || '_antiguo');
+    END LOOP;
+END $$;
+
+CREATE TABLE ubicaciones (LIKE ubicaciones_antigua INCLUDING DEFAULTS) PARTITION BY RANGE (recibido_en);
+ALTER TABLE ubicaciones ALTER COLUMN recibido_en SET NOT NULL;
+CREATE TABLE ubicaciones_default PARTITION OF ubicaciones DEFAULT;
+
+-- La secuencia de id (bigserial) pasa a la tabla nueva antes de borrar la vieja
+DO $$
+DECLARE secuencia text := pg_get_serial_sequence('ubicaciones_antigua', 'id');
+BEGIN
+    IF secuencia IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY ubicaciones.id', secuencia);
+    END IF;
+END $$;
+
+-- Claves foráneas que tuviera la tabla (p. ej. usuario_id -> usuarios)
+DO $$
+DECLARE r record;
+BEGIN
+    FOR r IN SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+             WHERE conrelid = 'ubicaciones_antigua'::regclass AND contype = 'f' LOOP
+        EXECUTE format('ALTER TABLE ubicaciones ADD CONSTRAINT %I %s', r.conname, r.def);
+    END LOOP;
+END $$;
+
+CREATE OR REPLACE FUNCTION crear_particion_ubicaciones(mes date) RETURNS boolean AS $$
+DECLARE
+    desde timestamptz := date_trunc('month', mes)::timestamp AT TIME ZONE 'UTC';
+    hasta timestamptz := (date_trunc('month', mes) + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC';
+    nombre text := 'ubicaciones_p' || to_char(date_trunc('month', mes), 'YYYYMM');
+BEGIN
+    -- Varios consumidores pueden llamarla a la vez
+    PERFORM pg_advisory_xact_lock(hashtext('crear_particion_ubicaciones'));
+    IF to_regclass(nombre) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE ubicaciones INCLUDING DEFAULTS)', nombre);
+    EXECUTE format('WITH movidas AS (DELETE FROM ubicaciones_default WHERE recibido_en >= %L AND recibido_en < %L RETURNING *)
+                    INSERT INTO %I SELECT * FROM movidas', desde, hasta, nombre);
+    EXECUTE format('ALTER TABLE ubicaciones ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', nombre, desde, hasta);
+    RETURN true;
+END $$ LANGUAGE plpgsql;
+
+-- Crea (si faltan) las particiones del mes actual y de los `meses_adelante`
+-- siguientes; devuelve cuántas ha creado.
+CREATE OR REPLACE FUNCTION asegurar_particiones_ubicaciones(meses_adelante integer DEFAULT 2) RETURNS integer AS $$
+DECLARE
+    creadas integer := 0;
+    i integer;
+BEGIN
+    FOR i IN 0..meses_adelante LOOP
+        IF crear_particion_ubicaciones(((NOW() AT TIME ZONE 'UTC') + make_interval(months => i))::date) THEN
+            creadas := creadas + 1;
+        END IF;
+    END LOOP;
+    RETURN creadas;
+END $$ LANGUAGE plpgsql;
+
+SELECT crear_particion_ubicaciones(mes::date)
+FROM generate_series(
+    (SELECT date_trunc('month', MIN(recibido_en AT TIME ZONE 'UTC')) FROM ubicaciones_antigua),
+    (SELECT MAX(recibido_en AT TIME ZONE 'UTC') FROM ubicaciones_antigua),
+    INTERVAL '1 month'
+) AS mes;
+SELECT asegurar_particiones_ubicaciones(2);
+
+INSERT INTO ubicaciones SELECT * FROM ubicaciones_antigua;
+
+-- Índices después de copiar: se construyen de una vez en cada partición
+ALTER TABLE ubicaciones ADD PRIMARY KEY (id, recibido_en);
+CREATE INDEX ubicaciones_usuario_recibido_id_idx ON ubicaciones (usuario_id, recibido_en, id)
+    INCLUDE (hora_utc, latitud, longitud, altitud, hdop, en_movimiento);
+
+DROP TABLE ubicaciones_antigua;
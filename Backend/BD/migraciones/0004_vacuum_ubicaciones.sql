@@ -0,0 +1,5 @@
+-- sin transaccion
+-- Tras la copia de 0003 las particiones no tienen mapa de visibilidad: sin
+-- este VACUUM los index-only scans del índice cubriente van igualmente al heap.
+-- VACUUM no puede ir dentro de una transacción.
+VACUUM (ANALYZE) ubicaciones;
@@ -0,0 +1,18 @@
+-- Niveles del histórico (ver historico.py y Utils/retencion.py).
+--
+-- ubicaciones_resumidas guarda un fix por minuto y dispositivo de los meses
+-- que ya han salido de ubicaciones, con sus mismos tipos y su id original
+-- (la paginación por (recibido_en, id) sigue valiendo). La clave cubre las
+-- consultas de la ruta igual que el índice de 0003.
+CREATE TABLE ubicaciones_resumidas (LIKE ubicaciones);
+ALTER TABLE ubicaciones_resumidas ADD COLUMN fixes INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE ubicaciones_resumidas ADD PRIMARY KEY (usuario_id, recibido_en, id)
+    INCLUDE (hora_utc, latitud, longitud, altitud, hdop, en_movimiento);
+
+-- Dónde empieza cada nivel; NULL mientras no se use. Una sola fila.
+CREATE TABLE historico_cortes (
+    unica BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (unica),
+    resumido_desde TIMESTAMPTZ,
+    completo_desde TIMESTAMPTZ
+);
+INSERT INTO historico_cortes DEFAULT VALUES;
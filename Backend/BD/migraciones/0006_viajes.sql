@@ -0,0 +1,27 @@
+-- Viajes y estado del segmentador (ver viajes.py). Antes los creaba el
+-- consumidor al arrancar; IF NOT EXISTS para las BD donde ya lo hizo.
+CREATE TABLE IF NOT EXISTS viajes (
+    usuario_id BIGINT NOT NULL,
+    inicio TIMESTAMPTZ NOT NULL,
+    fin TIMESTAMPTZ NOT NULL,
+    km DOUBLE PRECISION NOT NULL,
+    puntos INTEGER NOT NULL,
+    latitud_inicio DOUBLE PRECISION NOT NULL,
+    longitud_inicio DOUBLE PRECISION NOT NULL,
+    latitud_fin DOUBLE PRECISION NOT NULL,
+    longitud_fin DOUBLE PRECISION NOT NULL,
+    latitud_min DOUBLE PRECISION NOT NULL,
+    longitud_min DOUBLE PRECISION NOT NULL,
+    latitud_max DOUBLE PRECISION NOT NULL,
+    longitud_max DOUBLE PRECISION NOT NULL,
+    en_curso BOOLEAN NOT NULL,
+    PRIMARY KEY (usuario_id, inicio)
+);
+
+CREATE TABLE IF NOT EXISTS viajes_estado (
+    usuario_id BIGINT PRIMARY KEY,
+    latitud DOUBLE PRECISION,
+    longitud DOUBLE PRECISION,
+    ancla_en TIMESTAMPTZ,
+    visto_en TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,38 @@
+-- Desfase del reloj e intervalo entre fixes (ver tiempos.py): resumen ya
+-- calculado más el estado serializado para retomarlo tras un reinicio. Antes
+-- los creaba el consumidor al arrancar; IF NOT EXISTS para las BD donde ya lo
+-- hizo. Las columnas siguen tiempos.COLUMNAS_RESUMEN.
+CREATE TABLE IF NOT EXISTS tiempos_dispositivo (
+    usuario_id BIGINT PRIMARY KEY,
+    n_desfase BIGINT NOT NULL,
+    media_desfase DOUBLE PRECISION,
+    desviacion_desfase DOUBLE PRECISION,
+    p50_desfase DOUBLE PRECISION,
+    p95_desfase DOUBLE PRECISION,
+    n_intervalo BIGINT NOT NULL,
+    media_intervalo DOUBLE PRECISION,
+    desviacion_intervalo DOUBLE PRECISION,
+    p50_intervalo DOUBLE PRECISION,
+    p95_intervalo DOUBLE PRECISION,
+    ultimo_fix TIMESTAMPTZ,
+    estado BYTEA NOT NULL,
+    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Una fila por proceso de ingesta; se combinan al leer
+CREATE TABLE IF NOT EXISTS tiempos_flota (
+    proceso TEXT PRIMARY KEY,
+    n_desfase BIGINT NOT NULL,
+    media_desfase DOUBLE PRECISION,
+    desviacion_desfase DOUBLE PRECISION,
+    p50_desfase DOUBLE PRECISION,
+    p95_desfase DOUBLE PRECISION,
+    n_intervalo BIGINT NOT NULL,
+    media_intervalo DOUBLE PRECISION,
+    desviacion_intervalo DOUBLE PRECISION,
+    p50_intervalo DOUBLE PRECISION,
+    p95_intervalo DOUBLE PRECISION,
+    ultimo_fix TIMESTAMPTZ,
+    estado BYTEA NOT NULL,
+    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,148 @@
+# Aplica en orden las migraciones de BD/migraciones que falten, apuntándolas
+# en la tabla schema_migraciones.
+#
+#   python migrar.py             # aplica las pendientes
+#   python migrar.py --estado    # lista aplicadas y pendientes, sin tocar nada
+#
+# Cada migración es un fichero NNNN_descripcion.sql. Se ejecuta entero dentro
+# de una transacción junto con su apunte, salvo que la primera línea sea
+# "-- sin transaccion" (p. ej. CREATE INDEX CONCURRENTLY): entonces va en
+# autocommit sentencia a sentencia, y cada sentencia debe acabar en ';' a final
+# de línea. Esas migraciones tienen que poder repetirse si fallan a medias.
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import psycopg2
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+DIR_MIGRACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migraciones")
+PATRON_FICHERO = re.compile(r"^(\d{4})_(\w+)\.sql$")
+MARCA_SIN_TRANSACCION = "-- sin transaccion"
+# Clave de pg_advisory_lock: dos migrar.py a la vez se esperan en vez de pisarse
+CLAVE_BLOQUEO = 460118
+
+
+def listar_migraciones(directorio=DIR_MIGRACIONES):
+    migraciones = []
+    for fichero in sorted(os.listdir(directorio)):
+        m = PATRON_FICHERO.match(fichero)
+        if m:
+            with open(os.path.join(directorio, fichero), encoding="utf-8") as f:
+                sql = f.read()
+            migraciones.append((int(m.group(1)), m.group(2), sql))
+    versiones = [v for v, _, _ in migraciones]
+    if len(versiones) != len(set(versiones)):
+        raise SystemExit("Hay dos migraciones con el mismo número de versión")
+    return migraciones
+
+
+def suma(sql):
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+
+def sentencias(sql):
+    # Solo para las migraciones sin transacción: sin funciones ni ';' internos
+    lineas = [l for l in sql.splitlines() if not l.strip().startswith("--")]
+    return [s.strip() for s in re.split(r";\s*$", "\n".join(lineas), flags=re.M) if s.strip()]
+
+
+def crear_tabla(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migraciones (
+            version INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            suma TEXT NOT NULL,
+            aplicada_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    ''')
+
+
+def aplicadas(cur):
+    cur.execute("SELECT version, nombre, suma FROM schema_migraciones ORDER BY version")
+    return {version: (nombre, s) for version, nombre, s in cur.fetchall()}
+
+
+def aplicar(conn, version, nombre, sql):
+    apunte = ("INSERT INTO schema_migraciones (version, nombre, suma) VALUES (%s, %s, %s)",
+              (version, nombre, suma(sql)))
+    if sql.lstrip().startswith(MARCA_SIN_TRANSACCION):
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for sentencia in sentencias(sql):
+                    cur.execute(sentencia)
+                cur.execute(*apunte)
+        finally:
+            conn.autocommit = False
+    else:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            cur.execute(*apunte)
+        conn.commit()
+
+
+def migrar(conn, solo_estado=False):
+    """Aplica las migraciones pendientes; devuelve cuántas se aplicaron."""
+    with conn.cursor() as cur:
+        crear_tabla(cur)
+        conn.commit()
+        cur.execute("SELECT pg_advisory_lock(%s)", (CLAVE_BLOQUEO,))
+        conn.commit()
+    try:
+        with conn.cursor() as cur:
+            hechas = aplicadas(cur)
+        conn.commit()
+
+        pendientes = []
+        for version, nombre, sql in listar_migraciones():
+            if version in hechas:
+                estado = "aplicada"
+                if hechas[version][1] != suma(sql):
+                    estado = "aplicada, PERO EL FICHERO HA CAMBIADO"
+            else:
+                estado = "pendiente"
+                pendientes.append((version, nombre, sql))
+            print(f"{version:04d} {nombre}: {estado}", flush=True)
+
+        if solo_estado:
+            return 0
+        for version, nombre, sql in pendientes:
+            print(f"Aplicando {version:04d} {nombre}...", flush=True)
+            aplicar(conn, version, nombre, sql)
+        return len(pendientes)
+    finally:
+        conn.rollback()  # por si una migración falló dentro de su transacción
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (CLAVE_BLOQUEO,))
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aplica las migraciones de esquema pendientes")
+    parser.add_argument("--estado", action="store_true", help="solo listar, sin aplicar")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        n = migrar(conn, solo_estado=args.estado)
+        if not args.estado:
+            print(f"{n} migraciones aplicadas.")
+    except psycopg2.Error as e:
+        print(f"Error en la migración: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
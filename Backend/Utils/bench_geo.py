@@ -0,0 +1,103 @@
+# Benchmark de geo.py: versión escalar (bucle con math, como hacía la API)
+# frente a la vectorizada con NumPy, para longitud de ruta y para longitud con
+# filtro de jitter. Comprueba además que ambas dan el mismo resultado.
+#
+#   python bench_geo.py                      # 1k, 100k y 1M puntos
+#   python bench_geo.py --puntos 5000 --salida geo.json
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geo
+from distancias import AcumuladorDistancias
+
+TAMAÑOS = (1000, 100000, 1000000)
+TOLERANCIA_RELATIVA = 1e-9
+
+
+def generar_ruta(n, semilla=1, intervalo_s=5):
+    """Recorrido sintético con un fix cada `intervalo_s`: tramos en marcha
+    (~12 m/s, rumbo que cambia poco a poco) alternados con paradas en las que
+    el GPS baila unos metros, y algún fix con hdop malo."""
+    rng = np.random.default_rng(semilla)
+    parado = (np.arange(n) // 120) % 2 == 1
+    rumbo = np.cumsum(rng.normal(scale=0.15, size=n))
+    velocidad = np.where(parado, 0.0, rng.normal(12.0, 3.0, n).clip(0))
+    paso = (velocidad * intervalo_s)[:, None] * np.column_stack((np.cos(rumbo), np.sin(rumbo)))
+    ruido = 4.0 * rng.normal(size=(n, 2))
+    metros = np.cumsum(paso, axis=0) + ruido
+    lat = 40.4 + metros[:, 0] / 111320.0
+    lon = -3.7 + metros[:, 1] / (111320.0 * np.cos(np.radians(40.4)))
+    hdop = np.where(rng.random(n) < 0.02, 9.9, rng.uniform(0.7, 2.5, n))
+    return lat, lon, hdop
+
+
+def longitud_escalar(lat, lon):
+    total = 0.0
+    for i in range(1, len(lat)):
+        total += geo.haversine(lat[i - 1], lon[i - 1], lat[i], lon[i])
+    return total
+
+
+def longitud_filtrada_escalar(lat, lon, hdop):
+    acumulador = AcumuladorDistancias({})
+    for la, lo, h in zip(lat, lon, hdop):
+        acumulador.sumar("bench", 0, None, la, lo, h)
+    return sum(acumulador.km.values())
+
+
+def cronometrar(funcion, *args):
+    inicio = time.perf_counter()
+    resultado = funcion(*args)
+    return resultado, (time.perf_counter() - inicio) * 1000
+
+
+def medir(n):
+    lat, lon, hdop = generar_ruta(n)
+    lat_l, lon_l, hdop_l = lat.tolist(), lon.tolist(), hdop.tolist()
+
+    esc, ms_esc = cronometrar(longitud_escalar, lat_l, lon_l)
+    vec, ms_vec = cronometrar(geo.longitud_ruta, lat, lon)
+    esc_f, ms_esc_f = cronometrar(longitud_filtrada_escalar, lat_l, lon_l, hdop_l)
+    (km_f, _), ms_vec_f = cronometrar(geo.distancias_filtradas, lat, lon, hdop)
+    vec_f = float(km_f.sum())
+
+    for a, b in ((esc, vec), (esc_f, vec_f)):
+        if abs(a - b) > TOLERANCIA_RELATIVA * max(abs(a), 1.0):
+            raise AssertionError(f"{n} puntos: escalar={a!r} vectorizado={b!r}")
+
+    return {
+        "puntos": n,
+        "km_sin_filtro": round(vec, 3),
+        "km_con_filtro": round(vec_f, 3),
+        "longitud_ms": {"escalar": round(ms_esc, 2), "numpy": round(ms_vec, 2),
+                        "aceleracion": round(ms_esc / ms_vec, 1)},
+        "filtrada_ms": {"escalar": round(ms_esc_f, 2), "numpy": round(ms_vec_f, 2),
+                        "aceleracion": round(ms_esc_f / ms_vec_f, 1)},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark escalar vs NumPy de geo.py")
+    parser.add_argument("--puntos", type=int, action="append", help="repetible; por defecto 1k, 100k y 1M")
+    parser.add_argument("--salida", help="guardar los resultados JSON en este fichero")
+    args = parser.parse_args()
+
+    resultados = []
+    print(f"{'puntos':>9}{'km':>10}{'km filtro':>11}{'escalar ms':>12}{'numpy ms':>10}{'x':>7}"
+          f"{'filtro esc ms':>15}{'filtro np ms':>14}{'x':>7}")
+    for n in args.puntos or TAMAÑOS:
+        r = medir(n)
+        resultados.append(r)
+        lo, fi = r["longitud_ms"], r["filtrada_ms"]
+        print(f"{n:>9}{r['km_sin_filtro']:>10}{r['km_con_filtro']:>11}{lo['escalar']:>12}{lo['numpy']:>10}"
+              f"{lo['aceleracion']:>7}{fi['escalar']:>15}{fi['numpy']:>14}{fi['aceleracion']:>7}", flush=True)
+
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(resultados, f, indent=2)
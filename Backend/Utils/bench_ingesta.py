@@ -0,0 +1,176 @@
+# Caudal de la ingesta de extremo a extremo (MQTT -> Postgres) según el número
+# de procesos de main.py, contra un broker local (p. ej. Mosquitto).
+#
+#   python bench_ingesta.py --workers 1 2 4 8 --mensajes 50000 --dispositivos 500
+#
+# Para cada valor lanza ../main.py --workers N (que tiene que apuntar al mismo
+# broker y a la misma BD que este script), publica los mensajes repartidos
+# entre los dispositivos y espera a que lleguen a ubicaciones. Cada fix lleva
+# su número de secuencia en la altitud, así se comprueba que cada dispositivo
+# conserva su orden. Solo contra una BD de pruebas: da de alta un usuario por
+# dispositivo ficticio.
+#
+# Con --async se lanza ../ingesta_async.py --escritores N en lugar de main.py.
+# Además del caudal se da la CPU que gastó el consumidor por cada 1000 filas:
+# con un broker local en la misma máquina el caudal lo suele marcar el broker.
+import argparse
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import paho.mqtt.client as mqtt
+import psycopg2
+
+from datasimulation import cifrar_csv
+
+MQTT_BROKER = "localhost"
+MQTT_PORT = 1883
+MQTT_TOPIC = "ubi/campers"
+MQTT_USER = "USER"
+MQTT_PASS = "PASSWD"
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+MAIN_ASYNC = os.path.join(os.path.dirname(MAIN), "ingesta_async.py")
+ESPERA_ARRANQUE_S = 60
+# Sin filas nuevas durante este tiempo se da la pasada por terminada
+ESPERA_SIN_PROGRESO_S = 10
+
+
+def arrancar_consumidor(workers, log, asincrono=False):
+    orden = [MAIN_ASYNC, "--escritores"] if asincrono else [MAIN, "--workers"]
+    proceso = subprocess.Popen([sys.executable, "-u", *orden, str(workers)],
+                               stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(MAIN))
+    limite = time.monotonic() + ESPERA_ARRANQUE_S
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise SystemExit(f"main.py terminó al arrancar (código {proceso.returncode}), ver {log.name}")
+        with open(log.name, encoding="utf-8", errors="replace") as f:
+            if "Conectado al broker" in f.read():
+                return proceso
+        time.sleep(0.5)
+    proceso.kill()
+    raise SystemExit(f"main.py no se conectó al broker en {ESPERA_ARRANQUE_S} s, ver {log.name}")
+
+
+def publicar(mensajes, dispositivos, prefijo):
+    cliente = mqtt.Client()
+    cliente.username_pw_set(MQTT_USER, MQTT_PASS)
+    cliente.connect(MQTT_BROKER, MQTT_PORT, 60)
+    cliente.loop_start()
+    hora = datetime.now(timezone.utc).strftime("%H:%M:%S")
+    info = None
+    for i in range(mensajes):
+        disp, seq = i % dispositivos, i // dispositivos
+        en_mov = (seq // 10) % 2
+        csv = f"{prefijo}{disp},{hora},{40 + disp * 0.01 + seq * 1e-4:.6f},{-3 - seq * 1e-4:.6f},{seq},1.2,{en_mov}"
+        info = cliente.publish(MQTT_TOPIC, cifrar_csv(csv))
+    if info:
+        info.wait_for_publish()
+    cliente.loop_stop()
+    cliente.disconnect()
+
+
+def contar(cur, prefijo):
+    cur.execute('''
+        SELECT COUNT(*) FROM ubicaciones u JOIN usuarios s ON s.id = u.usuario_id
+        WHERE s.nombre LIKE %s
+    ''', (prefijo + "%",))
+    return cur.fetchone()[0]
+
+
+def desordenados(cur, prefijo):
+    # En orden de inserción (id), la secuencia de cada dispositivo solo crece
+    cur.execute('''
+        SELECT COUNT(*) FILTER (WHERE altitud < anterior) FROM (
+            SELECT u.altitud, lag(u.altitud) OVER (PARTITION BY u.usuario_id ORDER BY u.id) AS anterior
+            FROM ubicaciones u JOIN usuarios s ON s.id = u.usuario_id
+            WHERE s.nombre LIKE %s
+        ) x
+    ''', (prefijo + "%",))
+    return cur.fetchone()[0]
+
+
+def pasada(conn, workers, mensajes, dispositivos, asincrono=False):
+    prefijo = f"bench{int(time.time())}w{workers}_"
+    cpu_antes = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(f"ingesta_{'a' if asincrono else 'w'}{workers}.log", "w") as log:
+        consumidor = arrancar_consumidor(workers, log, asincrono)
+        try:
+            inicio = time.monotonic()
+            publicar(mensajes, dispositivos, prefijo)
+            publicado = time.monotonic() - inicio
+
+            llegadas, ultimo_cambio, fin = 0, time.monotonic(), inicio
+            with conn.cursor() as cur:
+                while llegadas < mensajes and time.monotonic() - ultimo_cambio < ESPERA_SIN_PROGRESO_S:
+                    time.sleep(0.5)
+                    n = contar(cur, prefijo)
+                    conn.rollback()
+                    if n != llegadas:
+                        llegadas, ultimo_cambio = n, time.monotonic()
+                        fin = ultimo_cambio
+                malos = desordenados(cur, prefijo)
+            conn.rollback()
+        finally:
+            consumidor.send_signal(signal.SIGTERM)
+            try:
+                consumidor.wait(60)
+            except subprocess.TimeoutExpired:
+                consumidor.kill()
+    cpu_despues = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (cpu_despues.ru_utime - cpu_antes.ru_utime) + (cpu_despues.ru_stime - cpu_antes.ru_stime)
+    segundos = fin - inicio
+    return {
+        "workers": workers,
+        "publicado_s": round(publicado, 2),
+        "filas": llegadas,
+        "perdidas": mensajes - llegadas,
+        "segundos": round(segundos, 2),
+        "filas_s": round(llegadas / segundos) if segundos > 0 else 0,
+        "desordenados": malos,
+        "cpu_ms_1000": round(cpu * 1e6 / llegadas) if llegadas else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caudal de la ingesta según el número de procesos")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--mensajes", type=int, default=50000)
+    parser.add_argument("--dispositivos", type=int, default=500)
+    parser.add_argument("--async", dest="asincrono", action="store_true",
+                        help="medir ingesta_async.py; --workers pasa a ser el número de escritores")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    resultados = []
+    try:
+        for workers in args.workers:
+            r = pasada(conn, workers, args.mensajes, args.dispositivos, args.asincrono)
+            resultados.append(r)
+            print(f"workers={workers}: {r['filas']} filas en {r['segundos']} s ({r['filas_s']} filas/s), "
+                  f"{r['perdidas']} perdidas, {r['desordenados']} fuera de orden, "
+                  f"{r['cpu_ms_1000']} ms de CPU cada 1000 filas", flush=True)
+    finally:
+        conn.close()
+
+    base = resultados[0]["filas_s"] or 1
+    print(f"\n{'workers':>7} {'filas/s':>9} {'x':>6} {'perdidas':>9} {'desorden':>9} {'cpu ms/1k':>10}")
+    for r in resultados:
+        print(f"{r['workers']:>7} {r['filas_s']:>9} {r['filas_s'] / base:>6.2f} {r['perdidas']:>9} {r['desordenados']:>9} "
+              f"{r['cpu_ms_1000']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# Prueba de carga de /stream (posición en directo por Server-Sent Events).
+#
+#   python bench_sse.py --usuarios 50 --suscriptores 100 1000 5000 --pid $(pgrep -f uvicorn)
+#
+# Para cada número de suscriptores abre esas conexiones a /stream repartidas
+# entre --usuarios usuarios simulados (varias apps por usuario, como una
+# familia mirando la misma autocaravana) y, con todas conectadas, actualiza
+# el estado de cada usuario cada --intervalo s escribiendo directamente en
+# estado_dispositivo, igual que el consumidor (upsert + NOTIFY). Se mide:
+#   - commit del estado -> evento recibido por cada suscriptor (por el id SSE)
+#   - eventos perdidos: los que no llegaron antes del final de la pasada
+#   - memoria residente de la API (VmRSS, con --pid) por conexión abierta
+# La API tiene que estar arrancada contra la misma BD. Solo contra una BD de
+# pruebas: da de alta los usuarios simulados como datasimulation.py.
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import psycopg2
+
+from carga_api import obtener_token, percentil
+from datasimulation import API_URL, CONTRASEÑA_SIMULADOS, POSTGRES_CONFIG, dar_de_alta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from estado_reciente import ESTADO_MOVIMIENTO, guardar_estados
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for linea in f:
+            if linea.startswith("VmRSS:"):
+                return int(linea.split()[1])
+    return None
+
+
+def subir_limite_ficheros(n):
+    blando, duro = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if blando < n:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(n, duro), duro))
+
+
+class Suscriptor:
+    def __init__(self, usuario_id):
+        self.usuario_id = usuario_id
+        # id SSE -> time.time() de llegada
+        self.recibidos = {}
+        self.conectado = asyncio.Event()
+        self.error = None
+
+
+async def escuchar(suscriptor, url, token):
+    partes = urlsplit(url)
+    try:
+        lector, escritor = await asyncio.open_connection(partes.hostname, partes.port or 80)
+        escritor.write((f"GET /stream HTTP/1.1\r\nHost: {partes.netloc}\r\n"
+                        f"Authorization: Bearer {token}\r\nAccept: text/event-stream\r\n\r\n").encode())
+        await escritor.drain()
+        estado = await lector.readline()
+        if b" 200 " not in estado:
+            suscriptor.error = estado.decode().strip()
+            suscriptor.conectado.set()
+            escritor.close()
+            return
+        # Cada evento llega en su propio trozo del chunked: basta con leer líneas
+        while True:
+            linea = await lector.readline()
+            if not linea:
+                break
+            if linea.startswith(b"retry:"):
+                suscriptor.conectado.set()
+            elif linea.startswith(b"id: "):
+                suscriptor.recibidos[linea[4:].strip().decode()] = time.time()
+    except (OSError, asyncio.IncompleteReadError) as e:
+        suscriptor.error = str(e)
+        suscriptor.conectado.set()
+
+
+def actualizar(conn, usuario_ids, enviados):
+    """Un fix nuevo para cada usuario en una transacción; apunta id SSE -> momento del commit."""
+    recibido_en = datetime.now(timezone.utc)
+    filas = [(u, recibido_en.strftime("%H:%M:%S"), 40.4, -3.7, 650.0, 1.0, 1, recibido_en,
+              ESTADO_MOVIMIENTO, recibido_en) for u in usuario_ids]
+    with conn.cursor() as cur:
+        guardar_estados(cur, filas)
+    conn.commit()
+    enviados[f"{recibido_en.timestamp():.6f}"] = time.time()
+
+
+async def pasada(url, tokens, conn, n, intervalo_s, duracion_s, pid):
+    usuario_ids = list(tokens)
+    rss_antes = rss_kb(pid) if pid else None
+    suscriptores = [Suscriptor(usuario_ids[i % len(usuario_ids)]) for i in range(n)]
+    tareas = []
+    inicio = time.monotonic()
+    for s in suscriptores:
+        tareas.append(asyncio.create_task(escuchar(s, url, tokens[s.usuario_id])))
+        if len(tareas) % 200 == 0:
+            # Sin ráfagas de miles de SYN contra el backlog del listen
+            await asyncio.sleep(0.05)
+    await asyncio.wait_for(asyncio.gather(*(s.conectado.wait() for s in suscriptores)), 120)
+    conexion_s = time.monotonic() - inicio
+    conectados = sum(1 for s in suscriptores if s.error is None)
+    rss_conectados = rss_kb(pid) if pid else None
+
+    enviados = {}
+    fin = time.monotonic() + duracion_s
+    while time.monotonic() < fin:
+        siguiente = time.monotonic() + intervalo_s
+        await asyncio.to_thread(actualizar, conn, usuario_ids, enviados)
+        await asyncio.sleep(max(siguiente - time.monotonic(), 0))
+    # Margen para los últimos eventos
+    await asyncio.sleep(min(intervalo_s, 2))
+
+    latencias = []
+    perdidos = 0
+    for s in suscriptores:
+        if s.error is not None:
+            continue
+        for id_sse, momento in enviados.items():
+            llegada = s.recibidos.get(id_sse)
+            if llegada is None:
+                perdidos += 1
+            else:
+                latencias.append((llegada - momento) * 1000)
+    for t in tareas:
+        t.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
+
+    errores = {}
+    for s in suscriptores:
+        if s.error is not None:
+            errores[s.error] = errores.get(s.error, 0) + 1
+    latencias.sort()
+    informe = {
+        "suscriptores": n,
+        "conectados": conectados,
+        "errores": errores,
+        "conexion_s": round(conexion_s, 2),
+        "actualizaciones": len(enviados),
+        "eventos_esperados": len(enviados) * conectados,
+        "eventos_perdidos": perdidos,
+        "latencia_ms": {
+            "p50": round(percentil(latencias, 50), 1) if latencias else None,
+            "p99": round(percentil(latencias, 99), 1) if latencias else None,
+            "max": round(latencias[-1], 1) if latencias else None,
+        },
+    }
+    if pid:
+        informe["rss_api_kb"] = {"antes": rss_antes, "conectados": rss_conectados}
+        if conectados:
+            informe["kb_por_conexion"] = round((rss_conectados - rss_antes) / conectados, 1)
+    return informe
+
+
+async def ejecutar(url, tokens, valores, intervalo_s, duracion_s, pid):
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        informes = []
+        for n in valores:
+            informe = await pasada(url, tokens, conn, n, intervalo_s, duracion_s, pid)
+            print(json.dumps(informe, ensure_ascii=False), flush=True)
+            informes.append(informe)
+            # Que la API cierre las conexiones anteriores antes de la siguiente pasada
+            await asyncio.sleep(2)
+        return informes
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga de /stream (SSE)")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--suscriptores", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--intervalo", type=float, default=1.0, help="s entre actualizaciones de cada usuario")
+    parser.add_argument("--duracion", type=float, default=20)
+    parser.add_argument("--pid", type=int, help="proceso de la API, para medir su memoria")
+    parser.add_argument("--salida", help="guardar el informe JSON en este fichero")
+    args = parser.parse_args()
+
+    subir_limite_ficheros(max(args.suscriptores) + 256)
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    ids = dar_de_alta(conn, [f"sse_{i:04d}" for i in range(args.usuarios)])
+    conn.close()
+    tokens = {u: obtener_token(args.url, nombre, CONTRASEÑA_SIMULADOS) for u, nombre in ids.items()}
+
+    informes = asyncio.run(ejecutar(args.url, tokens, args.suscriptores, args.intervalo, args.duracion, args.pid))
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump({"usuarios": args.usuarios, "intervalo_s": args.intervalo, "pasadas": informes},
+                      f, indent=2, ensure_ascii=False)
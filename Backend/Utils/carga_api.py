@@ -0,0 +1,115 @@
+# Prueba de carga de la API: simula N apps haciendo polling concurrente de
+# /ubicacion_actual y /estado_actual y mide latencias por endpoint.
+#
+#   python carga_api.py --concurrencia 50 --duracion 30 --salida despues.json
+#   python carga_api.py --comparar antes.json despues.json
+import argparse
+import json
+import threading
+import time
+
+import requests
+
+API_URL = "http://IP_SERVER:PUERTO"
+USUARIO = "USER"
+CONTRASEÑA = "PASSWD"
+
+ENDPOINTS = ["/ubicacion_actual", "/estado_actual"]
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    k = (len(valores_ordenados) - 1) * (p / 100)
+    f = int(k)
+    c = min(f + 1, len(valores_ordenados) - 1)
+    return valores_ordenados[f] * (c - k) + valores_ordenados[c] * (k - f) if f != c else valores_ordenados[f]
+
+
+def obtener_token(api_url, usuario, contraseña):
+    r = requests.post(f"{api_url}/token", data={"nombre": usuario, "contraseña": contraseña}, timeout=30)
+    r.raise_for_status()
+    return r.json()["access_token"]
+
+
+def cliente(api_url, token, endpoints, fin, resultados, lock):
+    # Cada cliente simula una app: su propia sesión keep-alive, endpoints en bucle
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    propios = {ep: [] for ep in endpoints}
+    errores = {ep: 0 for ep in endpoints}
+    i = 0
+    while time.monotonic() < fin:
+        ep = endpoints[i % len(endpoints)]
+        i += 1
+        inicio = time.perf_counter()
+        try:
+            r = session.get(f"{api_url}{ep}", timeout=30)
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        ms = (time.perf_counter() - inicio) * 1000
+        if ok:
+            propios[ep].append(ms)
+        else:
+            errores[ep] += 1
+
+    with lock:
+        for ep in endpoints:
+            resultados[ep]["latencias"].extend(propios[ep])
+            resultados[ep]["errores"] += errores[ep]
+
+
+def ejecutar(api_url, token, concurrencia, duracion_s, endpoints=ENDPOINTS):
+    resultados = {ep: {"latencias": [], "errores": 0} for ep in endpoints}
+    lock = threading.Lock()
+    fin = time.monotonic() + duracion_s
+    hilos = [threading.Thread(target=cliente, args=(api_url, token, endpoints, fin, resultados, lock))
+             for _ in range(concurrencia)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+
+    informe = {"concurrencia": concurrencia, "duracion_s": duracion_s, "endpoints": {}}
+    for ep, datos in resultados.items():
+        lat = sorted(datos["latencias"])
+        informe["endpoints"][ep] = {
+            "peticiones": len(lat),
+            "errores": datos["errores"],
+            "rps": round(len(lat) / duracion_s, 1),
+            "p50_ms": round(percentil(lat, 50), 2) if lat else None,
+            "p95_ms": round(percentil(lat, 95), 2) if lat else None,
+            "p99_ms": round(percentil(lat, 99), 2) if lat else None,
+        }
+    return informe
+
+
+def comparar(antes, despues):
+    print(f"{'endpoint':<22}{'p50 antes':>11}{'p50 después':>13}{'p99 antes':>11}{'p99 después':>13}{'rps antes':>11}{'rps después':>13}")
+    for ep, d in despues["endpoints"].items():
+        a = antes["endpoints"].get(ep, {})
+        print(f"{ep:<22}{a.get('p50_ms')!s:>11}{d['p50_ms']!s:>13}{a.get('p99_ms')!s:>11}{d['p99_ms']!s:>13}"
+              f"{a.get('rps')!s:>11}{d['rps']!s:>13}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga de los endpoints de polling")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--concurrencia", type=int, default=20)
+    parser.add_argument("--duracion", type=float, default=30)
+    parser.add_argument("--endpoint", action="append", help="repetible; por defecto los de polling")
+    parser.add_argument("--salida", help="guardar el informe JSON en este fichero")
+    parser.add_argument("--comparar", nargs=2, metavar=("ANTES", "DESPUES"))
+    args = parser.parse_args()
+
+    if args.comparar:
+        with open(args.comparar[0]) as fa, open(args.comparar[1]) as fd:
+            comparar(json.load(fa), json.load(fd))
+    else:
+        token = obtener_token(args.url, USUARIO, CONTRASEÑA)
+        informe = ejecutar(args.url, token, args.concurrencia, args.duracion, args.endpoint or ENDPOINTS)
+        print(json.dumps(informe, indent=2, ensure_ascii=False))
+        if args.salida:
+            with open(args.salida, "w") as f:
+                json.dump(informe, f, indent=2, ensure_ascii=False)
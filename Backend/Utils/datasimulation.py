@@ -1,7 +1,40 @@
+# Simulador de dispositivos y prueba de extremo a extremo (MQTT -> ubicaciones -> API).
+#
+#   python datasimulation.py --demo      # los tres puntos de "Nomada", 20 s entre ellos
+#   python datasimulation.py --dispositivos 500 --intervalo 15 --duracion 120 --salida base.json
+#   python datasimulation.py --comparar base.json nuevo.json
+#
+# Cada dispositivo alterna paradas y trayectos (rumbo y velocidad con deriva
+# aleatoria), con ruido de posición proporcional a un hdop que a veces se
+# dispara, y falsos positivos del sensor de movimiento estando parado. Publica
+# cada --intervalo s en el formato cifrado del ESP32 (como los reales, nunca
+# más de uno por segundo). Se mide:
+#   - publicación -> recibido_en (lo que tarda en llegar al consumidor)
+#   - publicación -> fila visible en ubicaciones (sondeando la BD)
+#   - publicación -> visible en /ubicacion_actual (en --sondas dispositivos)
+#   - filas/s ingeridas y p50/p99 de las peticiones a la API
+# Un fix se identifica por (dispositivo, hora_utc). El consumidor (../main.py
+# o ../ingesta_async.py) y la API tienen que estar ya arrancados contra el
+# mismo broker y la misma BD. Solo contra una BD de pruebas: da de alta un
+# usuario por dispositivo simulado.
+import argparse
 import base64
+import heapq
+import json
+import math
+import random
+import threading
 import time
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timezone
+
 import paho.mqtt.client as mqtt
+import psycopg2
+import requests
+from passlib.hash import bcrypt
+from psycopg2.extras import execute_values
+
+from carga_api import obtener_token, percentil
 
 MQTT_BROKER = "IPSERVER"
 MQTT_PORT = PORT
@@ -11,18 +44,345 @@ MQTT_PASS = "PASSWD"
 
 CLAVE_XOR = "CLAVE"
 
+API_URL = "http://IP_SERVER:PUERTO"
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+# Contraseña de los dispositivos simulados (para entrar en la API con las sondas)
+CONTRASEÑA_SIMULADOS = "simulado"
+
+# Modelo de movimiento
+DURACION_TRAYECTO_S = 600      # media
+DURACION_PARADA_S = 900        # media
+VELOCIDAD_MAX_MS = 33.0        # ~120 km/h
+PROB_HDOP_MALO = 0.03          # fixes con hdop >= 5.5 (ver movimiento.HDOP_MAX)
+PROB_FALSO_MOVIMIENTO = 0.02   # en_mov = 1 estando parado
+PROB_MOVIMIENTO_PERDIDO = 0.05 # en_mov = 0 en marcha
+METROS_POR_HDOP = 2.5          # desviación del ruido de posición
+
+SONDEO_BD_S = 0.25
+SONDEO_API_S = 0.2
+# Ids de ubicaciones que se vuelven a mirar: con varios escritores una
+# transacción puede confirmar ids más bajos que otra que ya se vio
+MARGEN_IDS_S = 3
+# Sin filas nuevas durante este tiempo se da la pasada por terminada
+ESPERA_SIN_PROGRESO_S = 10
+
+
 def cifrar_csv(csv, clave=CLAVE_XOR):
     cifrado = ''.join(chr(ord(c) ^ ord(clave[i % len(clave)])) for i, c in enumerate(csv))
     return base64.b64encode(cifrado.encode()).decode()
 
-def generar_csv(nombre, lat, lon):
-    hora_utc = datetime.utcnow().strftime("%H:%M:%S")
-    alt = 100.0  # valor ficticio
-    hdop = 1.2   # valor válido
-    en_mov = 1   # movimiento detectado
+def generar_csv(nombre, lat, lon, alt=100.0, hdop=1.2, en_mov=1, hora_utc=None):
+    hora_utc = hora_utc or datetime.now(timezone.utc).strftime("%H:%M:%S")
     return f"{nombre},{hora_utc},{lat},{lon},{alt},{hdop},{en_mov}"
 
-if __name__ == "__main__":
+
+# =======================
+# SIMULACIÓN
+# =======================
+class DispositivoSimulado:
+    def __init__(self, nombre, rng):
+        self.nombre = nombre
+        self.rng = rng
+        # En algún sitio de la península
+        self.lat = rng.uniform(37.0, 43.0)
+        self.lon = rng.uniform(-8.0, 1.0)
+        self.alt = rng.uniform(0, 900)
+        self.rumbo = rng.uniform(0, 360)
+        self.velocidad = 0.0
+        self.en_marcha = rng.random() < DURACION_TRAYECTO_S / (DURACION_TRAYECTO_S + DURACION_PARADA_S)
+        self.hdop_base = rng.uniform(0.7, 1.6)
+
+    def avanzar(self, dt):
+        # Paradas y trayectos de duración exponencial
+        media = DURACION_TRAYECTO_S if self.en_marcha else DURACION_PARADA_S
+        if self.rng.random() < dt / media:
+            self.en_marcha = not self.en_marcha
+        if not self.en_marcha:
+            self.velocidad = 0.0
+            return
+        self.velocidad = min(max(self.velocidad + self.rng.gauss(2.0, 3.0) * dt / 10, 0.0), VELOCIDAD_MAX_MS)
+        self.rumbo = (self.rumbo + self.rng.gauss(0, 10) * math.sqrt(dt)) % 360
+        metros = self.velocidad * dt
+        self.lat += metros * math.cos(math.radians(self.rumbo)) / 111320
+        self.lon += metros * math.sin(math.radians(self.rumbo)) / (111320 * math.cos(math.radians(self.lat)))
+        self.alt = max(self.alt + self.rng.gauss(0, 0.5) * metros / 100, 0.0)
+
+    def fix(self, hora_utc):
+        if self.rng.random() < PROB_HDOP_MALO:
+            hdop = self.rng.uniform(5.5, 20.0)
+        else:
+            hdop = self.hdop_base * self.rng.lognormvariate(0, 0.25)
+        ruido = hdop * METROS_POR_HDOP
+        lat = self.lat + self.rng.gauss(0, ruido) / 111320
+        lon = self.lon + self.rng.gauss(0, ruido) / (111320 * math.cos(math.radians(self.lat)))
+        if self.en_marcha:
+            en_mov = 0 if self.rng.random() < PROB_MOVIMIENTO_PERDIDO else 1
+        else:
+            en_mov = 1 if self.rng.random() < PROB_FALSO_MOVIMIENTO else 0
+        return generar_csv(self.nombre, f"{lat:.6f}", f"{lon:.6f}",
+                           round(self.alt + self.rng.gauss(0, hdop * 4), 1), round(hdop, 2), en_mov, hora_utc)
+
+
+# =======================
+# MEDICIÓN
+# =======================
+class Medicion:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.publicados = {}       # (nombre, hora_utc) -> momento de publicación
+        self.repetidos = set()     # dos fixes en el mismo segundo: no se sabe cuál es cuál
+        self.filas = 0
+        self.ultima_fila = None
+        self.recepcion_ms = []
+        self.fila_ms = []
+        self.api_ms = []
+        self.peticiones_ms = []
+        self.errores_api = 0
+
+    def publicado(self, nombre, hora_utc, momento):
+        with self.lock:
+            clave = (nombre, hora_utc)
+            if clave in self.publicados:
+                self.repetidos.add(clave)
+            self.publicados[clave] = momento
+
+    def fila(self, nombre, hora_utc, recibido_en, momento):
+        clave = (nombre, hora_utc)
+        with self.lock:
+            publicado = self.publicados.get(clave)
+            if publicado is None:
+                return
+            self.filas += 1
+            self.ultima_fila = momento
+            if clave not in self.repetidos:
+                self.recepcion_ms.append((recibido_en - publicado) * 1000)
+                self.fila_ms.append((momento - publicado) * 1000)
+
+    def visible_api(self, nombre, hora_utc, momento):
+        clave = (nombre, hora_utc)
+        with self.lock:
+            publicado = self.publicados.get(clave)
+            if publicado is not None and clave not in self.repetidos:
+                self.api_ms.append((momento - publicado) * 1000)
+
+    def peticion(self, ms):
+        with self.lock:
+            if ms is None:
+                self.errores_api += 1
+            else:
+                self.peticiones_ms.append(ms)
+
+
+def resumen_latencias(valores):
+    valores = sorted(valores)
+    if not valores:
+        return {"n": 0}
+    return {
+        "n": len(valores),
+        "p50_ms": round(percentil(valores, 50), 1),
+        "p95_ms": round(percentil(valores, 95), 1),
+        "p99_ms": round(percentil(valores, 99), 1),
+        "max_ms": round(valores[-1], 1),
+    }
+
+
+# =======================
+# PASADA
+# =======================
+def dar_de_alta(conn, nombres):
+    # Todos con la misma contraseña: un solo hash de bcrypt para toda la flota
+    contraseña = bcrypt.hash(CONTRASEÑA_SIMULADOS)
+    with conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO usuarios (nombre, contraseña, correo) VALUES %s ON CONFLICT (nombre) DO NOTHING",
+                       [(n, contraseña, "sin@email.com") for n in nombres])
+        cur.execute("SELECT id, nombre FROM usuarios WHERE nombre = ANY(%s)", (nombres,))
+        ids = dict(cur.fetchall())
+    conn.commit()
+    return ids
+
+
+def publicar(dispositivos, intervalo_s, duracion_s, medicion, rng):
+    cliente = mqtt.Client()
+    cliente.username_pw_set(MQTT_USER, MQTT_PASS)
+    cliente.connect(MQTT_BROKER, MQTT_PORT, 60)
+    cliente.loop_start()
+
+    inicio = time.time()
+    fin = inicio + duracion_s
+    # Cada dispositivo empieza en un punto distinto del primer intervalo
+    agenda = [(inicio + intervalo_s * i / len(dispositivos), i) for i in range(len(dispositivos))]
+    heapq.heapify(agenda)
+    anterior = {}
+    retraso_max = 0.0
+    info = None
+    while agenda[0][0] < fin:
+        cuando, i = heapq.heappop(agenda)
+        espera = cuando - time.time()
+        if espera > 0:
+            time.sleep(espera)
+        else:
+            retraso_max = max(retraso_max, -espera)
+        ahora = time.time()
+        d = dispositivos[i]
+        d.avanzar(ahora - anterior.get(i, ahora))
+        anterior[i] = ahora
+        hora_utc = datetime.fromtimestamp(ahora, timezone.utc).strftime("%H:%M:%S")
+        # Se anota antes de publicar: la fila puede aparecer antes de volver de publish()
+        medicion.publicado(d.nombre, hora_utc, ahora)
+        info = cliente.publish(MQTT_TOPIC, cifrar_csv(d.fix(hora_utc)))
+        # Intervalo con algo de ruido, pero nunca dos fixes en el mismo segundo
+        heapq.heappush(agenda, (max(cuando + rng.gauss(intervalo_s, intervalo_s * 0.02), ahora + 1), i))
+    if info:
+        info.wait_for_publish()
+    cliente.loop_stop()
+    cliente.disconnect()
+    return inicio, time.time(), retraso_max
+
+
+def sondear_bd(conn, ids, desde, medicion, parar):
+    # Se sigue ubicaciones por id. Con varios escritores una transacción puede
+    # confirmar ids más bajos que otra que ya se vio, así que se vuelve a mirar
+    # desde el id máximo de hace MARGEN_IDS_S, descartando los ya vistos.
+    corte, maximo = 0, 0
+    marcas = deque()
+    vistos = set()
+    with conn.cursor() as cur:
+        while not parar.is_set():
+            cur.execute('''
+                SELECT id, usuario_id, hora_utc::text, recibido_en FROM ubicaciones
+                WHERE id > %s AND recibido_en >= %s
+            ''', (corte, desde))
+            filas = cur.fetchall()
+            conn.rollback()
+            ahora = time.time()
+            for id_, usuario_id, hora_utc, recibido_en in filas:
+                maximo = max(maximo, id_)
+                if id_ in vistos or usuario_id not in ids:
+                    continue
+                vistos.add(id_)
+                medicion.fila(ids[usuario_id], hora_utc, recibido_en.timestamp(), ahora)
+            marcas.append((ahora, maximo))
+            while ahora - marcas[0][0] > MARGEN_IDS_S:
+                corte = marcas.popleft()[1]
+            vistos = {i for i in vistos if i > corte}
+            parar.wait(SONDEO_BD_S)
+
+
+def sondear_api(api_url, nombre, medicion, parar):
+    # Como la app: /ubicacion_actual en bucle, anotando cuándo cambia el fix
+    try:
+        token = obtener_token(api_url, nombre, CONTRASEÑA_SIMULADOS)
+    except requests.RequestException as e:
+        print(f"La sonda {nombre} no pudo entrar en la API: {e}", flush=True)
+        medicion.peticion(None)
+        return
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    ultima = None
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        try:
+            r = session.get(f"{api_url}/ubicacion_actual", timeout=30)
+        except requests.RequestException:
+            medicion.peticion(None)
+            parar.wait(SONDEO_API_S)
+            continue
+        ahora = time.time()
+        # 404 es "todavía sin ubicación", una respuesta normal
+        medicion.peticion((time.perf_counter() - inicio) * 1000 if r.status_code in (200, 404) else None)
+        if r.status_code == 200:
+            hora_utc = r.json()["hora_utc"]
+            if hora_utc != ultima:
+                ultima = hora_utc
+                medicion.visible_api(nombre, hora_utc, ahora)
+        parar.wait(SONDEO_API_S)
+
+
+def pasada(conn, args):
+    rng = random.Random(args.semilla)
+    prefijo = f"sim{int(time.time())}_"
+    nombres = [f"{prefijo}{i}" for i in range(args.dispositivos)]
+    ids = dar_de_alta(conn, nombres)
+    dispositivos = [DispositivoSimulado(n, rng) for n in nombres]
+    intervalo_s = args.dispositivos / args.ritmo if args.ritmo else args.intervalo
+    if intervalo_s < 1:
+        raise SystemExit(f"{args.dispositivos} dispositivos no pueden publicar a más de {args.dispositivos} msg/s")
+
+    medicion = Medicion()
+    parar = threading.Event()
+    desde = datetime.now(timezone.utc)
+    hilos = [threading.Thread(target=sondear_bd, args=(conn, ids, desde, medicion, parar), daemon=True)]
+    hilos += [threading.Thread(target=sondear_api, args=(args.url, n, medicion, parar), daemon=True)
+              for n in nombres[:args.sondas]]
+    for h in hilos:
+        h.start()
+
+    print(f"Publicando {args.dispositivos} dispositivos cada {intervalo_s:.2f} s durante {args.duracion} s "
+          f"({args.dispositivos / intervalo_s:.1f} msg/s)...", flush=True)
+    inicio, fin_publicacion, retraso_max = publicar(dispositivos, intervalo_s, args.duracion, medicion, rng)
+    publicados = len(medicion.publicados)
+
+    # Esperar a que llegue todo (o a que deje de llegar)
+    filas, ultimo_cambio = -1, time.time()
+    while medicion.filas < publicados and time.time() - ultimo_cambio < ESPERA_SIN_PROGRESO_S:
+        if medicion.filas != filas:
+            filas, ultimo_cambio = medicion.filas, time.time()
+        time.sleep(0.5)
+    parar.set()
+    for h in hilos:
+        h.join()
+
+    segundos_ingesta = (medicion.ultima_fila or inicio) - inicio
+    peticiones = sorted(medicion.peticiones_ms)
+    return {
+        "dispositivos": args.dispositivos,
+        "intervalo_s": round(intervalo_s, 3),
+        "duracion_s": args.duracion,
+        "sondas": min(args.sondas, args.dispositivos),
+        "publicados": publicados,
+        "publicados_s": round(publicados / (fin_publicacion - inicio), 1),
+        "retraso_publicacion_max_ms": round(retraso_max * 1000, 1),
+        "filas": medicion.filas,
+        "perdidas": publicados - medicion.filas,
+        "ingesta_filas_s": round(medicion.filas / segundos_ingesta, 1) if segundos_ingesta > 0 else 0,
+        "latencia_recepcion": resumen_latencias(medicion.recepcion_ms),
+        "latencia_fila": resumen_latencias(medicion.fila_ms),
+        "latencia_api": resumen_latencias(medicion.api_ms),
+        "api": {
+            "peticiones": len(peticiones),
+            "errores": medicion.errores_api,
+            "p50_ms": round(percentil(peticiones, 50), 2) if peticiones else None,
+            "p99_ms": round(percentil(peticiones, 99), 2) if peticiones else None,
+        },
+    }
+
+
+def comparar(antes, despues):
+    filas = [
+        ("publicados/s", lambda r: r["publicados_s"]),
+        ("ingesta filas/s", lambda r: r["ingesta_filas_s"]),
+        ("perdidas", lambda r: r["perdidas"]),
+        ("fila p50 ms", lambda r: r["latencia_fila"].get("p50_ms")),
+        ("fila p99 ms", lambda r: r["latencia_fila"].get("p99_ms")),
+        ("api visible p50 ms", lambda r: r["latencia_api"].get("p50_ms")),
+        ("api visible p99 ms", lambda r: r["latencia_api"].get("p99_ms")),
+        ("petición p50 ms", lambda r: r["api"]["p50_ms"]),
+        ("petición p99 ms", lambda r: r["api"]["p99_ms"]),
+    ]
+    print(f"{'':<20}{'antes':>12}{'después':>12}")
+    for nombre, valor in filas:
+        print(f"{nombre:<20}{valor(antes)!s:>12}{valor(despues)!s:>12}")
+
+
+def demo():
     client = mqtt.Client()
     client.username_pw_set(MQTT_USER, MQTT_PASS)
     print(f"Conectando a {MQTT_BROKER}:{MQTT_PORT} como {MQTT_USER}...")
@@ -31,9 +391,9 @@ if __name__ == "__main__":
 
     nombre_usuario = "Nomada"
     ubicaciones = [
-        (40.4168, -3.7038), 
-        (40.4170, -3.7036),  
-        (40.4172, -3.7034), 
+        (40.4168, -3.7038),
+        (40.4170, -3.7036),
+        (40.4172, -3.7034),
     ]
 
     for i, (lat, lon) in enumerate(ubicaciones):
@@ -42,8 +402,39 @@ if __name__ == "__main__":
         client.publish(MQTT_TOPIC, cifrado_b64)
         print(f"Enviado registro {i+1}: {csv}")
         if i < len(ubicaciones) - 1:
-            time.sleep(20)  
+            time.sleep(20)
 
     client.loop_stop()
     client.disconnect()
     print("Script finalizado.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulador de dispositivos y prueba de extremo a extremo")
+    parser.add_argument("--demo", action="store_true", help="solo publicar los tres puntos de prueba")
+    parser.add_argument("--dispositivos", type=int, default=200)
+    parser.add_argument("--intervalo", type=float, default=15, help="segundos entre fixes de un dispositivo")
+    parser.add_argument("--ritmo", type=float, help="msg/s en total; fija el intervalo a dispositivos/ritmo")
+    parser.add_argument("--duracion", type=float, default=60)
+    parser.add_argument("--sondas", type=int, default=10, help="dispositivos seguidos también por la API")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--semilla", type=int)
+    parser.add_argument("--salida", help="guardar el informe JSON en este fichero")
+    parser.add_argument("--comparar", nargs=2, metavar=("ANTES", "DESPUES"))
+    args = parser.parse_args()
+
+    if args.demo:
+        demo()
+    elif args.comparar:
+        with open(args.comparar[0]) as fa, open(args.comparar[1]) as fd:
+            comparar(json.load(fa), json.load(fd))
+    else:
+        conn = psycopg2.connect(**POSTGRES_CONFIG)
+        try:
+            informe = pasada(conn, args)
+        finally:
+            conn.close()
+        print(json.dumps(informe, indent=2, ensure_ascii=False))
+        if args.salida:
+            with open(args.salida, "w") as f:
+                json.dump(informe, f, indent=2, ensure_ascii=False)
@@ -1,90 +1,86 @@
+# Desfase del reloj (recibido_en - hora_utc) e intervalo entre fixes, por
+# dispositivo y de toda la flota. Los calcula la ingesta sobre la última
+# ventana (ver tiempos.py) y aquí solo se leen: sin recorrer ubicaciones.
+#
+#   python desviacion_temporal.py                   # flota y los 20 peores en desfase
+#   python desviacion_temporal.py --orden intervalo --limite 50
+#   python desviacion_temporal.py --dispositivo camper_0042
+import argparse
+import os
+import sys
+
 import psycopg2
-from statistics import mean, pstdev
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tiempos import COLUMNAS_RESUMEN, VENTANA_S, leer_flota
 
 POSTGRES_CONFIG = {
     "host": "IPHOST",
     "port": PUERTO,
     "user": "USERNAME",
-    "password": "PASSWORD", 
+    "password": "PASSWORD",
     "database": "DBNAME"
 }
 
-TABLE_NAME = "ubicaciones"
+# Lo que más se aleja de 0 en cualquier sentido: retraso del módem o reloj adelantado
+ORDEN = {
+    "desfase": "GREATEST(ABS(t.p50_desfase), ABS(t.p95_desfase)) DESC NULLS LAST",
+    "intervalo": "t.p95_intervalo DESC NULLS LAST",
+}
 
-QUERY = f"""
-WITH last1000 AS (
-  SELECT
-    id,
-    hora_utc,
-    recibido_en,
-    (EXTRACT(MINUTE FROM recibido_en)::int * 60 +
-     EXTRACT(SECOND FROM recibido_en)::int) AS rec_mmss_s,
-    (EXTRACT(MINUTE FROM CAST(hora_utc AS time))::int * 60 +
-     EXTRACT(SECOND FROM CAST(hora_utc AS time))::int) AS utc_mmss_s
-  FROM {TABLE_NAME}
-  ORDER BY id DESC
-  LIMIT 400
-)
-SELECT
-  id,
-  hora_utc,
-  recibido_en,
-  (utc_mmss_s - rec_mmss_s) AS diff_raw_s,
-  (((utc_mmss_s - rec_mmss_s + 1800) % 3600) - 1800) AS diff_circular_s
-FROM last1000
-ORDER BY id DESC;
-"""
 
-def percentile(sorted_vals, p):
-    if not sorted_vals:
-        return None
-    k = (len(sorted_vals) - 1) * (p / 100)
-    f = int(k)
-    c = min(f + 1, len(sorted_vals) - 1)
-    if f == c:
-        return float(sorted_vals[f])
-    return float(sorted_vals[f]) * (c - k) + float(sorted_vals[c]) * (k - f)
+def imprimir(nombre, resumen, ultimo_fix):
+    datos = dict(zip(COLUMNAS_RESUMEN, resumen))
+    print(f"--- {nombre} (último fix: {f'{ultimo_fix:%Y-%m-%d %H:%M:%S}' if ultimo_fix else '-'}) ---")
+    for magnitud, titulo in (("desfase", "Desfase (s)"), ("intervalo", "Intervalo (s)")):
+        if not datos[f"n_{magnitud}"]:
+            print(f"{titulo:14}: sin datos")
+            continue
+        print(f"{titulo:14}: N {datos[f'n_{magnitud}']}  media {datos[f'media_{magnitud}']:.3f}  "
+              f"std {datos[f'desviacion_{magnitud}']:.3f}  "
+              f"P50 {datos[f'p50_{magnitud}']:.2f}  P95 {datos[f'p95_{magnitud}']:.2f}")
+    print()
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Desfase del reloj e intervalo entre fixes de los dispositivos")
+    parser.add_argument("--dispositivo", help="solo este dispositivo (nombre de usuario)")
+    parser.add_argument("--orden", choices=sorted(ORDEN), default="desfase")
+    parser.add_argument("--limite", type=int, default=20, help="dispositivos a listar")
+    args = parser.parse_args()
+
     conn = psycopg2.connect(**POSTGRES_CONFIG)
     try:
         with conn.cursor() as cur:
-            cur.execute(QUERY)
-            rows = cur.fetchall()
-            colnames = [d[0] for d in cur.description]
-
-        data = [dict(zip(colnames, r)) for r in rows]
-
-        diffs_raw = [d["diff_raw_s"] for d in data]
-        diffs_circ = [d["diff_circular_s"] for d in data]
-
-        diffs_raw_sorted = sorted(diffs_raw)
-        diffs_circ_sorted = sorted(diffs_circ)
-
-        print("\n=== DESVIACIÓN TEMPORAL (ignorando horas, usando mm:ss) ===\n")
-        print("Definiciones:")
-        print("- diff_raw_s      = (mm:ss recibido_en) - (mm:ss hora_utc)")
-        print("- diff_circular_s = igual, ajustado a [-1800, +1800] para evitar saltos al cruzar la hora\n")
-
-        def print_stats(name, vals, vals_sorted):
-            print(f"--- {name} ---")
-            print(f"N            : {len(vals)}")
-            print(f"Media (s)    : {mean(vals):.3f}")
-            print(f"StdDev (s)   : {pstdev(vals):.3f}")
-            print(f"Min / Max (s): {min(vals)} / {max(vals)}")
-            print(f"P50 (s)      : {percentile(vals_sorted, 50):.2f}")
-            print(f"P95 (s)      : {percentile(vals_sorted, 95):.2f}")
-            print()
+            print(f"\n=== DESVIACIÓN TEMPORAL (últimas {VENTANA_S // 3600} h como mucho) ===\n")
+            print("- desfase   = recibido_en - hora_utc, como hora del día UTC en [-12 h, +12 h)")
+            print("- intervalo = recibido_en - recibido_en del fix anterior del mismo dispositivo\n")
 
-        print_stats("Desviación RAW", diffs_raw, diffs_raw_sorted)
-        print_stats("Desviación CIRCULAR", diffs_circ, diffs_circ_sorted)
+            flota = leer_flota(cur)
+            if flota is None:
+                print("La ingesta todavía no ha guardado tiempos de la flota.\n")
+            elif not args.dispositivo:
+                imprimir("Flota", *flota)
 
-        print("Ejemplos (primeros 10 por id DESC):")
-        print("id | hora_utc | recibido_en | diff_raw_s | diff_circular_s")
-        for d in data[:10]:
-            print(f'{d["id"]} | {d["hora_utc"]} | {d["recibido_en"]} | {d["diff_raw_s"]:>10} | {d["diff_circular_s"]:>15}')
+            # Los que llevan más de la ventana sin emitir conservan el resumen
+            # de entonces: fuera, como hace leer_flota
+            filtro, params = "", [VENTANA_S]
+            if args.dispositivo:
+                filtro, params = "AND u.nombre = %s", params + [args.dispositivo]
+            cur.execute(f"""
+                SELECT u.nombre, t.ultimo_fix, {", ".join(f"t.{c}" for c in COLUMNAS_RESUMEN)}
+                FROM tiempos_dispositivo t
+                JOIN usuarios u ON u.id = t.usuario_id
+                WHERE t.ultimo_fix > NOW() - %s * INTERVAL '1 second' {filtro}
+                ORDER BY {ORDEN[args.orden]}
+                LIMIT %s
+            """, params + [args.limite])
+            filas = cur.fetchall()
 
-        print("\nListo.\n")
+        if args.dispositivo and not filas:
+            print(f"Sin tiempos para {args.dispositivo} en las últimas {VENTANA_S // 3600} h.")
+        for nombre, ultimo_fix, *resumen in filas:
+            imprimir(nombre, resumen, ultimo_fix)
 
     finally:
         conn.close()
@@ -0,0 +1,378 @@
+# Benchmark de planes: pasa EXPLAIN (ANALYZE, BUFFERS) a cada consulta de la
+# API (API/main.py) y del consumidor (main.py y lo que llama) y guarda plan,
+# índices usados, particiones recorridas, tiempos y buffers. Sirve para
+# comparar antes y después de una migración de esquema:
+#
+#   python explicar_consultas.py --salida antes.json
+#   python ../BD/migrar.py
+#   python explicar_consultas.py --salida despues.json
+#   python explicar_consultas.py --comparar antes.json despues.json
+#
+# Las consultas son copias de las del código (mantenerlas al día). Las
+# escrituras también se ejecutan de verdad, dentro de una transacción que se
+# deshace siempre. Los parámetros salen de la propia BD: el usuario con más
+# fixes y sus últimos DIAS_RANGO días.
+import argparse
+import json
+import os
+import statistics
+import sys
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from estado_reciente import CANAL_ESTADO, COLUMNAS as COLUMNAS_ESTADO
+from historico import FUENTE_RUTA
+from movimiento import FIXES_MOVIMIENTO, HDOP_MAX, VENTANA_S
+from viajes import COLUMNAS_VIAJES
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+REPETICIONES = 5
+DIAS_RANGO = 7
+TAM_PAGINA = 5000      # RUTA_MAX_PAGINA de la API
+TAM_LOTE = 500         # INGESTA_TAM_LOTE del consumidor
+
+# API/main.py
+COLUMNAS_RUTA = """
+    COALESCE(hora_utc::text, '') AS hora_utc, latitud, longitud, altitud, hdop, en_movimiento,
+    to_char(recibido_en, 'YYYY-MM-DD HH24:MI:SS') AS recibido_en,
+    EXTRACT(EPOCH FROM recibido_en)::float8 AS recibido_epoch
+"""
+CLAVE_RUTA = "(ubicaciones.recibido_en, ubicaciones.id)"
+VALOR_CLAVE = "(TIMESTAMPTZ 'epoch' + %({0}_us)s * INTERVAL '1 microsecond', %({0}_id)s)"
+RANGO = "usuario_id = %(usuario_id)s AND recibido_en BETWEEN %(desde)s AND %(hasta)s"
+
+CONSULTAS_API = [
+    ("login", "SELECT id, contraseña FROM usuarios WHERE nombre = %(nombre)s"),
+    ("registrar_token", "UPDATE usuarios SET fcm_token = fcm_token WHERE id = %(usuario_id)s RETURNING nombre"),
+    ("estado_reciente", f"""
+        SELECT {", ".join(c for c in COLUMNAS_ESTADO if c != "hora_utc")}, hora_utc::text AS hora_utc
+        FROM estado_dispositivo WHERE usuario_id = %(usuario_id)s
+    """),
+    ("estado_desde_ubicaciones", """
+        SELECT recibido_en, en_movimiento, hdop FROM ubicaciones
+        WHERE usuario_id = %(usuario_id)s
+        ORDER BY recibido_en DESC LIMIT 50
+    """),
+    ("ubicacion_actual", f"""
+        SELECT {COLUMNAS_RUTA} FROM ubicaciones
+        WHERE usuario_id = %(usuario_id)s
+        ORDER BY ubicaciones.recibido_en DESC LIMIT 1
+    """),
+    ("ruta_limite_pagina", """
+        SELECT (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint, id FROM ubicaciones
+        WHERE usuario_id = %(usuario_id)s
+        ORDER BY recibido_en DESC, id DESC
+        OFFSET %(offset)s LIMIT 2
+    """),
+    ("ruta_pagina", f"""
+        SELECT {COLUMNAS_RUTA} FROM ubicaciones
+        WHERE usuario_id = %(usuario_id)s
+          AND {CLAVE_RUTA} < {VALOR_CLAVE.format("cursor")}
+          AND {CLAVE_RUTA} >= {VALOR_CLAVE.format("fin")}
+        ORDER BY ubicaciones.recibido_en DESC, ubicaciones.id DESC
+    """),
+    ("ruta_fechas_limite_pagina", f"""
+        SELECT (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint, id FROM ubicaciones
+        WHERE {RANGO}
+        ORDER BY recibido_en ASC, id ASC
+        OFFSET %(offset)s LIMIT 2
+    """),
+    ("ruta_fechas_pagina", f"""
+        SELECT {COLUMNAS_RUTA} FROM ubicaciones
+        WHERE {RANGO} AND {CLAVE_RUTA} <= {VALOR_CLAVE.format("fin_asc")}
+        ORDER BY ubicaciones.recibido_en ASC, ubicaciones.id ASC
+    """),
+    ("niveles_rango", """
+        SELECT %(desde)s::timestamptz, %(hasta)s::timestamptz, resumido_desde, completo_desde FROM historico_cortes
+    """),
+    ("ruta_fechas_historico_pagina", f"""
+        SELECT {COLUMNAS_RUTA} FROM {FUENTE_RUTA}
+        WHERE {RANGO} AND {CLAVE_RUTA} <= {VALOR_CLAVE.format("fin_asc")}
+        ORDER BY ubicaciones.recibido_en ASC, ubicaciones.id ASC
+    """),
+    ("ruta_simplificada", f"""
+        SELECT {COLUMNAS_RUTA} FROM ubicaciones
+        WHERE {RANGO}
+        ORDER BY ubicaciones.recibido_en ASC, ubicaciones.id ASC LIMIT 50000
+    """),
+    ("ruta_resumen", f"""
+        SELECT latitud, longitud, hdop FROM ubicaciones
+        WHERE {RANGO}
+        ORDER BY recibido_en ASC
+    """),
+    ("km_ultimos_dias", """
+        SELECT COALESCE(SUM(km), 0) FROM distancia_diaria
+        WHERE usuario_id = %(usuario_id)s AND dia > (NOW() AT TIME ZONE 'UTC')::date - 7
+    """),
+    ("viajes", """
+        SELECT to_char(inicio, 'YYYY-MM-DD HH24:MI:SS') AS inicio, to_char(fin, 'YYYY-MM-DD HH24:MI:SS') AS fin,
+               EXTRACT(EPOCH FROM fin - inicio)::integer AS duracion_s, km, puntos,
+               latitud_inicio, longitud_inicio, latitud_fin, longitud_fin,
+               latitud_min, longitud_min, latitud_max, longitud_max, en_curso,
+               (EXTRACT(EPOCH FROM inicio) * 1000000)::bigint AS inicio_us
+        FROM viajes
+        WHERE usuario_id = %(usuario_id)s AND fin >= %(desde)s AND inicio <= %(hasta)s
+        ORDER BY inicio DESC
+        LIMIT 51
+    """),
+    ("codigos_verificacion", "SELECT codigo, generado_en, usuario FROM codigos_verificacion WHERE email = %(correo)s"),
+]
+
+# main.py, ingesta.py, estado_reciente.py, distancias.py, movimiento.py, viajes.py
+CONSULTAS_CONSUMIDOR = [
+    ("resolver_usuarios", "SELECT nombre, id, fcm_token FROM usuarios WHERE nombre = ANY(%(nombres)s)"),
+    ("insertar_lote", f"""
+        INSERT INTO ubicaciones (usuario_id, hora_utc, latitud, longitud, altitud, hdop, en_movimiento, recibido_en)
+        SELECT %(usuario_id)s, '12:00:00', 40.4 + g * 1e-4, -3.7, 650, 1.2, 1, NOW() - g * INTERVAL '1 second'
+        FROM generate_series(1, {TAM_LOTE}) g
+    """),
+    ("apuntar_lote", "INSERT INTO lotes_ingesta (id) VALUES (gen_random_uuid()) ON CONFLICT DO NOTHING"),
+    ("guardar_estados", f"""
+        WITH guardados AS (
+            INSERT INTO estado_dispositivo ({", ".join(COLUMNAS_ESTADO)})
+            VALUES (%(usuario_id)s, '12:00:00', 40.4, -3.7, 650, 1.2, 1, NOW(), 'Reposo', NULL)
+            ON CONFLICT (usuario_id) DO UPDATE SET
+                {", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNAS_ESTADO[1:])}
+            WHERE estado_dispositivo.recibido_en <= EXCLUDED.recibido_en
+            RETURNING {", ".join(COLUMNAS_ESTADO)}
+        )
+        SELECT pg_notify('{CANAL_ESTADO}', row_to_json(guardados)::text) FROM guardados
+    """),
+    ("sumar_distancia", """
+        INSERT INTO distancia_diaria (usuario_id, dia, km) VALUES (%(usuario_id)s, CURRENT_DATE, 0.5)
+        ON CONFLICT (usuario_id, dia) DO UPDATE SET km = distancia_diaria.km + EXCLUDED.km
+    """),
+    ("guardar_ancla", """
+        INSERT INTO distancia_ancla (usuario_id, latitud, longitud) VALUES (%(usuario_id)s, 40.4, -3.7)
+        ON CONFLICT (usuario_id) DO UPDATE SET latitud = EXCLUDED.latitud, longitud = EXCLUDED.longitud
+    """),
+    ("guardar_viaje", f"""
+        INSERT INTO viajes ({", ".join(COLUMNAS_VIAJES)})
+        VALUES (%(usuario_id)s, NOW() - INTERVAL '1 hour', NOW(), 12.5, 200, 40.4, -3.7, 40.5, -3.6,
+                40.4, -3.7, 40.5, -3.6, TRUE)
+        ON CONFLICT (usuario_id, inicio) DO UPDATE SET
+            {", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNAS_VIAJES[2:])}
+    """),
+    ("guardar_estado_viajes", """
+        INSERT INTO viajes_estado (usuario_id, latitud, longitud, ancla_en, visto_en)
+        VALUES (%(usuario_id)s, 40.4, -3.7, NOW(), NOW())
+        ON CONFLICT (usuario_id) DO UPDATE SET
+            latitud = EXCLUDED.latitud, longitud = EXCLUDED.longitud,
+            ancla_en = EXCLUDED.ancla_en, visto_en = EXCLUDED.visto_en
+    """),
+    ("purgar_lotes", "DELETE FROM lotes_ingesta WHERE aplicado_en < NOW() - 24 * INTERVAL '1 hour'"),
+    ("cargar_ventanas", f"""
+        SELECT u.nombre, x.hora_utc, x.en_movimiento, x.hdop, x.recibido_en, e.ultima_vez_en_movimiento
+        FROM usuarios u
+        CROSS JOIN LATERAL (
+            SELECT hora_utc::text AS hora_utc, en_movimiento, hdop, recibido_en
+            FROM ubicaciones
+            WHERE usuario_id = u.id
+            ORDER BY recibido_en DESC LIMIT {FIXES_MOVIMIENTO + 1}
+        ) x
+        LEFT JOIN estado_dispositivo e ON e.usuario_id = u.id
+        ORDER BY u.nombre, x.recibido_en ASC
+    """),
+    ("cargar_ultimo_movimiento", f"""
+        SELECT DISTINCT ON (nombre) nombre, recibido_en
+        FROM (
+            SELECT u.nombre, x.recibido_en, x.en_movimiento, x.hdop,
+                   LEAD(x.en_movimiento, 1) OVER w AS m2, LEAD(x.hdop, 1) OVER w AS h2,
+                   LEAD(x.en_movimiento, 2) OVER w AS m3, LEAD(x.hdop, 2) OVER w AS h3,
+                   LEAD(x.recibido_en, 2) OVER w AS t3
+            FROM usuarios u
+            CROSS JOIN LATERAL (
+                SELECT recibido_en, en_movimiento, hdop FROM ubicaciones
+                WHERE usuario_id = u.id
+                ORDER BY recibido_en DESC LIMIT 50
+            ) x
+            WHERE NOT EXISTS (SELECT 1 FROM estado_dispositivo e WHERE e.usuario_id = u.id)
+            WINDOW w AS (PARTITION BY u.nombre ORDER BY x.recibido_en DESC)
+        ) t
+        WHERE en_movimiento = 1 AND m2 = 1 AND m3 = 1
+          AND hdop < {HDOP_MAX} AND h2 < {HDOP_MAX} AND h3 < {HDOP_MAX}
+          AND ABS(EXTRACT(EPOCH FROM recibido_en - t3)) <= {VENTANA_S}
+        ORDER BY nombre, recibido_en DESC
+    """),
+    ("cargar_anclas", """
+        SELECT u.nombre, COALESCE(a.latitud, x.latitud), COALESCE(a.longitud, x.longitud)
+        FROM usuarios u
+        LEFT JOIN distancia_ancla a ON a.usuario_id = u.id
+        LEFT JOIN LATERAL (
+            SELECT latitud, longitud FROM ubicaciones
+            WHERE usuario_id = u.id AND a.usuario_id IS NULL
+            ORDER BY recibido_en DESC LIMIT 1
+        ) x ON TRUE
+        WHERE a.usuario_id IS NOT NULL OR x.latitud IS NOT NULL
+    """),
+    ("cargar_segmentadores", f"""
+        SELECT u.nombre, e.latitud, e.longitud, e.ancla_en, e.visto_en,
+               {", ".join(f"v.{c}" for c in COLUMNAS_VIAJES[1:-1])}
+        FROM viajes_estado e
+        JOIN usuarios u ON u.id = e.usuario_id
+        LEFT JOIN viajes v ON v.usuario_id = e.usuario_id AND v.en_curso
+    """),
+]
+
+
+def elegir_parametros(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT u.id, u.nombre, u.correo FROM usuarios u
+            JOIN (SELECT usuario_id, COUNT(*) AS n FROM ubicaciones GROUP BY usuario_id) c ON c.usuario_id = u.id
+            ORDER BY c.n DESC LIMIT 1
+        """)
+        fila = cur.fetchone()
+        if fila is None:
+            raise SystemExit("ubicaciones está vacía: no hay con qué medir")
+        usuario_id, nombre, correo = fila
+        cur.execute("SELECT MAX(recibido_en) FROM ubicaciones WHERE usuario_id = %s", (usuario_id,))
+        hasta = cur.fetchone()[0]
+        cur.execute("SELECT %s - %s * INTERVAL '1 day'", (hasta, DIAS_RANGO))
+        desde = cur.fetchone()[0]
+
+        # Segunda página de /ruta: cursor tras TAM_PAGINA filas, fin tras 2 * TAM_PAGINA
+        cur.execute("""
+            SELECT (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint, id FROM ubicaciones
+            WHERE usuario_id = %s ORDER BY recibido_en DESC, id DESC
+            OFFSET %s LIMIT %s
+        """, (usuario_id, TAM_PAGINA - 1, TAM_PAGINA + 1))
+        claves = cur.fetchall()
+        cursor, fin = claves[0], claves[-1]
+        cur.execute(f"""
+            SELECT (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint, id FROM ubicaciones
+            WHERE usuario_id = %s AND recibido_en BETWEEN %s AND %s ORDER BY recibido_en ASC, id ASC
+            OFFSET %s LIMIT 1
+        """, (usuario_id, desde, hasta, TAM_PAGINA - 1))
+        fin_asc = cur.fetchone() or fin
+    conn.rollback()
+    return {
+        "usuario_id": usuario_id, "nombre": nombre, "nombres": [nombre], "correo": correo,
+        "desde": desde, "hasta": hasta, "offset": TAM_PAGINA - 1,
+        "cursor_us": cursor[0], "cursor_id": cursor[1],
+        "fin_us": fin[0], "fin_id": fin[1],
+        "fin_asc_us": fin_asc[0], "fin_asc_id": fin_asc[1],
+    }
+
+
+def cargar_particiones(conn):
+    """Partición (tabla o índice) -> tabla o índice padre."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname, p.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+        """)
+        padres = dict(cur.fetchall())
+    conn.rollback()
+    return padres
+
+
+def recorrer(nodo, resumen, padres):
+    # Los índices y tablas de cada partición se apuntan con el nombre del
+    # padre; las particiones recorridas se cuentan aparte.
+    resumen["nodos"].append(nodo["Node Type"])
+    if "Index Name" in nodo:
+        resumen["indices"].add(padres.get(nodo["Index Name"], nodo["Index Name"]))
+    if "Relation Name" in nodo:
+        relacion = nodo["Relation Name"]
+        if relacion in padres:
+            resumen["particiones"].add(relacion)
+        resumen["relaciones"].add(padres.get(relacion, relacion))
+    for hijo in nodo.get("Plans", []):
+        recorrer(hijo, resumen, padres)
+
+
+def explicar(conn, sql, params, repeticiones, padres):
+    ejecuciones, planificaciones = [], []
+    plan = None
+    # Una pasada de calentamiento que no cuenta
+    for i in range(repeticiones + 1):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()[0][0]
+        finally:
+            conn.rollback()
+        if i:
+            ejecuciones.append(plan["Execution Time"])
+            planificaciones.append(plan["Planning Time"])
+
+    raiz = plan["Plan"]
+    resumen = {"nodos": [], "indices": set(), "relaciones": set(), "particiones": set()}
+    recorrer(raiz, resumen, padres)
+    return {
+        "plan": " > ".join(dict.fromkeys(resumen["nodos"])),
+        "indices": sorted(resumen["indices"]),
+        "relaciones": sorted(resumen["relaciones"]),
+        "particiones": len(resumen["particiones"]),
+        "filas": raiz.get("Actual Rows"),
+        "planificacion_ms": round(statistics.median(planificaciones), 3),
+        "ejecucion_ms": round(statistics.median(ejecuciones), 3),
+        "buffers": raiz.get("Shared Hit Blocks", 0) + raiz.get("Shared Read Blocks", 0),
+    }
+
+
+def ejecutar(conn, repeticiones):
+    params = elegir_parametros(conn)
+    padres = cargar_particiones(conn)
+    migraciones = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migraciones') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT version, nombre FROM schema_migraciones ORDER BY version")
+            migraciones = [f"{v:04d}_{n}" for v, n in cur.fetchall()]
+    conn.rollback()
+
+    informe = {"migraciones": migraciones, "usuario_id": params["usuario_id"],
+               "desde": str(params["desde"]), "hasta": str(params["hasta"]), "consultas": {}}
+    for origen, consultas in (("api", CONSULTAS_API), ("consumidor", CONSULTAS_CONSUMIDOR)):
+        for nombre, sql in consultas:
+            try:
+                r = explicar(conn, sql, params, repeticiones, padres)
+            except psycopg2.Error as e:
+                r = {"error": str(e).strip().splitlines()[0]}
+            r["origen"] = origen
+            informe["consultas"][nombre] = r
+            print(f"{nombre:<28}{r.get('ejecucion_ms', '-')!s:>10} ms  {r.get('plan', r.get('error'))}", flush=True)
+    return informe
+
+
+def comparar(antes, despues):
+    print(f"Antes: {antes['migraciones']}  Después: {despues['migraciones']}")
+    print(f"{'consulta':<28}{'ms antes':>10}{'ms después':>12}{'x':>7}{'buf antes':>11}{'buf después':>13}{'part.':>7}  índices después")
+    for nombre, d in despues["consultas"].items():
+        a = antes["consultas"].get(nombre, {})
+        ma, md = a.get("ejecucion_ms"), d.get("ejecucion_ms")
+        x = round(ma / md, 1) if ma and md else "-"
+        indices = ", ".join(d.get("indices", [])) or d.get("error", "")
+        print(f"{nombre:<28}{ma!s:>10}{md!s:>12}{x!s:>7}{a.get('buffers')!s:>11}{d.get('buffers')!s:>13}{d.get('particiones', '-')!s:>7}  {indices}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE de las consultas de la API y del consumidor")
+    parser.add_argument("--repeticiones", type=int, default=REPETICIONES)
+    parser.add_argument("--salida", help="guardar el informe JSON en este fichero")
+    parser.add_argument("--comparar", nargs=2, metavar=("ANTES", "DESPUES"))
+    args = parser.parse_args()
+
+    if args.comparar:
+        with open(args.comparar[0]) as fa, open(args.comparar[1]) as fd:
+            comparar(json.load(fa), json.load(fd))
+    else:
+        conn = psycopg2.connect(**POSTGRES_CONFIG)
+        try:
+            informe = ejecutar(conn, args.repeticiones)
+        finally:
+            conn.close()
+        if args.salida:
+            with open(args.salida, "w") as f:
+                json.dump(informe, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,166 @@
+# Reconstruye distancia_diaria (y distancia_ancla) a partir del histórico de
+# ubicaciones con el kernel vectorizado de geo.py, y comprueba que cuadra con
+# lo que sumaría la ingesta punto a punto (AcumuladorDistancias).
+#
+# Solo toca los días que siguen a resolución completa en ubicaciones (desde
+# historico_cortes.completo_desde, ver Utils/retencion.py); los anteriores se
+# calcularon en su día con todos los fixes y se dejan como están.
+#
+#   python reconstruir_distancias.py                   # todos los usuarios
+#   python reconstruir_distancias.py --usuario 12
+#   python reconstruir_distancias.py --solo-verificar
+import argparse
+import os
+import sys
+from collections import defaultdict
+from datetime import date, timedelta, timezone
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from distancias import AcumuladorDistancias, crear_tabla_distancias, guardar_anclas
+from geo import HDOP_MAX, distancias_filtradas
+from historico import leer_cortes
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD", 
+    "database": "DBNAME"
+}
+
+TAM_TROZO = 100000
+TOLERANCIA_KM = 1e-6
+EPOCH = date(1970, 1, 1)
+
+
+def bloquear(cur):
+    # Mientras dure la transacción el consumidor MQTT no puede sumar a
+    # distancia_diaria: sus lotes esperan y suman después sobre lo reconstruido.
+    cur.execute("LOCK TABLE distancia_diaria, distancia_ancla IN SHARE ROW EXCLUSIVE MODE")
+
+
+def punto_de_partida(conn, usuario_id, desde):
+    """(primer día a reconstruir, ancla inicial).
+
+    Sin corte se parte de cero. Con corte, del último fix resumido anterior:
+    el ancla real de la ingesta no se conserva, y este es lo más parecido.
+    """
+    if desde is None:
+        return None, None
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT latitud, longitud FROM ubicaciones_resumidas
+        WHERE usuario_id = %s AND recibido_en < %s AND (hdop IS NULL OR hdop < %s)
+        ORDER BY recibido_en DESC LIMIT 1
+    ''', (usuario_id, desde, HDOP_MAX))
+    return (desde.astimezone(timezone.utc).date(), cur.fetchone())
+
+
+def leer_puntos(conn, usuario_id, desde=None):
+    """Genera trozos (lat, lon, hdop, dia) como arrays; dia = días desde 1970 (UTC)."""
+    with conn.cursor(name=f"puntos_{usuario_id}") as puntos:
+        puntos.itersize = TAM_TROZO
+        puntos.execute('''
+            SELECT latitud, longitud, hdop, (recibido_en AT TIME ZONE 'UTC')::date - DATE '1970-01-01'
+            FROM ubicaciones
+            WHERE usuario_id = %s AND recibido_en >= COALESCE(%s::timestamptz, '-infinity')
+            ORDER BY recibido_en ASC
+        ''', (usuario_id, desde))
+        while True:
+            filas = puntos.fetchmany(TAM_TROZO)
+            if not filas:
+                break
+            datos = np.array(filas, dtype=np.float64)  # hdop NULL -> NaN
+            yield datos[:, 0], datos[:, 1], datos[:, 2], datos[:, 3].astype(np.int64)
+
+
+def reconstruir_usuario(conn, usuario_id, desde=None):
+    cur = conn.cursor()
+    bloquear(cur)
+
+    km = defaultdict(float)
+    primer_dia, ancla = punto_de_partida(conn, usuario_id, desde)
+    for lat, lon, hdop, dia in leer_puntos(conn, usuario_id, desde):
+        km_punto, ancla = distancias_filtradas(lat, lon, hdop, ancla=ancla)
+        dias, inverso = np.unique(dia, return_inverse=True)
+        for d, total in zip(dias, np.bincount(inverso, weights=km_punto)):
+            km[EPOCH + timedelta(days=int(d))] += float(total)
+
+    cur.execute("DELETE FROM distancia_diaria WHERE usuario_id = %s AND dia >= COALESCE(%s::date, '-infinity')",
+                (usuario_id, primer_dia))
+    cur.execute("DELETE FROM distancia_ancla WHERE usuario_id = %s", (usuario_id,))
+    psycopg2.extras.execute_values(cur, '''
+        INSERT INTO distancia_diaria (usuario_id, dia, km) VALUES %s
+    ''', [(usuario_id, dia, total) for dia, total in km.items()])
+    if ancla is not None:
+        guardar_anclas(cur, [(usuario_id, ancla[0], ancla[1])])
+    conn.commit()
+    return len(km)
+
+
+def verificar_usuario(conn, usuario_id, desde=None):
+    """Recalcula los cubos con la regla de la ingesta, fix a fix, y los compara."""
+    cur = conn.cursor()
+    bloquear(cur)
+
+    primer_dia, ancla = punto_de_partida(conn, usuario_id, desde)
+    acumulador = AcumuladorDistancias({usuario_id: ancla} if ancla else {})
+    for lat, lon, hdop, dia in leer_puntos(conn, usuario_id, desde):
+        for la, lo, h, d in zip(lat.tolist(), lon.tolist(), hdop.tolist(), dia.tolist()):
+            acumulador.sumar(usuario_id, usuario_id, EPOCH + timedelta(days=d), la, lo, None if h != h else h)
+    esperado = {dia: total for (_, dia), total in acumulador.km.items()}
+
+    cur.execute("SELECT dia, km FROM distancia_diaria WHERE usuario_id = %s AND dia >= COALESCE(%s::date, '-infinity')",
+                (usuario_id, primer_dia))
+    obtenido = dict(cur.fetchall())
+    diferencias = []
+    for dia in sorted(set(esperado) | set(obtenido)):
+        e, o = esperado.get(dia, 0.0), obtenido.get(dia, 0.0)
+        if abs(e - o) > TOLERANCIA_KM:
+            diferencias.append((dia, e, o))
+
+    conn.rollback()
+    return diferencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruye y verifica distancia_diaria")
+    parser.add_argument("--usuario", type=int, action="append", help="repetible; por defecto todos")
+    parser.add_argument("--solo-verificar", action="store_true")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        cur = conn.cursor()
+        crear_tabla_distancias(cur)
+        if args.usuario:
+            usuarios = args.usuario
+        else:
+            cur.execute("SELECT id FROM usuarios ORDER BY id")
+            usuarios = [r[0] for r in cur.fetchall()]
+        desde = leer_cortes(conn).completo_desde
+        conn.commit()
+        if desde:
+            print(f"Solo desde {desde:%Y-%m-%d}: lo anterior ya no está a resolución completa.", flush=True)
+
+        errores = 0
+        for usuario_id in usuarios:
+            if not args.solo_verificar:
+                cubos = reconstruir_usuario(conn, usuario_id, desde)
+                print(f"Usuario {usuario_id}: {cubos} días reconstruidos", flush=True)
+            for dia, esperado, obtenido in verificar_usuario(conn, usuario_id, desde):
+                errores += 1
+                print(f"  DIFERENCIA usuario {usuario_id}, {dia}: puntos={esperado:.6f} km, cubos={obtenido:.6f} km")
+
+        print(f"\n{len(usuarios)} usuarios verificados, {errores} diferencias.")
+        sys.exit(1 if errores else 0)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Reconstruye viajes (y viajes_estado) a partir del histórico de ubicaciones,
+# pasando los fixes de cada usuario por la misma segmentación que la ingesta
+# (viajes.SegmentadorViajes). Sirve para rellenar los viajes anteriores a que
+# la ingesta los calculara, o para recalcularlos tras cambiar los umbrales.
+#
+# Solo con los fixes que siguen a resolución completa en ubicaciones (desde
+# historico_cortes.completo_desde, ver Utils/retencion.py); los viajes que
+# empiezan antes se dejan como están.
+#
+# Con el consumidor MQTT parado: guarda en memoria el estado de la
+# segmentación de cada dispositivo y al volver a escribir pisaría lo
+# reconstruido. Las tablas tienen que existir (BD/migraciones/0006_viajes.sql).
+#
+#   python reconstruir_viajes.py                   # todos los usuarios
+#   python reconstruir_viajes.py --usuario 12
+import argparse
+import os
+import sys
+
+import psycopg2
+import psycopg2.extras
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from historico import leer_cortes
+from viajes import VIAJE_MIN_KM, AcumuladorViajes
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+TAM_TROZO = 100000
+
+
+def leer_fixes(conn, usuario_id, desde=None):
+    """Genera (recibido_en, lat, lon, hdop, en_movimiento) en orden."""
+    with conn.cursor(name=f"fixes_{usuario_id}") as fixes:
+        fixes.itersize = TAM_TROZO
+        fixes.execute('''
+            SELECT recibido_en, latitud, longitud, hdop, en_movimiento
+            FROM ubicaciones
+            WHERE usuario_id = %s AND recibido_en >= COALESCE(%s::timestamptz, '-infinity')
+            ORDER BY recibido_en ASC
+        ''', (usuario_id, desde))
+        yield from fixes
+
+
+def reconstruir_usuario(conn, usuario_id, desde=None):
+    # El acumulador de un lote, con un solo lote que es todo el histórico
+    viajes = AcumuladorViajes({})
+    for recibido_en, lat, lon, hdop, en_mov in leer_fixes(conn, usuario_id, desde):
+        viajes.registrar(usuario_id, usuario_id, recibido_en, lat, lon, hdop, en_mov)
+
+    cur = conn.cursor()
+    cur.execute("DELETE FROM viajes WHERE usuario_id = %s AND inicio >= COALESCE(%s::timestamptz, '-infinity')",
+                (usuario_id, desde))
+    cur.execute("DELETE FROM viajes_estado WHERE usuario_id = %s", (usuario_id,))
+    viajes.guardar(cur)
+    conn.commit()
+    return len(viajes.filas_viajes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruye la tabla viajes desde ubicaciones")
+    parser.add_argument("--usuario", type=int, action="append", help="repetible; por defecto todos")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        cur = conn.cursor()
+        if args.usuario:
+            usuarios = args.usuario
+        else:
+            cur.execute("SELECT id FROM usuarios ORDER BY id")
+            usuarios = [r[0] for r in cur.fetchall()]
+        desde = leer_cortes(conn).completo_desde
+        conn.commit()
+        if desde:
+            print(f"Solo desde {desde:%Y-%m-%d}: lo anterior ya no está a resolución completa.", flush=True)
+
+        total = 0
+        for usuario_id in usuarios:
+            n = reconstruir_usuario(conn, usuario_id, desde)
+            total += n
+            if n:
+                print(f"Usuario {usuario_id}: {n} viajes", flush=True)
+        print(f"\n{len(usuarios)} usuarios, {total} viajes de al menos {VIAJE_MIN_KM} km.")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# Retención del histórico de ubicaciones en tres niveles (ver historico.py):
+# los fixes de más de MESES_COMPLETOS meses se resumen a uno por minuto en
+# ubicaciones_resumidas y los de más de MESES_RESUMIDOS meses pasan a ficheros
+# en disco. Se trabaja por meses naturales (UTC), cada uno en su transacción.
+#
+#   python retencion.py              # aplica lo que toque
+#   python retencion.py --simular    # solo lista los meses que movería
+#
+# Pensado para cron (una vez al día basta: solo hace algo al cambiar de mes).
+# Si se corta a medias se puede relanzar: un mes a medio archivar solo deja
+# ficheros que la siguiente pasada reescribe.
+import argparse
+import itertools
+import os
+import sys
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.sql
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import historico
+from movimiento import HDOP_MAX
+
+POSTGRES_CONFIG = {
+    "host": "IPHOST",
+    "port": PUERTO,
+    "user": "USERNAME",
+    "password": "PASSWORD",
+    "database": "DBNAME"
+}
+
+MESES_COMPLETOS = 3      # además del mes en curso
+MESES_RESUMIDOS = 24     # ídem; tiene que ser >= MESES_COMPLETOS
+INTERVALO_RESUMEN_S = 60
+TAM_TROZO = 50000
+# Clave de pg_advisory_lock: dos pasadas a la vez no se pisan
+CLAVE_BLOQUEO = 460119
+
+
+def mes_siguiente(mes):
+    return datetime(mes.year + mes.month // 12, mes.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def restar_meses(mes, n):
+    total = mes.year * 12 + mes.month - 1 - n
+    return datetime(total // 12, total % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def meses_pendientes(cur, tabla, corte_actual, hasta):
+    """Meses de `tabla` anteriores a `hasta` que aún no se han procesado."""
+    desde = corte_actual
+    if desde is None:
+        # Primera pasada: buscar el fix más antiguo (con las particiones solo
+        # se miran las anteriores al corte)
+        cur.execute(psycopg2.sql.SQL("SELECT MIN(recibido_en) FROM {} WHERE recibido_en < %s")
+                    .format(psycopg2.sql.Identifier(tabla)), (hasta,))
+        desde = cur.fetchone()[0]
+        if desde is None:
+            return []
+    desde = desde.astimezone(timezone.utc)
+    mes = datetime(desde.year, desde.month, 1, tzinfo=timezone.utc)
+    pendientes = []
+    while mes < hasta:
+        pendientes.append(mes)
+        mes = mes_siguiente(mes)
+    return pendientes
+
+
+def resumir_mes(conn, mes):
+    """Pasa un mes de ubicaciones a ubicaciones_resumidas y lo borra de ubicaciones.
+
+    De cada dispositivo y minuto se queda el primer fix con hdop bueno (o el
+    primero, si ninguno lo es), con cuántos fixes representaba.
+    """
+    fin = mes_siguiente(mes)
+    with conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO ubicaciones_resumidas
+                (id, usuario_id, hora_utc, latitud, longitud, altitud, hdop, en_movimiento, recibido_en, fixes)
+            SELECT DISTINCT ON (usuario_id, cubo)
+                id, usuario_id, hora_utc, latitud, longitud, altitud, hdop, en_movimiento, recibido_en,
+                COUNT(*) OVER (PARTITION BY usuario_id, cubo)
+            FROM (
+                SELECT *, floor(EXTRACT(EPOCH FROM recibido_en) / %(intervalo)s) AS cubo
+                FROM ubicaciones
+                WHERE recibido_en >= %(desde)s AND recibido_en < %(hasta)s
+            ) x
+            ORDER BY usuario_id, cubo, hdop IS NULL OR hdop >= %(hdop_max)s, recibido_en, id
+        ''', {"intervalo": INTERVALO_RESUMEN_S, "desde": mes, "hasta": fin, "hdop_max": HDOP_MAX})
+        resumidas = cur.rowcount
+
+        # La partición del mes (migración 0003) se borra entera; el DELETE
+        # recoge lo que hubiera en ubicaciones_default o si no hay particiones.
+        particion = f"ubicaciones_p{mes:%Y%m}"
+        cur.execute('''
+            SELECT 1 FROM pg_inherits
+            WHERE inhrelid = to_regclass(%s) AND inhparent = 'ubicaciones'::regclass
+        ''', (particion,))
+        borradas = 0
+        if cur.fetchone():
+            cur.execute(psycopg2.sql.SQL("SELECT COUNT(*) FROM {}").format(psycopg2.sql.Identifier(particion)))
+            borradas = cur.fetchone()[0]
+            cur.execute(psycopg2.sql.SQL("DROP TABLE {}").format(psycopg2.sql.Identifier(particion)))
+        cur.execute("DELETE FROM ubicaciones WHERE recibido_en >= %s AND recibido_en < %s", (mes, fin))
+        borradas += cur.rowcount
+
+        cur.execute("UPDATE historico_cortes SET completo_desde = %s", (fin,))
+    conn.commit()
+    return borradas, resumidas
+
+
+def archivar_mes(conn, mes, directorio):
+    """Escribe un mes de ubicaciones_resumidas a ficheros y lo borra de la BD."""
+    fin = mes_siguiente(mes)
+    usuarios = filas = 0
+    # recibido_en se formatea aquí como lo hace la API (misma zona de sesión)
+    with conn.cursor(name="archivo") as cur:
+        cur.itersize = TAM_TROZO
+        cur.execute('''
+            SELECT usuario_id, id, COALESCE(hora_utc::text, ''), latitud, longitud, altitud, hdop, en_movimiento,
+                   to_char(recibido_en, 'YYYY-MM-DD HH24:MI:SS'),
+                   (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint
+            FROM ubicaciones_resumidas
+            WHERE recibido_en >= %s AND recibido_en < %s
+            ORDER BY usuario_id, recibido_en, id
+        ''', (mes, fin))
+        for usuario_id, grupo in itertools.groupby(cur, key=lambda f: f[0]):
+            datos = [f[1:] for f in grupo]
+            historico.escribir_fichero(usuario_id, mes, datos, directorio)
+            usuarios += 1
+            filas += len(datos)
+
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM ubicaciones_resumidas WHERE recibido_en >= %s AND recibido_en < %s", (mes, fin))
+        cur.execute("UPDATE historico_cortes SET resumido_desde = %s", (fin,))
+    conn.commit()
+    return usuarios, filas
+
+
+def aplicar(conn, simular=False, directorio=historico.DIR_ARCHIVO, ahora=None):
+    ahora = ahora or datetime.now(timezone.utc)
+    este_mes = datetime(ahora.year, ahora.month, 1, tzinfo=timezone.utc)
+    corte_completo = restar_meses(este_mes, MESES_COMPLETOS)
+    corte_resumido = restar_meses(este_mes, MESES_RESUMIDOS)
+
+    cortes = historico.leer_cortes(conn)
+    with conn.cursor() as cur:
+        a_resumir = meses_pendientes(cur, "ubicaciones", cortes.completo_desde, corte_completo)
+    conn.rollback()
+    for mes in a_resumir:
+        if simular:
+            print(f"{mes:%Y-%m}: se resumiría", flush=True)
+            continue
+        borradas, resumidas = resumir_mes(conn, mes)
+        print(f"{mes:%Y-%m}: {borradas} fixes -> {resumidas} resumidos", flush=True)
+
+    cortes = historico.leer_cortes(conn)
+    with conn.cursor() as cur:
+        a_archivar = meses_pendientes(cur, "ubicaciones_resumidas", cortes.resumido_desde, corte_resumido)
+    conn.rollback()
+    for mes in a_archivar:
+        if simular:
+            print(f"{mes:%Y-%m}: se archivaría en {directorio}", flush=True)
+            continue
+        usuarios, filas = archivar_mes(conn, mes, directorio)
+        print(f"{mes:%Y-%m}: {filas} fixes resumidos de {usuarios} usuarios archivados", flush=True)
+    return len(a_resumir), len(a_archivar)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resume y archiva el histórico de ubicaciones")
+    parser.add_argument("--simular", action="store_true", help="solo listar, sin tocar nada")
+    args = parser.parse_args()
+    if MESES_RESUMIDOS < MESES_COMPLETOS:
+        raise SystemExit("MESES_RESUMIDOS no puede ser menor que MESES_COMPLETOS")
+
+    conn = psycopg2.connect(**POSTGRES_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (CLAVE_BLOQUEO,))
+            if not cur.fetchone()[0]:
+                raise SystemExit("Ya hay otra pasada de retención en marcha")
+        conn.commit()
+        resumidos, archivados = aplicar(conn, args.simular)
+        if args.simular:
+            print(f"{resumidos} meses por resumir, {archivados} por archivar.")
+        else:
+            print(f"{resumidos} meses resumidos, {archivados} meses archivados.")
+    except psycopg2.Error as e:
+        print(f"Error en la retención: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
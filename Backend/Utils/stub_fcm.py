@@ -0,0 +1,91 @@
+# Servidor HTTP local que imita el endpoint FCM v1 para probar DespachadorFCM
+# sin tocar Google. Ejecutado como script hace una prueba completa: devuelve
+# algunos 429/500/401 y comprueba que todo acaba entregándose.
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from notificaciones import DespachadorFCM
+
+PUERTO_STUB = 8765
+PROJECT_ID = "stub"
+
+
+class EstadoStub:
+    def __init__(self):
+        self.recibidos = []
+        self.conexiones = set()
+        # Respuestas forzadas antes de empezar a aceptar (se consumen en orden)
+        self.respuestas = []
+        self.lock = threading.Lock()
+
+
+class ManejadorFCM(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, para ver la reutilización de conexión
+
+    def do_POST(self):
+        estado = self.server.estado
+        cuerpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with estado.lock:
+            estado.conexiones.add(self.client_address)
+            codigo = estado.respuestas.pop(0) if estado.respuestas else 200
+            if codigo == 200:
+                estado.recibidos.append((self.headers.get("Authorization"), json.loads(cuerpo)))
+
+        respuesta = json.dumps({"name": f"projects/{PROJECT_ID}/messages/{len(estado.recibidos)}"}).encode()
+        self.send_response(codigo)
+        if codigo == 429:
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(respuesta)))
+        self.end_headers()
+        self.wfile.write(respuesta)
+
+    def log_message(self, *args):
+        pass
+
+
+class TokenFalso:
+    def __init__(self):
+        self.refrescos = 0
+
+    def obtener(self, forzar=False):
+        if forzar or not self.refrescos:
+            self.refrescos += 1
+        return f"token-{self.refrescos}"
+
+
+def arrancar_stub(puerto=PUERTO_STUB):
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), ManejadorFCM)
+    servidor.estado = EstadoStub()
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+if __name__ == "__main__":
+    servidor = arrancar_stub()
+    servidor.estado.respuestas = [429, 500, 401]
+
+    token = TokenFalso()
+    despachador = DespachadorFCM(PROJECT_ID, token, url_base=f"http://127.0.0.1:{PUERTO_STUB}", max_por_segundo=50)
+    despachador.iniciar()
+
+    inicio = time.monotonic()
+    for i in range(20):
+        assert despachador.enviar(f"fcm-{i}", "Prueba", f"Mensaje {i}")
+    print(f"20 notificaciones encoladas en {(time.monotonic() - inicio) * 1000:.2f} ms")
+
+    despachador.detener(timeout=30)
+    servidor.shutdown()
+
+    print("Métricas:", despachador.resumen_metricas())
+    print("Entregadas al stub:", len(servidor.estado.recibidos))
+    print("Conexiones TCP distintas:", len(servidor.estado.conexiones))
+    print("Refrescos de token:", token.refrescos)
+    assert len(servidor.estado.recibidos) == 20
+    assert servidor.estado.recibidos[-1][0] == "Bearer token-2"
+    print("OK")
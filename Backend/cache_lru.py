@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheLRU:
+    """Cache clave -> valor con caducidad, tamaño máximo y generación.
+
+    - Cada entrada vale `ttl_s` segundos desde que se pone; pasado ese tiempo
+      `obtener` la borra y cuenta un fallo.
+    - Con más de `max_entradas` se expulsan las menos usadas recientemente.
+    - `invalidar` sube la generación. Quien lee de la fuente apunta antes
+      `generacion()` y se la pasa a `poner`: si entretanto hubo una
+      invalidación el valor se descarta, porque podría ser anterior al cambio.
+
+    Es segura entre hilos.
+    """
+
+    def __init__(self, max_entradas=10000, ttl_s=600):
+        self.max_entradas = max_entradas
+        self.ttl_s = ttl_s
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self._generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+
+    def generacion(self):
+        with self._lock:
+            return self._generacion
+
+    def obtener(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[1] < ahora:
+                if entrada is not None:
+                    del self._datos[clave]
+                self.fallos += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def poner(self, clave, valor, generacion):
+        with self._lock:
+            if generacion != self._generacion:
+                return
+            self._datos[clave] = (valor, time.monotonic() + self.ttl_s)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def invalidar(self, clave=None):
+        with self._lock:
+            self._generacion += 1
+            self.invalidaciones += 1
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+    def resumen_metricas(self):
+        with self._lock:
+            return {
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "invalidaciones": self.invalidaciones,
+                "entradas": len(self._datos),
+            }
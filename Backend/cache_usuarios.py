@@ -0,0 +1,13 @@
+from cache_lru import CacheLRU
+
+# Canal por el que la API avisa de cambios en usuarios (p. ej. nuevo fcm_token).
+# El payload es el nombre del usuario/dispositivo afectado.
+CANAL_USUARIOS = "usuarios_cambios"
+
+
+class CacheUsuarios(CacheLRU):
+    """Nombre de dispositivo -> (usuario_id, fcm_token).
+
+    Se invalida con los avisos de CANAL_USUARIOS (por nombre) y al reconectar
+    la escucha (entera).
+    """
@@ -0,0 +1,185 @@
+"""Descifrado y parseo de los payloads MQTT de los localizadores.
+
+Cada payload es base64 de un CSV "nombre,hora_utc,lat,lon,alt,hdop,en_mov"
+cifrado con XOR contra una clave repetida (la misma que lleva el ESP32).
+
+`descifrar_csv` es el camino por mensaje; `decodificar_lote` procesa muchos
+payloads de golpe (reproducir un backlog del broker o una captura) y devuelve
+columnas tipadas listas para un INSERT masivo. Ambos dan exactamente lo mismo
+que la implementación original carácter a carácter (`descifrar_csv_referencia`).
+"""
+import base64
+import sys
+import time
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional: sin él se usa XOR sobre enteros grandes
+    np = None
+
+Columnas = namedtuple("Columnas", "nombre hora_utc lat lon alt hdop en_mov")
+
+_flujos = {}
+
+
+def flujo_clave(clave, n):
+    """Clave repetida hasta al menos `n` bytes (se guarda y se reutiliza)."""
+    flujo = _flujos.get(clave)
+    if flujo is None or len(flujo) < n:
+        clave_b = clave.encode("ascii")
+        flujo = clave_b * (max(n, 256, len(flujo or b"") * 2) // len(clave_b) + 1)
+        _flujos[clave] = flujo
+    return flujo
+
+
+def descifrar_csv_referencia(b64_encoded, clave):
+    # Implementación original, carácter a carácter. Se mantiene como referencia
+    # y como camino lento para datos no ASCII.
+    try:
+        cifrado = base64.b64decode(b64_encoded).decode()
+        plano = ''.join(chr(ord(c) ^ ord(clave[i % len(clave)])) for i, c in enumerate(cifrado))
+        return plano
+    except Exception as e:
+        return f"[ERROR DESCIFRANDO] {e}"
+
+
+def _xor(datos, clave):
+    n = len(datos)
+    if not n:
+        return ""
+    flujo = flujo_clave(clave, n)
+    x = int.from_bytes(datos, "little") ^ int.from_bytes(flujo[:n], "little")
+    # ASCII ^ ASCII sigue siendo ASCII: latin-1 decodifica byte a byte sin validar
+    return x.to_bytes(n, "little").decode("latin-1")
+
+
+def descifrar_csv(b64_encoded, clave):
+    # Con bytes y clave ASCII, XOR por bytes == XOR por caracteres
+    if not clave or not clave.isascii():
+        return descifrar_csv_referencia(b64_encoded, clave)
+    try:
+        datos = base64.b64decode(b64_encoded)
+    except Exception as e:
+        return f"[ERROR DESCIFRANDO] {e}"
+    if not datos.isascii():
+        return descifrar_csv_referencia(b64_encoded, clave)
+    return _xor(datos, clave)
+
+
+def descifrar_lote(payloads, clave):
+    """Descifra muchos payloads. Devuelve una lista de str, con el mismo
+    "[ERROR DESCIFRANDO] ..." que `descifrar_csv` donde falle."""
+    if not clave or not clave.isascii():
+        return [descifrar_csv_referencia(p, clave) for p in payloads]
+
+    planos = [None] * len(payloads)
+    rapidos, datos_rapidos = [], []
+    for i, payload in enumerate(payloads):
+        try:
+            datos = base64.b64decode(payload)
+        except Exception as e:
+            planos[i] = f"[ERROR DESCIFRANDO] {e}"
+            continue
+        if datos.isascii():
+            rapidos.append(i)
+            datos_rapidos.append(datos)
+        else:
+            planos[i] = descifrar_csv_referencia(payload, clave)
+
+    if not rapidos:
+        return planos
+
+    if np is not None:
+        longitudes = np.fromiter(map(len, datos_rapidos), dtype=np.int64, count=len(datos_rapidos))
+        fines = np.cumsum(longitudes)
+        total = int(fines[-1]) if len(fines) else 0
+        buf = np.frombuffer(b"".join(datos_rapidos), dtype=np.uint8)
+        clave_arr = np.frombuffer(clave.encode("ascii"), dtype=np.uint8)
+        # Posición dentro de su propio mensaje: la clave se reinicia en cada uno
+        pos = np.arange(total, dtype=np.int64) - np.repeat(fines - longitudes, longitudes)
+        texto = (buf ^ clave_arr[pos % len(clave_arr)]).tobytes().decode("latin-1")
+        inicio = 0
+        for i, fin in zip(rapidos, fines.tolist()):
+            planos[i] = texto[inicio:fin]
+            inicio = fin
+    else:
+        for i, datos in zip(rapidos, datos_rapidos):
+            planos[i] = _xor(datos, clave)
+    return planos
+
+
+def parsear_lote(planos, como_numpy=False):
+    """CSV descifrados -> (Columnas, indices_validos, errores).
+
+    Aplica las mismas conversiones que `ingesta.parsear_csv` (float/int de
+    Python), así que las filas válidas y los valores son idénticos.
+    `errores` es una lista de (indice, motivo).
+    """
+    filas, indices, errores = [], [], []
+    for i, plano in enumerate(planos):
+        if plano.startswith("[ERROR"):
+            errores.append((i, plano))
+            continue
+        campos = plano.split(',')
+        if len(campos) != 7:
+            errores.append((i, "CSV mal formado, se esperaban 7 campos"))
+            continue
+        filas.append(campos)
+        indices.append(i)
+
+    if not filas:
+        vacias = Columnas([], [], [], [], [], [], [])
+        return vacias, indices, errores
+
+    nombre, hora_utc, lat, lon, alt, hdop, en_mov = (list(c) for c in zip(*filas))
+    try:
+        numericas = (list(map(float, lat)), list(map(float, lon)), list(map(float, alt)),
+                     list(map(float, hdop)), list(map(int, en_mov)))
+    except ValueError:
+        # Alguna fila trae basura: se separan fila a fila y se repite
+        buenas = []
+        for fila, i in zip(filas, indices):
+            try:
+                float(fila[2]), float(fila[3]), float(fila[4]), float(fila[5]), int(fila[6])
+                buenas.append((fila, i))
+            except ValueError:
+                errores.append((i, "Error de conversión de tipos en los campos numéricos."))
+        errores.sort()
+        columnas, indices, _ = parsear_lote([",".join(f) for f, _ in buenas], como_numpy)
+        return columnas, [buenas[j][1] for j in indices], errores
+
+    if como_numpy and np is not None:
+        numericas = tuple(np.asarray(c, dtype=np.float64) for c in numericas[:4]) + \
+                    (np.asarray(numericas[4], dtype=np.int16),)
+    return Columnas(nombre, hora_utc, *numericas), indices, errores
+
+
+def decodificar_lote(payloads, clave, como_numpy=False):
+    """base64 cifrado -> columnas tipadas (nombre, hora_utc, lat, lon, alt, hdop, en_mov)."""
+    return parsear_lote(descifrar_lote(payloads, clave), como_numpy)
+
+
+# =======================
+# USO: python decodificacion.py CLAVE volcado.txt
+# (un payload base64 por línea, p. ej. un `mosquitto_sub -t ubi/campers` capturado)
+# =======================
+if __name__ == "__main__":
+    clave, fichero = sys.argv[1], sys.argv[2]
+    with open(fichero) as f:
+        payloads = [linea.strip() for linea in f if linea.strip()]
+
+    inicio = time.perf_counter()
+    referencia = [descifrar_csv_referencia(p, clave) for p in payloads]
+    t_ref = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    columnas, indices, errores = decodificar_lote(payloads, clave, como_numpy=True)
+    t_lote = time.perf_counter() - inicio
+
+    assert descifrar_lote(payloads, clave) == referencia, "descifrar_lote difiere de la referencia"
+    assert [descifrar_csv(p, clave) for p in payloads] == referencia, "descifrar_csv difiere de la referencia"
+
+    print(f"{len(payloads)} payloads, {len(indices)} válidos, {len(errores)} con error")
+    print(f"Referencia (solo descifrar): {t_ref * 1000:.1f} ms")
+    print(f"Lote (descifrar + parsear):  {t_lote * 1000:.1f} ms")
@@ -0,0 +1,126 @@
+"""Distancia recorrida por usuario y día (UTC), acumulada durante la ingesta.
+
+Cada fix suma al cubo de su día (el de su recibido_en) el tramo desde el
+último punto aceptado (el ancla) del mismo dispositivo, con el filtro de
+jitter de geo.py: fixes con hdop alto o a menos de UMBRAL_JITTER_M del ancla
+no suman. Las consultas de distancia solo suman unos pocos cubos en vez de
+recorrer todos los puntos de la ventana.
+"""
+from collections import defaultdict
+
+import psycopg2.extras
+
+from geo import HDOP_MAX, UMBRAL_JITTER_M, haversine
+
+
+def crear_tabla_distancias(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS distancia_diaria (
+            usuario_id BIGINT NOT NULL,
+            dia DATE NOT NULL,
+            km DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, dia)
+        )
+    ''')
+    # El ancla no se puede deducir de la última fila (puede ser un fix
+    # descartado), así que se guarda junto a los cubos.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS distancia_ancla (
+            usuario_id BIGINT PRIMARY KEY,
+            latitud DOUBLE PRECISION NOT NULL,
+            longitud DOUBLE PRECISION NOT NULL
+        )
+    ''')
+
+
+def guardar_anclas(cursor, filas):
+    """Upsert de (usuario_id, lat, lon)."""
+    if not filas:
+        return
+    psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO distancia_ancla (usuario_id, latitud, longitud) VALUES %s
+        ON CONFLICT (usuario_id) DO UPDATE SET latitud = EXCLUDED.latitud, longitud = EXCLUDED.longitud
+    ''', filas)
+
+
+def cargar_anclas(cursor):
+    """nombre de dispositivo -> (lat, lon) del último punto aceptado.
+
+    Los dispositivos sin fila en distancia_ancla (anteriores al filtro de
+    jitter) parten de su último fix guardado.
+    """
+    cursor.execute("""
+        SELECT u.nombre, COALESCE(a.latitud, x.latitud), COALESCE(a.longitud, x.longitud)
+        FROM usuarios u
+        LEFT JOIN distancia_ancla a ON a.usuario_id = u.id
+        LEFT JOIN LATERAL (
+            SELECT latitud, longitud FROM ubicaciones
+            WHERE usuario_id = u.id AND a.usuario_id IS NULL
+            ORDER BY recibido_en DESC LIMIT 1
+        ) x ON TRUE
+        WHERE a.usuario_id IS NOT NULL OR x.latitud IS NOT NULL
+    """)
+    return {nombre: (lat, lon) for nombre, lat, lon in cursor.fetchall()}
+
+
+class AcumuladorDistancias:
+    """Tramos de un lote agrupados por (usuario_id, día).
+
+    Trabaja sobre `anclas` (nombre -> último punto aceptado) sin modificarlo;
+    las anclas nuevas quedan en `self.anclas` para aplicarlas tras el commit.
+    Es la versión punto a punto de `geo.distancias_filtradas`.
+    """
+
+    def __init__(self, anclas):
+        self.base = anclas
+        self.anclas = {}
+        self.usuario_ids = {}
+        self.km = defaultdict(float)
+
+    def sumar(self, nombre, usuario_id, dia, lat, lon, hdop=None):
+        if hdop is not None and hdop >= HDOP_MAX:
+            return
+        ancla = self.anclas.get(nombre) or self.base.get(nombre)
+        if ancla is not None:
+            km = haversine(ancla[0], ancla[1], lat, lon)
+            if km < UMBRAL_JITTER_M / 1000.0:
+                return
+            self.km[(usuario_id, dia)] += km
+        self.anclas[nombre] = (lat, lon)
+        self.usuario_ids[nombre] = usuario_id
+
+    def guardar(self, cursor):
+        if self.km:
+            psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO distancia_diaria (usuario_id, dia, km) VALUES %s
+                ON CONFLICT (usuario_id, dia) DO UPDATE SET km = distancia_diaria.km + EXCLUDED.km
+            ''', [(uid, dia, km) for (uid, dia), km in self.km.items()])
+        guardar_anclas(cursor, [(self.usuario_ids[n], lat, lon) for n, (lat, lon) in self.anclas.items()])
+
+    async def guardar_asyncpg(self, conn):
+        """guardar() para una conexión de asyncpg (ingesta_async.py)."""
+        if self.km:
+            claves = list(self.km)
+            await conn.execute('''
+                INSERT INTO distancia_diaria (usuario_id, dia, km)
+                SELECT * FROM unnest($1::bigint[], $2::date[], $3::float8[])
+                ON CONFLICT (usuario_id, dia) DO UPDATE SET km = distancia_diaria.km + EXCLUDED.km
+            ''', [uid for uid, _ in claves], [dia for _, dia in claves], [self.km[c] for c in claves])
+        if self.anclas:
+            nombres = list(self.anclas)
+            await conn.execute('''
+                INSERT INTO distancia_ancla (usuario_id, latitud, longitud)
+                SELECT * FROM unnest($1::bigint[], $2::float8[], $3::float8[])
+                ON CONFLICT (usuario_id) DO UPDATE SET latitud = EXCLUDED.latitud, longitud = EXCLUDED.longitud
+            ''', [self.usuario_ids[n] for n in nombres], [self.anclas[n][0] for n in nombres],
+                [self.anclas[n][1] for n in nombres])
+
+
+def km_ultimos_dias(conn, usuario_id, dias):
+    """Km de los últimos `dias` días naturales UTC, hoy incluido."""
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT COALESCE(SUM(km), 0) FROM distancia_diaria
+        WHERE usuario_id = %s AND dia > (NOW() AT TIME ZONE 'UTC')::date - %s
+    ''', (usuario_id, dias))
+    return round(cur.fetchone()[0], 2)
@@ -0,0 +1,59 @@
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+log = logging.getLogger(__name__)
+
+
+class EscuchaPostgres(threading.Thread):
+    """Hilo que hace LISTEN en uno o varios canales de PostgreSQL.
+
+    Llama a `al_notificar(canal, payload)` por cada NOTIFY recibido. Si la
+    conexión se cae se reconecta sola y llama a `al_reconectar()`, porque los
+    NOTIFY emitidos mientras estaba caída se han perdido.
+    """
+
+    def __init__(self, conectar, canales, al_notificar, al_reconectar=None, espera_reconexion_s=5):
+        super().__init__(name="escucha-pg", daemon=True)
+        self.conectar = conectar
+        self.canales = list(canales)
+        self.al_notificar = al_notificar
+        self.al_reconectar = al_reconectar
+        self.espera_reconexion_s = espera_reconexion_s
+        self._parar = threading.Event()
+
+    def detener(self):
+        self._parar.set()
+
+    def run(self):
+        while not self._parar.is_set():
+            conn = None
+            try:
+                conn = self.conectar()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    for canal in self.canales:
+                        cursor.execute(f"LISTEN {canal}")
+                if self.al_reconectar:
+                    self.al_reconectar()
+
+                while not self._parar.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        aviso = conn.notifies.pop(0)
+                        try:
+                            self.al_notificar(aviso.channel, aviso.payload)
+                        except Exception as e:
+                            log.exception("Error procesando NOTIFY %s: %s", aviso.channel, e)
+            except psycopg2.Error as e:
+                log.warning("LISTEN caído (%s), reconectando en %ss...", e, self.espera_reconexion_s)
+                time.sleep(self.espera_reconexion_s)
+            finally:
+                if conn is not None:
+                    conn.close()
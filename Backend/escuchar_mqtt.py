@@ -1,6 +1,7 @@
-import base64
 import paho.mqtt.client as mqtt
 
+import decodificacion
+
 # Configuración del broker
 MQTT_BROKER = "IP_SERVER"
 MQTT_PORT = PUERTO
@@ -9,12 +10,7 @@ MQTT_TOPIC = "ubi/campers"
 CLAVE_XOR = "CLAVE"
 
 def descifrar_csv(b64_encoded, clave=CLAVE_XOR):
-    try:
-        cifrado = base64.b64decode(b64_encoded).decode()
-        plano = ''.join(chr(ord(c) ^ ord(clave[i % len(clave)])) for i, c in enumerate(cifrado))
-        return plano
-    except Exception as e:
-        return f"[ERROR DESCIFRANDO] {e}"
+    return decodificacion.descifrar_csv(b64_encoded, clave)
 
 def on_connect(client, userdata, flags, rc):
     print("Conectado al broker MQTT. Código de estado:", rc)
@@ -0,0 +1,147 @@
+"""Último estado conocido de cada dispositivo (última posición + movimiento).
+
+El consumidor MQTT lo escribe en `estado_dispositivo` dentro de la misma
+transacción que inserta los fixes y avisa por NOTIFY con la fila guardada en
+JSON (ver `estado_de_aviso`). La API lo mantiene en memoria
+(`EstadosRecientes`) aplicando esos avisos, así que solo lee
+estado_dispositivo en arranque en frío o al reconectar el LISTEN.
+"""
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import psycopg2.extras
+
+CANAL_ESTADO = "estado_dispositivo"
+
+ESTADO_MOVIMIENTO = "Movimiento"
+ESTADO_REPOSO = "Reposo"
+
+COLUMNAS = ("usuario_id", "hora_utc", "latitud", "longitud", "altitud", "hdop",
+            "en_movimiento", "recibido_en", "estado", "ultima_vez_en_movimiento")
+# En el aviso van como microsegundos desde 1970: exactos y sin depender de
+# cómo formatee las fechas Postgres o de qué acepte fromisoformat
+COLUMNAS_FECHA = ("recibido_en", "ultima_vez_en_movimiento")
+_EPOCA = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def crear_tabla_estado(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS estado_dispositivo (
+            usuario_id BIGINT PRIMARY KEY,
+            hora_utc TEXT,
+            latitud DOUBLE PRECISION,
+            longitud DOUBLE PRECISION,
+            altitud DOUBLE PRECISION,
+            hdop DOUBLE PRECISION,
+            en_movimiento INTEGER,
+            recibido_en TIMESTAMPTZ NOT NULL,
+            estado TEXT NOT NULL,
+            ultima_vez_en_movimiento TIMESTAMPTZ
+        )
+    ''')
+
+
+# El WHERE evita que un fix más antiguo (reintento, reproducción) pise a uno
+# más reciente ya guardado.
+_ACTUALIZAR = f"""
+        ON CONFLICT (usuario_id) DO UPDATE SET
+            {", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNAS[1:])}
+        WHERE estado_dispositivo.recibido_en <= EXCLUDED.recibido_en"""
+
+
+def _campo_aviso(columna):
+    if columna in COLUMNAS_FECHA:
+        return f"'{columna}', (EXTRACT(EPOCH FROM {columna}) * 1000000)::bigint"
+    if columna == "hora_utc":
+        return "'hora_utc', hora_utc::text"
+    return f"'{columna}', {columna}"
+
+
+# Un NOTIFY por fila que de verdad se ha guardado (el WHERE de _ACTUALIZAR
+# puede saltarse alguna), con la fila entera: unos 300 bytes, lejos del límite
+# de 8000 de pg_notify.
+_AVISAR = f"""
+    RETURNING {", ".join(COLUMNAS)}
+)
+SELECT pg_notify('{CANAL_ESTADO}', json_build_object({", ".join(_campo_aviso(c) for c in COLUMNAS)})::text)
+FROM guardados"""
+
+
+def estado_de_aviso(payload):
+    """La fila de estado_dispositivo (dict) que viene en un NOTIFY de CANAL_ESTADO."""
+    estado = json.loads(payload)
+    # JSON no distingue 40 de 40.0: que salgan igual que leídas con psycopg2
+    for columna in ("latitud", "longitud", "altitud", "hdop"):
+        if estado[columna] is not None:
+            estado[columna] = float(estado[columna])
+    for columna in COLUMNAS_FECHA:
+        if estado[columna] is not None:
+            estado[columna] = _EPOCA + timedelta(microseconds=estado[columna])
+    return estado
+
+
+def guardar_estados(cursor, filas):
+    """Upsert de `filas` (tuplas en el orden de COLUMNAS) y NOTIFY con cada fila guardada."""
+    if not filas:
+        return
+    psycopg2.extras.execute_values(cursor, f'''
+        WITH guardados AS (
+            INSERT INTO estado_dispositivo ({", ".join(COLUMNAS)})
+            VALUES %s
+            {_ACTUALIZAR}
+        {_AVISAR}
+    ''', filas, page_size=len(filas))
+
+
+async def guardar_estados_asyncpg(conn, filas):
+    """guardar_estados para una conexión de asyncpg (ingesta_async.py)."""
+    if not filas:
+        return
+    await conn.execute(f'''
+        WITH guardados AS (
+            INSERT INTO estado_dispositivo ({", ".join(COLUMNAS)})
+            SELECT * FROM unnest($1::bigint[], $2::text[], $3::float8[], $4::float8[], $5::float8[],
+                                 $6::float8[], $7::integer[], $8::timestamptz[], $9::text[], $10::timestamptz[])
+            {_ACTUALIZAR}
+        {_AVISAR}
+    ''', *(list(columna) for columna in zip(*filas)))
+
+
+class EstadosRecientes:
+    """Cache en memoria usuario_id -> fila de estado_dispositivo (dict)."""
+
+    def __init__(self):
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, conn, usuario_id):
+        estado = self._datos.get(usuario_id)
+        if estado is None:
+            estado = self.refrescar(conn, usuario_id)
+        return estado
+
+    def refrescar(self, conn, usuario_id):
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(f'''
+            SELECT {", ".join(c for c in COLUMNAS if c != "hora_utc")}, hora_utc::text AS hora_utc
+            FROM estado_dispositivo WHERE usuario_id = %s
+        ''', (usuario_id,))
+        fila = cur.fetchone()
+        if fila is None:
+            return None
+        return self.aplicar(fila)
+
+    def aplicar(self, estado):
+        """Guarda `estado` salvo que ya haya uno más reciente; devuelve el que queda."""
+        usuario_id = estado["usuario_id"]
+        with self._lock:
+            actual = self._datos.get(usuario_id)
+            # Un refresco y un aviso a la vez: gana el fix más reciente
+            if actual is None or actual["recibido_en"] <= estado["recibido_en"]:
+                self._datos[usuario_id] = estado
+            return self._datos[usuario_id]
+
+    def vaciar(self):
+        with self._lock:
+            self._datos.clear()
@@ -0,0 +1,237 @@
+"""Funciones geográficas compartidas por el consumidor, la API y los scripts.
+
+Las versiones `_vec` trabajan sobre arrays de NumPy de una vez; `haversine`
+es la escalar, para el camino de un punto cada vez en la ingesta. Las
+distancias van en km y las coordenadas en grados.
+"""
+import heapq
+from math import radians, cos, sin, asin, sqrt
+
+import numpy as np
+
+R_TIERRA_KM = 6371.0
+
+# Filtro de ruido GPS para el cómputo de distancias: con el vehículo parado el
+# fix baila unos metros y, sumado fix a fix, acaba dando kilómetros fantasma.
+UMBRAL_JITTER_M = 20.0
+HDOP_MAX = 5.5
+
+# filtrar_jitter: candidatos que se comprueban con haversine escalar antes de
+# pasar a bloques vectorizados
+UNO_A_UNO = 8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
+    return 2 * R_TIERRA_KM * asin(sqrt(a))
+
+
+def haversine_vec(lat1, lon1, lat2, lon2):
+    """Haversine elemento a elemento (admite escalares mezclados con arrays)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * R_TIERRA_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def tramos(lat, lon):
+    """Distancia de cada punto al siguiente: array de len(lat) - 1."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lat) < 2:
+        return np.zeros(0)
+    return haversine_vec(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def distancia_acumulada(lat, lon):
+    """Km recorridos hasta cada punto (el primero vale 0)."""
+    return np.concatenate(([0.0], np.cumsum(tramos(lat, lon))))
+
+
+def longitud_ruta(lat, lon):
+    return float(tramos(lat, lon).sum())
+
+
+def bbox(lat, lon):
+    """(lat_min, lon_min, lat_max, lon_max), o None si no hay puntos."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if not len(lat):
+        return None
+    return float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max())
+
+
+def filtrar_jitter(lat, lon, hdop=None, umbral_m=UMBRAL_JITTER_M, hdop_max=HDOP_MAX, ancla=None):
+    """Puntos que cuentan para la distancia: (máscara booleana, última ancla).
+
+    Se descartan los fixes con hdop >= hdop_max. De los demás, un punto solo se
+    acepta si está al menos a `umbral_m` del último aceptado (el ancla); así el
+    baile de un GPS parado no suma nada. `ancla` permite continuar un flujo
+    partido en trozos (lat, lon del último aceptado del trozo anterior).
+
+    Es la misma regla que aplica `distancias.AcumuladorDistancias` punto a
+    punto. Los tramos largos seguidos se aceptan en bloque; solo las paradas
+    se recorren, y a saltos de tamaño creciente.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    mascara = np.zeros(len(lat), dtype=bool)
+
+    if hdop is None:
+        idx = np.arange(len(lat))
+    else:
+        # NaN (hdop desconocido) no se descarta
+        idx = np.flatnonzero(~(np.asarray(hdop, dtype=np.float64) >= hdop_max))
+    if not len(idx):
+        return mascara, ancla
+
+    la, lo = lat[idx], lon[idx]
+    m = len(idx)
+    umbral_km = umbral_m / 1000.0
+    aceptado = np.zeros(m, dtype=bool)
+
+    # paso[i]: distancia del candidato i-1 al i (para i = 0, desde el ancla)
+    paso = np.empty(m)
+    paso[1:] = haversine_vec(la[:-1], lo[:-1], la[1:], lo[1:])
+    if ancla is None:
+        aceptado[0] = True
+        a_lat, a_lon = la[0], lo[0]
+        i = 1
+    else:
+        a_lat, a_lon = ancla
+        paso[0] = haversine(a_lat, a_lon, la[0], lo[0])
+        i = 0
+    cortos = np.flatnonzero(paso < umbral_km)
+    la_l, lo_l = la.tolist(), lo.tolist()
+
+    ancla_es_anterior = True  # el ancla es el candidato i - 1
+    while i < m:
+        if ancla_es_anterior:
+            # Todos los candidatos hasta el siguiente paso corto se aceptan
+            k = np.searchsorted(cortos, i)
+            j = int(cortos[k]) if k < len(cortos) else m
+            if j > i:
+                aceptado[i:j] = True
+                a_lat, a_lon = la[j - 1], lo[j - 1]
+            i = j + 1  # el candidato j queda a menos del umbral: descartado
+            ancla_es_anterior = False
+            continue
+
+        # Parada: buscar el primer candidato que se aleje del ancla. Lo normal
+        # es encontrarlo enseguida, así que los primeros se miran uno a uno y
+        # solo después se pasa a bloques.
+        fin = min(m, i + UNO_A_UNO)
+        while i < fin:
+            if haversine(a_lat, a_lon, la_l[i], lo_l[i]) >= umbral_km:
+                break
+            i += 1
+        if i < fin:
+            aceptado[i] = True
+            a_lat, a_lon = la_l[i], lo_l[i]
+            i += 1
+            ancla_es_anterior = True
+            continue
+
+        salto = 32
+        while i < m:
+            fin = min(m, i + salto)
+            lejos = np.flatnonzero(haversine_vec(a_lat, a_lon, la[i:fin], lo[i:fin]) >= umbral_km)
+            if len(lejos):
+                k = i + int(lejos[0])
+                aceptado[k] = True
+                a_lat, a_lon = la[k], lo[k]
+                i = k + 1
+                ancla_es_anterior = True
+                break
+            i = fin
+            salto = min(salto * 2, 65536)
+
+    mascara[idx[aceptado]] = True
+    return mascara, (float(a_lat), float(a_lon))
+
+
+def distancias_filtradas(lat, lon, hdop=None, umbral_m=UMBRAL_JITTER_M, hdop_max=HDOP_MAX, ancla=None):
+    """Km que aporta cada punto tras el filtro de jitter: (km_por_punto, última ancla).
+
+    Un punto aceptado aporta el tramo desde el anterior aceptado (o desde
+    `ancla`); los descartados aportan 0.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    mascara, nueva_ancla = filtrar_jitter(lat, lon, hdop, umbral_m, hdop_max, ancla)
+    km = np.zeros(len(lat))
+    pts = np.flatnonzero(mascara)
+    if len(pts):
+        if ancla is None:
+            origen_lat, origen_lon = lat[pts[0]], lon[pts[0]]
+        else:
+            origen_lat, origen_lon = ancla
+        prev_lat = np.concatenate(([origen_lat], lat[pts[:-1]]))
+        prev_lon = np.concatenate(([origen_lon], lon[pts[:-1]]))
+        km[pts] = haversine_vec(prev_lat, prev_lon, lat[pts], lon[pts])
+    return km, nueva_ancla
+
+
+def proyectar_m(lat, lon):
+    """Proyección equirectangular local a metros (x, y), centrada en la ruta.
+
+    Basta para medir desviaciones de unos metros dentro de una misma ruta.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    k = np.radians(1.0) * R_TIERRA_KM * 1000.0
+    lat0 = np.radians(lat.mean()) if len(lat) else 0.0
+    return lon * k * np.cos(lat0), lat * k
+
+
+def _desviacion_m(x, y, ini, fin):
+    """Distancia de los puntos ini+1..fin-1 al segmento ini-fin."""
+    px, py = x[ini + 1:fin], y[ini + 1:fin]
+    ax, ay, bx, by = x[ini], y[ini], x[fin], y[fin]
+    dx, dy = bx - ax, by - ay
+    largo2 = dx * dx + dy * dy
+    if largo2 == 0.0:
+        return np.hypot(px - ax, py - ay)
+    t = np.clip(((px - ax) * dx + (py - ay) * dy) / largo2, 0.0, 1.0)
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def simplificar(lat, lon, tolerancia_m=None, max_puntos=None):
+    """Índices (ordenados) de los puntos que quedan tras Douglas-Peucker.
+
+    Con `tolerancia_m` es el Douglas-Peucker clásico: se descartan los puntos
+    que se desvían menos de esa distancia. Con `max_puntos` se parte siempre
+    el tramo con la mayor desviación pendiente hasta llegar a ese número, así
+    que el resultado es el mismo que con la tolerancia que daría esa cantidad.
+    Se pueden combinar; sin ninguno de los dos se devuelven todos.
+    Primero y último se conservan siempre.
+    """
+    n = len(lat)
+    if n <= 2 or (tolerancia_m is None and max_puntos is None):
+        return np.arange(n)
+    x, y = proyectar_m(lat, lon)
+    tolerancia_m = 0.0 if tolerancia_m is None else tolerancia_m
+    max_puntos = n if max_puntos is None else max(2, max_puntos)
+
+    def candidato(ini, fin, cota):
+        # (-desviación, ini, fin, k): el heap saca primero la mayor. Un punto
+        # nunca pesa más que el que partió su tramo, así el orden de salida
+        # coincide con el de Douglas-Peucker por tolerancia.
+        if fin - ini < 2:
+            return None
+        d = _desviacion_m(x, y, ini, fin)
+        k = int(np.argmax(d))
+        return (-min(float(d[k]), cota), ini, fin, ini + 1 + k)
+
+    quedan = [0, n - 1]
+    pendientes = [c for c in (candidato(0, n - 1, float("inf")),) if c]
+    while pendientes and len(quedan) < max_puntos:
+        desviacion, ini, fin, k = heapq.heappop(pendientes)
+        if -desviacion <= tolerancia_m:
+            break
+        quedan.append(k)
+        for c in (candidato(ini, k, -desviacion), candidato(k, fin, -desviacion)):
+            if c:
+                heapq.heappush(pendientes, c)
+    return np.sort(np.array(quedan))
@@ -0,0 +1,152 @@
+"""Niveles del histórico de ubicaciones (ver Utils/retencion.py).
+
+    completo    ubicaciones: todos los fixes, desde historico_cortes.completo_desde
+    resumido    ubicaciones_resumidas: un fix por minuto y dispositivo, desde
+                historico_cortes.resumido_desde hasta completo_desde
+    archivo     ficheros en DIR_ARCHIVO, uno por mes y usuario, con las filas
+                resumidas anteriores a resumido_desde
+
+Un corte a NULL quiere decir que ese nivel aún no se usa. Los ficheros son
+Parquet si está instalado pyarrow y CSV comprimido con gzip si no; se leen
+los dos.
+"""
+import csv
+import gzip
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DIR_ARCHIVO = "/mnt/disk2/loc_archivo"
+
+# Ubicaciones y ubicaciones_resumidas juntas, con el nombre de la primera para
+# que las consultas de la ruta (que filtran y ordenan por ubicaciones.*) sirvan
+# tal cual. Postgres empuja los filtros a cada rama y usa sus índices.
+FUENTE_RUTA = """(
+    SELECT id, usuario_id, hora_utc, latitud, longitud, altitud, hdop, en_movimiento, recibido_en
+    FROM ubicaciones_resumidas
+    UNION ALL
+    SELECT id, usuario_id, hora_utc, latitud, longitud, altitud, hdop, en_movimiento, recibido_en
+    FROM ubicaciones
+) AS ubicaciones"""
+
+# Columnas de los ficheros. recibido_en va ya formateado (como lo devuelve la
+# API) y además en microsegundos epoch, que es lo que se usa para filtrar y
+# para el cursor.
+COLUMNAS_ARCHIVO = ("id", "hora_utc", "latitud", "longitud", "altitud", "hdop",
+                    "en_movimiento", "recibido_en", "recibido_us")
+
+Cortes = namedtuple("Cortes", "resumido_desde completo_desde")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def leer_cortes(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT resumido_desde, completo_desde FROM historico_cortes")
+    fila = cur.fetchone()
+    return Cortes(*fila) if fila else Cortes(None, None)
+
+
+def microsegundos(fecha):
+    # Como (EXTRACT(EPOCH FROM recibido_en) * 1000000)::bigint; `fecha` con zona
+    return (fecha - EPOCH) // timedelta(microseconds=1)
+
+
+def ruta_fichero(usuario_id, mes, extension, directorio=DIR_ARCHIVO):
+    return os.path.join(directorio, mes.strftime("%Y%m"), f"u{usuario_id}.{extension}")
+
+
+def escribir_fichero(usuario_id, mes, filas, directorio=DIR_ARCHIVO):
+    """Guarda `filas` (tuplas en el orden de COLUMNAS_ARCHIVO) de un usuario y mes.
+
+    Se escribe a un temporal y se renombra, así un fichero a medias nunca
+    sustituye a uno bueno. Devuelve la ruta.
+    """
+    extension = "parquet" if pyarrow else "csv.gz"
+    ruta = ruta_fichero(usuario_id, mes, extension, directorio)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = ruta + ".tmp"
+    if pyarrow:
+        tabla = pyarrow.table({c: list(v) for c, v in zip(COLUMNAS_ARCHIVO, zip(*filas))}
+                              if filas else {c: [] for c in COLUMNAS_ARCHIVO})
+        pyarrow.parquet.write_table(tabla, temporal, compression="zstd")
+    else:
+        with gzip.open(temporal, "wt", newline="") as f:
+            escritor = csv.writer(f)
+            escritor.writerow(COLUMNAS_ARCHIVO)
+            escritor.writerows(filas)
+    with open(temporal, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+    return ruta
+
+
+def _leer_csv(ruta):
+    def numero(tipo, x):
+        return tipo(x) if x != "" else None
+
+    filas = []
+    with gzip.open(ruta, "rt", newline="") as f:
+        lector = csv.reader(f)
+        next(lector)
+        for id_fila, hora, lat, lon, alt, hdop, mov, recibido, us in lector:
+            filas.append((int(id_fila), hora, float(lat), float(lon), numero(float, alt),
+                          numero(float, hdop), numero(int, mov), recibido, int(us)))
+    return filas
+
+
+def leer_fichero(usuario_id, mes, directorio=DIR_ARCHIVO):
+    """Filas archivadas de un usuario y mes, ordenadas; [] si no hay fichero."""
+    ruta = ruta_fichero(usuario_id, mes, "parquet", directorio)
+    if os.path.exists(ruta):
+        if pyarrow is None:
+            raise RuntimeError(f"{ruta} necesita pyarrow")
+        columnas = pyarrow.parquet.read_table(ruta).to_pydict()
+        return list(zip(*(columnas[c] for c in COLUMNAS_ARCHIVO)))
+    ruta = ruta_fichero(usuario_id, mes, "csv.gz", directorio)
+    if os.path.exists(ruta):
+        return _leer_csv(ruta)
+    return []
+
+
+def meses(desde, hasta):
+    """Primer día de cada mes (UTC) que toca el rango [desde, hasta]; fechas con zona."""
+    desde, hasta = desde.astimezone(timezone.utc), hasta.astimezone(timezone.utc)
+    mes = datetime(desde.year, desde.month, 1, tzinfo=timezone.utc)
+    while mes <= hasta:
+        yield mes
+        mes = datetime(mes.year + mes.month // 12, mes.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def leer_archivo(usuario_id, desde, hasta, despues=None, limite=None, directorio=DIR_ARCHIVO):
+    """Filas archivadas con desde <= recibido_en < hasta (fechas con zona), en
+    orden de (recibido_en, id).
+
+    `despues` es una clave (recibido_us, id) de cursor: solo se devuelven las
+    posteriores. Devuelve (claves, filas); las filas son dicts con las columnas
+    de la ruta de la API.
+    """
+    if despues:
+        # Los meses anteriores al cursor ni se abren
+        desde = max(desde, EPOCH + timedelta(microseconds=despues[0]))
+    desde_us, hasta_us = microsegundos(desde), microsegundos(hasta)
+    claves, filas = [], []
+    if desde_us >= hasta_us:
+        return claves, filas
+    for mes in meses(desde, hasta):
+        for id_fila, hora, lat, lon, alt, hdop, mov, recibido, us in leer_fichero(usuario_id, mes, directorio):
+            if not desde_us <= us < hasta_us or (despues and (us, id_fila) <= tuple(despues)):
+                continue
+            claves.append((us, id_fila))
+            filas.append({"hora_utc": hora or "", "latitud": lat, "longitud": lon, "altitud": alt,
+                          "hdop": hdop, "en_movimiento": mov, "recibido_en": recibido,
+                          "recibido_epoch": us / 1000000})
+            if limite and len(filas) >= limite:
+                return claves, filas
+    return claves, filas
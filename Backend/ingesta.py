@@ -0,0 +1,351 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import psycopg2
+
+import metricas
+
+log = logging.getLogger(__name__)
+
+# Las mismas en main.py e ingesta_async.py
+MENSAJES = metricas.contador("ingesta_mensajes_total", "Mensajes MQTT recibidos")
+MENSAJES_INVALIDOS = metricas.contador("ingesta_mensajes_invalidos_total",
+                                       "Mensajes que no se pudieron descifrar o parsear")
+DESCARTADOS = metricas.contador("ingesta_descartados_total",
+                                "Fixes descartados al encolar (cola llena o spool sin disco)")
+DURACION_INSERTAR = metricas.histograma("ingesta_insertar_segundos",
+                                        "Transacción de un lote de la ingesta (INSERT, estado, commit)")
+DURACION_MOVIMIENTO = metricas.histograma("ingesta_movimiento_segundos",
+                                          "Ventanas de movimiento y distancias de un lote")
+
+# Un fix GPS ya descifrado y tipado, listo para insertar
+Fix = namedtuple("Fix", "nombre hora_utc lat lon alt hdop en_mov recibido_en")
+
+
+# =======================
+# PARSEO
+# =======================
+def parsear_csv(csv, recibido_en=None):
+    campos = csv.split(',')
+    if len(campos) != 7:
+        log.warning("CSV mal formado, se esperaban 7 campos: %s", campos)
+        return None
+
+    nombre_usuario, hora_utc, lat, lon, alt, hdop, en_mov = campos
+
+    try:
+        lat, lon = float(lat), float(lon)
+        alt, hdop = float(alt), float(hdop)
+        en_mov = int(en_mov)
+    except ValueError:
+        log.warning("Error de conversión de tipos en los campos numéricos: %s", campos)
+        return None
+
+    return Fix(nombre_usuario, hora_utc, lat, lon, alt, hdop, en_mov,
+               recibido_en or datetime.now(timezone.utc))
+
+
+# =======================
+# REGISTRO DE LOTES APLICADOS
+# =======================
+# Cada lote escribe su id en lotes_ingesta dentro de la misma transacción que
+# sus filas. Si el commit falla con resultado incierto (se cae la conexión) y
+# reintentamos, el id ya existe y sabemos que el lote está aplicado: así un
+# lote nunca se inserta dos veces ni se pierde a medias.
+def crear_tabla_lotes(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lotes_ingesta (
+            id UUID PRIMARY KEY,
+            aplicado_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    ''')
+
+def purgar_lotes_antiguos(cursor, horas=24):
+    cursor.execute("DELETE FROM lotes_ingesta WHERE aplicado_en < NOW() - %s * INTERVAL '1 hour'", (horas,))
+
+
+# =======================
+# ESCRITOR POR LOTES
+# =======================
+class EscritorLotes:
+    """Vacía una cola acotada de fixes hacia PostgreSQL en lotes.
+
+    `escribir(cursor, lote)` inserta el lote dentro de una transacción abierta
+    y devuelve un resultado cualquiera; `tras_commit(lote, resultado)` se llama
+    una sola vez por lote confirmado (alertas, estado en memoria, etc.).
+
+    Con `spool` (spool.Spool ya abierto) los fixes se apuntan en disco en vez
+    de en la cola: encolar() no descarta aunque Postgres esté caído, y los
+    lotes se reintentan sin límite hasta que vuelve.
+    """
+
+    def __init__(self, pool, escribir, tras_commit=None, tam_cola=10000, tam_lote=500,
+                 max_espera_s=1.0, reintentos=5, espera_encolar_s=0.05, intervalo_metricas_s=60,
+                 metricas_extra=None, spool=None):
+        self.pool = pool
+        self.escribir = escribir
+        self.tras_commit = tras_commit
+        self.cola = queue.Queue(maxsize=tam_cola)
+        self.tam_lote = tam_lote
+        self.max_espera_s = max_espera_s
+        self.reintentos = reintentos
+        self.espera_encolar_s = espera_encolar_s
+        self.intervalo_metricas_s = intervalo_metricas_s
+        # nombre -> función que devuelve un dict, se imprime junto al resumen
+        self.metricas_extra = metricas_extra or {}
+        self.spool = spool
+        self._parar = threading.Event()
+        self._hilo = None
+        self._proximo_resumen = time.monotonic() + intervalo_metricas_s
+        self._lock_metricas = threading.Lock()
+        self.metricas = {
+            "encolados": 0,
+            "descartados_cola_llena": 0,
+            "descartados_db": 0,
+            "descartados_spool": 0,
+            "filas_escritas": 0,
+            "filas_invalidas": 0,
+            "lotes_escritos": 0,
+            "lotes_ya_aplicados": 0,
+            "reintentos": 0,
+            "profundidad_max": 0,
+            "ultimo_lote_ms": 0.0,
+        }
+
+    def _sumar(self, clave, n=1):
+        with self._lock_metricas:
+            self.metricas[clave] += n
+
+    def resumen_metricas(self):
+        with self._lock_metricas:
+            datos = dict(self.metricas)
+        datos["profundidad"] = self.cola.qsize()
+        datos["capacidad"] = self.cola.maxsize
+        return datos
+
+    # ---- lado productor (hilo MQTT) ----
+    def encolar(self, fix):
+        if self.spool:
+            try:
+                self.spool.anotar(fix)
+            except (OSError, ValueError) as e:
+                log.error("No se pudo anotar el fix en el spool: %s", e)
+                self._sumar("descartados_spool")
+                return False
+            self._sumar("encolados")
+            return True
+
+        # Backpressure: si la cola está llena esperamos un instante como mucho
+        # y después descartamos, para no bloquear el hilo de red de paho.
+        try:
+            self.cola.put(fix, timeout=self.espera_encolar_s)
+        except queue.Full:
+            self._sumar("descartados_cola_llena")
+            return False
+
+        profundidad = self.cola.qsize()
+        with self._lock_metricas:
+            self.metricas["encolados"] += 1
+            if profundidad > self.metricas["profundidad_max"]:
+                self.metricas["profundidad_max"] = profundidad
+        return True
+
+    # ---- ciclo de vida ----
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._bucle, name="escritor-lotes", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout=30):
+        """Devuelve False si el hilo escritor no terminó a tiempo."""
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+            return not self._hilo.is_alive()
+        return True
+
+    # ---- lado consumidor ----
+    def _tomar_lote(self):
+        """(lote, seqs): seqs son las posiciones en el spool, o None sin spool."""
+        if self.spool:
+            lote, seqs = self.spool.leer(self.tam_lote, 0.5)
+            limite = time.monotonic() + self.max_espera_s
+            while lote and len(lote) < self.tam_lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                mas, mas_seqs = self.spool.leer(self.tam_lote - len(lote), restante)
+                if not mas:
+                    break
+                lote += mas
+                seqs += mas_seqs
+            return lote, seqs
+
+        try:
+            primero = self.cola.get(timeout=0.5)
+        except queue.Empty:
+            return [], None
+
+        lote = [primero]
+        limite = time.monotonic() + self.max_espera_s
+        while len(lote) < self.tam_lote:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self.cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote, None
+
+    def _pendiente(self):
+        # Al parar se vacía la cola en memoria; lo que quede en el spool se
+        # reenvía al arrancar
+        return not self.spool and not self.cola.empty()
+
+    def _imprimir_metricas(self):
+        ahora = time.monotonic()
+        if ahora < self._proximo_resumen:
+            return
+        log.info("Métricas ingesta: %s", self.resumen_metricas())
+        for nombre, fuente in self.metricas_extra.items():
+            log.info("Métricas %s: %s", nombre, fuente())
+        self._proximo_resumen = ahora + self.intervalo_metricas_s
+
+    def _bucle(self):
+        proxima_purga = time.monotonic()
+
+        while not (self._parar.is_set() and not self._pendiente()):
+            # Si el hilo muriera, encolar() seguiría aceptando fixes sin que
+            # nadie los escriba: solo se sale al parar
+            try:
+                lote, seqs = self._tomar_lote()
+                if lote and self.escribir_lote(lote, seqs) is None:
+                    # Parando con Postgres caído: el resto sigue en el spool
+                    break
+
+                self._imprimir_metricas()
+                ahora = time.monotonic()
+                if ahora >= proxima_purga:
+                    self._purgar_registro()
+                    proxima_purga = ahora + 3600
+            except Exception:
+                log.exception("Error inesperado en el escritor de lotes, se sigue con el siguiente.")
+                time.sleep(1)
+
+    def _purgar_registro(self):
+        try:
+            conn = self.pool.getconn()
+        except psycopg2.Error as e:
+            log.warning("No se pudo purgar lotes_ingesta: %s", e)
+            return
+        try:
+            with conn.cursor() as cursor:
+                purgar_lotes_antiguos(cursor)
+            conn.commit()
+            self.pool.putconn(conn)
+        except psycopg2.Error as e:
+            log.warning("No se pudo purgar lotes_ingesta: %s", e)
+            self.pool.putconn(conn, close=True)
+
+    def escribir_lote(self, lote, seqs=None):
+        """Escribe `lote` con semántica exactamente-una-vez. Devuelve True si quedó
+        aplicado; None si con spool se está parando y el lote queda en él."""
+        id_lote = str(uuid.uuid4())
+        resultado = None
+        inicio = time.monotonic()
+
+        # Con spool no se descarta nada: se reintenta hasta que vuelva Postgres
+        for intento in itertools.count() if self.spool else range(self.reintentos):
+            if intento:
+                if self.spool and self._parar.is_set():
+                    return None
+                self._sumar("reintentos")
+                time.sleep(min(0.3 * 2 ** (min(intento, 10) - 1), 5))
+                if self.spool:
+                    self._imprimir_metricas()
+
+            try:
+                conn = self.pool.getconn()
+            except psycopg2.Error as e:
+                log.warning("Pool PostgreSQL sin conexión disponible: %s", e)
+                continue
+
+            inicio_intento = time.perf_counter()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("INSERT INTO lotes_ingesta (id) VALUES (%s) ON CONFLICT DO NOTHING", (id_lote,))
+                    if cursor.rowcount == 0:
+                        # Un intento anterior hizo commit aunque no llegó la confirmación
+                        conn.rollback()
+                        self.pool.putconn(conn)
+                        self._sumar("lotes_ya_aplicados")
+                        self._confirmar(lote, seqs, resultado, inicio)
+                        return True
+                    resultado = self.escribir(cursor, lote)
+                    if seqs:
+                        self.spool.registrar_confirmado(cursor, seqs[-1])
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                log.warning("PostgreSQL ocupado, reintentando lote... %s", e)
+                self.pool.putconn(conn, close=True)
+                continue
+            except psycopg2.Error as e:
+                # Error de datos: ningún reintento lo va a arreglar. Se deshace la
+                # transacción entera y se parte el lote para aislar la fila mala.
+                conn.rollback()
+                self.pool.putconn(conn)
+                return self._partir(lote, seqs, e)
+            except Exception as e:
+                # Fallo en escribir() (ventanas, distancias, viajes...) o un fix
+                # con valores imposibles: igual que un error de datos, pero la
+                # conexión se descarta porque no se sabe cómo ha quedado
+                log.exception("Error inesperado escribiendo un lote de %d filas.", len(lote))
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+                self.pool.putconn(conn, close=True)
+                return self._partir(lote, seqs, e)
+
+            DURACION_INSERTAR.observar(time.perf_counter() - inicio_intento)
+            self.pool.putconn(conn)
+            self._confirmar(lote, seqs, resultado, inicio)
+            return True
+
+        log.error("Lote de %d filas descartado tras %d intentos.", len(lote), self.reintentos)
+        self._sumar("descartados_db", len(lote))
+        return False
+
+    def _partir(self, lote, seqs, error):
+        if len(lote) == 1:
+            log.error("Fila descartada por error de datos: %s %s", lote[0], error)
+            self._sumar("filas_invalidas")
+            if seqs:
+                self.spool.confirmar(seqs[-1])
+            return False
+        mitad = len(lote) // 2
+        a = self.escribir_lote(lote[:mitad], seqs and seqs[:mitad])
+        if a is None:
+            return None
+        b = self.escribir_lote(lote[mitad:], seqs and seqs[mitad:])
+        return None if b is None else a and b
+
+    def _confirmar(self, lote, seqs, resultado, inicio):
+        if seqs:
+            self.spool.confirmar(seqs[-1])
+        with self._lock_metricas:
+            self.metricas["filas_escritas"] += len(lote)
+            self.metricas["lotes_escritos"] += 1
+            self.metricas["ultimo_lote_ms"] = round((time.monotonic() - inicio) * 1000, 1)
+
+        if self.tras_commit:
+            try:
+                self.tras_commit(lote, resultado)
+            except Exception as e:
+                log.exception("Error procesando lote confirmado: %s", e)
@@ -0,0 +1,644 @@
+"""Consumidor MQTT con asyncio: alternativa a main.py con asyncpg.
+
+    recibir      paho-mqtt sobre el bucle de asyncio -> (payload, recibido_en)
+    decodificar  descifrado y parseo por lotes (decodificacion.decodificar_lote)
+                 y reparto por dispositivo entre los escritores (reparto.particion)
+    escribir     ESCRITORES tareas, cada una con sus dispositivos: evalúa la
+                 ventana de movimiento y las distancias y escribe el lote en una
+                 transacción, con su apunte en lotes_ingesta como main.py
+    notificar    alertas de movimiento ya confirmadas -> DespachadorFCM
+
+Las etapas se pasan el trabajo por colas acotadas: si Postgres se atasca, las
+anteriores esperan y al final se deja de leer del broker, pero como mucho
+PAUSA_LECTURA_MAX_S: sin leer el socket paho no ve los PINGRESP y cortaría la
+conexión al pasar el keepalive. Si sigue atascado se vuelve a leer y lo que
+no cabe se descarta (y se cuenta): con QoS 0 el broker no guarda nada para
+nosotros mientras tanto, lo que no se lee se pierde igual. Con varios
+escritores hay varias transacciones en vuelo a la vez sin perder el orden de
+cada dispositivo. Con SIGINT/SIGTERM se deja de recibir y cada etapa vacía
+su cola antes de acabar.
+
+paho se mueve desde el bucle (add_reader/add_writer) en lugar de con su hilo
+de red: aiomqtt hace lo mismo pero gasta el doble de CPU por mensaje.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+import time
+import uuid
+from datetime import datetime, time as hora, timezone
+
+import asyncpg
+import paho.mqtt.client as mqtt
+import psycopg2
+import requests
+
+import decodificacion
+import metricas
+from cache_usuarios import CANAL_USUARIOS, CacheUsuarios
+from distancias import AcumuladorDistancias, cargar_anclas, crear_tabla_distancias
+from estado_reciente import ESTADO_MOVIMIENTO, ESTADO_REPOSO, crear_tabla_estado, guardar_estados_asyncpg
+from ingesta import (DESCARTADOS, DURACION_INSERTAR, DURACION_MOVIMIENTO, MENSAJES, MENSAJES_INVALIDOS, Fix,
+                     crear_tabla_lotes)
+from movimiento import MOVIMIENTO_NUEVO, MOVIMIENTO_REPETIDO, VentanaMovimiento, cargar_ventanas, segundos_del_dia
+from notificaciones import DespachadorFCM, TokenCuentaServicio
+from reparto import particion
+from tiempos import cargar_tiempos, guardar_tiempos_asyncpg
+from viajes import AcumuladorViajes, cargar_segmentadores
+
+
+# Configuración del broker
+MQTT_BROKER = "IP_SERVER"
+MQTT_PORT = PORT
+MQTT_TOPIC = "ubi/campers"
+MQTT_USER = "USER"
+MQTT_PASS = "PASSWD"
+MQTT_KEEPALIVE_S = 60
+SERVICE_ACCOUNT_FILE = '/mnt/disk2/../../../api/loc_acc_file/xxx.json'
+PROJECT_ID = 'ID'
+
+# Clave de cifrado usada en el ESP32
+CLAVE_XOR = "CLAVE"
+
+PG_CONFIG = {
+    "host": "SERVERIP",
+    "port": PORT,
+    "dbname": "DBNAME",
+    "user": "DBUSER",
+    "password": "PASSWD"
+}
+
+# Pipeline
+ESCRITORES = 4                 # transacciones en vuelo a la vez
+TAM_COLA = 10000               # por cola entre etapas
+TAM_LOTE_DECODIFICAR = 1000
+# paho lee un mensaje por vuelta del bucle: se espera un poco a juntar un lote
+ESPERA_DECODIFICAR_S = 0.005
+# Con la cola de recibidos llena se deja de leer el socket como mucho esto
+# (por debajo del keepalive); después se lee y se descarta lo que no quepa
+PAUSA_LECTURA_MAX_S = MQTT_KEEPALIVE_S / 2
+INGESTA_TAM_LOTE = 500
+INGESTA_MAX_ESPERA_S = 1.0
+INGESTA_REINTENTOS = 5
+INTERVALO_METRICAS_S = 60
+# /metrics (ver metricas.py); 0 para no servirlas
+METRICAS_PUERTO = 9108
+
+FCM_TAM_COLA = 1000
+FCM_MAX_POR_SEGUNDO = 20
+FCM_REINTENTOS = 4
+
+CACHE_USUARIOS_MAX = 10000
+CACHE_USUARIOS_TTL_S = 600
+
+PARTICIONES_MESES_ADELANTE = 2
+PARTICIONES_INTERVALO_S = 6 * 3600
+
+# Desfase e intervalo de cada dispositivo (ver tiempos.py); su fila en
+# tiempos_flota es la de este nombre
+TIEMPOS_INTERVALO_S = 60
+TIEMPOS_PROCESO = "ingesta_async"
+
+COLUMNAS_UBICACIONES = ("usuario_id", "hora_utc", "latitud", "longitud", "altitud", "hdop",
+                        "en_movimiento", "recibido_en")
+# Errores de conexión: el lote se reintenta entero con el mismo id
+ERRORES_CONEXION = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, ConnectionError, OSError,
+                    asyncio.TimeoutError)
+
+log = logging.getLogger("consumidor")
+
+DURACION_DECODIFICAR_LOTE = metricas.histograma("ingesta_decodificar_lote_segundos",
+                                                "Descifrar y parsear un lote de mensajes")
+
+
+def config_asyncpg():
+    config = dict(PG_CONFIG)
+    config["database"] = config.pop("dbname")
+    return config
+
+
+def inicializar():
+    """Esquema y estado en memoria, con psycopg2 antes de arrancar el bucle
+    (las mismas funciones que main.py)."""
+    conn = psycopg2.connect(**PG_CONFIG)
+    try:
+        with conn.cursor() as cursor:
+            crear_tabla_lotes(cursor)
+            crear_tabla_estado(cursor)
+            crear_tabla_distancias(cursor)
+        conn.commit()
+        with conn.cursor() as cursor:
+            ventanas = cargar_ventanas(cursor)
+            anclas = cargar_anclas(cursor)
+            segmentadores = cargar_segmentadores(cursor)
+            tiempos = cargar_tiempos(cursor, TIEMPOS_PROCESO)
+        conn.rollback()
+    finally:
+        conn.close()
+    log.info("Ventanas de movimiento cargadas para %d dispositivos.", len(ventanas))
+    return ventanas, anclas, segmentadores, tiempos
+
+
+def crear_despachador_fcm():
+    # El envío sigue en el hilo del despachador: enviar() solo encola
+    session = requests.Session()
+    token = TokenCuentaServicio(SERVICE_ACCOUNT_FILE, session)
+    return DespachadorFCM(
+        PROJECT_ID, token, session=session,
+        tam_cola=FCM_TAM_COLA,
+        max_por_segundo=FCM_MAX_POR_SEGUNDO,
+        reintentos=FCM_REINTENTOS,
+    )
+
+
+def a_hora(segundos):
+    return None if segundos is None else hora(segundos // 3600, segundos // 60 % 60, segundos % 60)
+
+
+async def resolver_usuarios(conn, nombres):
+    filas = await conn.fetch("SELECT nombre, id, fcm_token FROM usuarios WHERE nombre = ANY($1::text[])",
+                             list(nombres))
+    usuarios = {f["nombre"]: (f["id"], f["fcm_token"]) for f in filas}
+    for nombre in nombres:
+        if nombre not in usuarios:
+            usuario_id = await conn.fetchval(
+                "INSERT INTO usuarios (nombre, contraseña, correo) VALUES ($1, $2, $3) RETURNING id",
+                nombre, "default", "sin@email.com")
+            usuarios[nombre] = (usuario_id, None)
+    return usuarios
+
+
+class ConsumidorAsync:
+    def __init__(self, pool, ventanas, anclas, segmentadores, tiempos, despachador_fcm, escritores=ESCRITORES):
+        self.pool = pool
+        self.ventanas = ventanas
+        self.anclas = anclas
+        self.segmentadores = segmentadores
+        self.tiempos = tiempos
+        self.despachador_fcm = despachador_fcm
+        self.cache_usuarios = CacheUsuarios(CACHE_USUARIOS_MAX, CACHE_USUARIOS_TTL_S)
+        self.cola_recibidos = asyncio.Queue(TAM_COLA)
+        self._mqtt = None                # (cliente, socket) mientras hay conexión
+        self._lectura_pausada = False
+        self._fin_pausa = None           # call_later que acaba la pausa de lectura
+        self._descartando = False        # pausa agotada: lo que no cabe se descarta
+        self.colas_escritura = [asyncio.Queue(TAM_COLA) for _ in range(escritores)]
+        self.cola_notificar = asyncio.Queue(FCM_TAM_COLA)
+        self.metricas = {
+            "recibidos": 0,
+            "descartados_cola_llena": 0,
+            "pausas_lectura": 0,
+            "descartados_decodificar": 0,
+            "filas_escritas": 0,
+            "filas_invalidas": 0,
+            "lotes_escritos": 0,
+            "lotes_ya_aplicados": 0,
+            "reintentos": 0,
+            "descartados_db": 0,
+            "ultimo_lote_ms": 0.0,
+        }
+
+    def resumen_metricas(self):
+        datos = dict(self.metricas)
+        datos["cola_recibidos"] = self.cola_recibidos.qsize()
+        datos["colas_escritura"] = [c.qsize() for c in self.colas_escritura]
+        datos["cola_notificar"] = self.cola_notificar.qsize()
+        return datos
+
+    # ---- recibir ----
+    async def recibir(self):
+        loop = asyncio.get_running_loop()
+        cliente = mqtt.Client()
+        cliente.username_pw_set(MQTT_USER, MQTT_PASS)
+        desconexion = None
+
+        def on_connect(client, userdata, flags, rc):
+            log.info("Conectado al broker MQTT. Código de estado: %s", rc)
+            client.subscribe(MQTT_TOPIC)
+
+        def on_disconnect(client, userdata, rc):
+            if desconexion is not None and not desconexion.done():
+                desconexion.set_result(rc)
+
+        def on_message(client, userdata, msg):
+            self.metricas["recibidos"] += 1
+            MENSAJES.inc()
+            if self.cola_recibidos.full():
+                # Solo tras agotar la pausa (o con paquetes que paho ya tenía leídos)
+                self.metricas["descartados_cola_llena"] += 1
+                DESCARTADOS.inc()
+                return
+            # recibido_en al recibir, como en main.py: no al escribir
+            self.cola_recibidos.put_nowait((msg.payload, datetime.now(timezone.utc)))
+            if self.cola_recibidos.full() and not self._descartando:
+                # Cola llena: no se lee más del socket hasta que decodificar
+                # haga sitio o pase PAUSA_LECTURA_MAX_S
+                self._pausar_lectura()
+
+        def on_socket_open(client, userdata, sock):
+            self._mqtt = (client, sock)
+            if not self._lectura_pausada:
+                loop.add_reader(sock, client.loop_read)
+
+        def on_socket_close(client, userdata, sock):
+            self._mqtt = None
+            loop.remove_reader(sock)
+            loop.remove_writer(sock)
+
+        cliente.on_connect = on_connect
+        cliente.on_disconnect = on_disconnect
+        cliente.on_message = on_message
+        cliente.on_socket_open = on_socket_open
+        cliente.on_socket_close = on_socket_close
+        cliente.on_socket_register_write = lambda client, userdata, sock: loop.add_writer(sock, client.loop_write)
+        cliente.on_socket_unregister_write = lambda client, userdata, sock: loop.remove_writer(sock)
+
+        try:
+            while True:
+                desconexion = loop.create_future()
+                try:
+                    # Solo bloquea el bucle mientras se abre la conexión TCP
+                    cliente.connect(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE_S)
+                except OSError as e:
+                    log.warning("No se pudo conectar al broker (%s), reintentando en 5 s...", e)
+                    await asyncio.sleep(5)
+                    continue
+                while not desconexion.done():
+                    # Keepalive y reintentos de paho
+                    cliente.loop_misc()
+                    await asyncio.wait([desconexion], timeout=1)
+                log.warning("Conexión MQTT perdida (código %s), reconectando en 5 s...", desconexion.result())
+                await asyncio.sleep(5)
+        finally:
+            if self._mqtt is not None:
+                cliente.disconnect()
+                cliente.loop_write()
+
+    def _pausar_lectura(self):
+        self._lectura_pausada = True
+        self.metricas["pausas_lectura"] += 1
+        loop = asyncio.get_running_loop()
+        self._fin_pausa = loop.call_later(PAUSA_LECTURA_MAX_S, self._agotar_pausa)
+        if self._mqtt is not None:
+            loop.remove_reader(self._mqtt[1])
+
+    def _agotar_pausa(self):
+        log.warning("Cola de recibidos llena durante %.0f s: se vuelve a leer del broker y se descarta lo que "
+                    "no quepa.", PAUSA_LECTURA_MAX_S)
+        self._descartando = True
+        self._reanudar_lectura()
+
+    def _reanudar_lectura(self):
+        self._lectura_pausada = False
+        if self._fin_pausa is not None:
+            self._fin_pausa.cancel()
+            self._fin_pausa = None
+        if self._mqtt is not None:
+            cliente, sock = self._mqtt
+            asyncio.get_running_loop().add_reader(sock, cliente.loop_read)
+
+    # ---- decodificar ----
+    async def decodificar(self):
+        fin = False
+        while not fin:
+            recibidos = [await self.cola_recibidos.get()]
+            if recibidos[0] is not None and self.cola_recibidos.qsize() < TAM_LOTE_DECODIFICAR:
+                await asyncio.sleep(ESPERA_DECODIFICAR_S)
+            while len(recibidos) < TAM_LOTE_DECODIFICAR and not self.cola_recibidos.empty() \
+                    and recibidos[-1] is not None:
+                recibidos.append(self.cola_recibidos.get_nowait())
+            if self._lectura_pausada and not self.cola_recibidos.full():
+                self._reanudar_lectura()
+            if self._descartando and self.cola_recibidos.qsize() < TAM_COLA // 2:
+                # Con margen: si no, cada hueco que hiciera decodificar dejaría
+                # leer un paquete antes de otra pausa entera
+                self._descartando = False
+            if recibidos[-1] is None:
+                recibidos.pop()
+                fin = True
+
+            inicio = time.perf_counter()
+            columnas, indices, errores = decodificacion.decodificar_lote([p for p, _ in recibidos], CLAVE_XOR)
+            DURACION_DECODIFICAR_LOTE.observar(time.perf_counter() - inicio)
+            for _, motivo in errores:
+                log.warning("Mensaje descartado: %s", motivo)
+            self.metricas["descartados_decodificar"] += len(errores)
+            MENSAJES_INVALIDOS.inc(len(errores))
+            for j, i in enumerate(indices):
+                fix = Fix(columnas.nombre[j], columnas.hora_utc[j], columnas.lat[j], columnas.lon[j],
+                          columnas.alt[j], columnas.hdop[j], columnas.en_mov[j], recibidos[i][1])
+                await self.colas_escritura[particion(fix.nombre, len(self.colas_escritura))].put(fix)
+
+        for cola in self.colas_escritura:
+            await cola.put(None)
+
+    # ---- escribir ----
+    async def _tomar_lote(self, cola):
+        """(lote, fin): hasta INGESTA_TAM_LOTE fixes o lo que llegue en INGESTA_MAX_ESPERA_S."""
+        primero = await cola.get()
+        if primero is None:
+            return [], True
+        lote = [primero]
+        limite = time.monotonic() + INGESTA_MAX_ESPERA_S
+        while len(lote) < INGESTA_TAM_LOTE:
+            if cola.empty():
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    fix = await asyncio.wait_for(cola.get(), restante)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                fix = cola.get_nowait()
+            if fix is None:
+                return lote, True
+            lote.append(fix)
+        return lote, False
+
+    async def escribir(self, indice):
+        cola = self.colas_escritura[indice]
+        fin = False
+        while not fin:
+            lote, fin = await self._tomar_lote(cola)
+            if lote:
+                await self.escribir_lote(lote)
+
+    async def escribir_lote(self, lote):
+        """Escribe `lote` con semántica exactamente-una-vez (ver ingesta.EscritorLotes)."""
+        id_lote = uuid.uuid4()
+        resultado = None
+        inicio = time.monotonic()
+
+        for intento in range(INGESTA_REINTENTOS):
+            if intento:
+                self.metricas["reintentos"] += 1
+                await asyncio.sleep(min(0.3 * 2 ** (intento - 1), 5))
+            inicio_intento = time.perf_counter()
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        aplicado = await conn.fetchval(
+                            "INSERT INTO lotes_ingesta (id) VALUES ($1) ON CONFLICT DO NOTHING RETURNING TRUE",
+                            id_lote)
+                        if aplicado:
+                            resultado = await self._escribir(conn, lote)
+                if not aplicado:
+                    # Un intento anterior hizo commit aunque no llegó la confirmación
+                    self.metricas["lotes_ya_aplicados"] += 1
+            except asyncpg.DataError as e:
+                # Valor que asyncpg no sabe codificar: como un error de datos
+                return await self._partir(lote, e)
+            except ERRORES_CONEXION as e:
+                log.warning("PostgreSQL ocupado, reintentando lote... %s", e)
+                continue
+            except asyncpg.PostgresError as e:
+                return await self._partir(lote, e)
+
+            DURACION_INSERTAR.observar(time.perf_counter() - inicio_intento)
+            await self._confirmar(lote, resultado, inicio)
+            return True
+
+        log.error("Lote de %d filas descartado tras %d intentos.", len(lote), INGESTA_REINTENTOS)
+        self.metricas["descartados_db"] += len(lote)
+        return False
+
+    async def _partir(self, lote, error):
+        # Ningún reintento lo va a arreglar: se parte el lote para aislar la fila mala
+        if len(lote) == 1:
+            log.error("Fila descartada por error de datos: %s %s", lote[0], error)
+            self.metricas["filas_invalidas"] += 1
+            return False
+        mitad = len(lote) // 2
+        a = await self.escribir_lote(lote[:mitad])
+        b = await self.escribir_lote(lote[mitad:])
+        return a and b
+
+    async def _escribir(self, conn, lote):
+        # Lo mismo que main.escribir_lote: ventanas, anclas y viajes se
+        # evalúan sobre copias y solo se aplican tras el commit
+        generacion = self.cache_usuarios.generacion()
+        usuarios, faltan = {}, set()
+        for nombre in {fix.nombre for fix in lote}:
+            valor = self.cache_usuarios.obtener(nombre)
+            if valor:
+                usuarios[nombre] = valor
+            else:
+                faltan.add(nombre)
+        leidos = await resolver_usuarios(conn, faltan) if faltan else {}
+        usuarios.update(leidos)
+        usuario_ids = [usuarios[fix.nombre][0] for fix in lote]
+        segundos = [segundos_del_dia(fix.hora_utc) for fix in lote]
+
+        await conn.copy_records_to_table("ubicaciones", columns=COLUMNAS_UBICACIONES, records=[
+            (uid, a_hora(seg), fix.lat, fix.lon, fix.alt, fix.hdop, fix.en_mov, fix.recibido_en)
+            for uid, fix, seg in zip(usuario_ids, lote, segundos)
+        ])
+
+        inicio = time.perf_counter()
+        ventanas_lote, ultimos, movimientos = {}, {}, []
+        distancias = AcumuladorDistancias(self.anclas)
+        viajes = AcumuladorViajes(self.segmentadores)
+        for uid, fix, seg in zip(usuario_ids, lote, segundos):
+            ventana = ventanas_lote.get(fix.nombre)
+            if ventana is None:
+                actual = self.ventanas.get(fix.nombre)
+                ventana = ventanas_lote[fix.nombre] = actual.copia() if actual else VentanaMovimiento()
+            movimientos.append(ventana.registrar(seg, fix.en_mov, fix.hdop, fix.recibido_en))
+            distancias.sumar(fix.nombre, uid, fix.recibido_en.date(), fix.lat, fix.lon, fix.hdop)
+            viajes.registrar(fix.nombre, uid, fix.recibido_en, fix.lat, fix.lon, fix.hdop, fix.en_mov)
+            ultimos[fix.nombre] = (uid, fix)
+        DURACION_MOVIMIENTO.observar(time.perf_counter() - inicio)
+
+        await distancias.guardar_asyncpg(conn)
+        await viajes.guardar_asyncpg(conn)
+        await guardar_estados_asyncpg(conn, [
+            (uid, fix.hora_utc, fix.lat, fix.lon, fix.alt, fix.hdop, fix.en_mov, fix.recibido_en,
+             ESTADO_MOVIMIENTO if ventanas_lote[nombre].en_movimiento() else ESTADO_REPOSO,
+             ventanas_lote[nombre].ultima_vez_mov)
+            for nombre, (uid, fix) in ultimos.items()
+        ])
+        return usuarios, leidos, generacion, ventanas_lote, distancias.anclas, viajes.segmentadores, movimientos
+
+    async def _confirmar(self, lote, resultado, inicio):
+        self.metricas["filas_escritas"] += len(lote)
+        self.metricas["lotes_escritos"] += 1
+        self.metricas["ultimo_lote_ms"] = round((time.monotonic() - inicio) * 1000, 1)
+        if resultado is None:
+            return
+        usuarios, leidos, generacion, ventanas_lote, anclas_lote, segmentadores_lote, movimientos = resultado
+        for nombre, valor in leidos.items():
+            self.cache_usuarios.poner(nombre, valor, generacion)
+        self.ventanas.update(ventanas_lote)
+        self.anclas.update(anclas_lote)
+        self.segmentadores.update(segmentadores_lote)
+        self.tiempos.registrar_lote([usuarios[fix.nombre][0] for fix in lote], lote)
+
+        log.debug("Lote de %d fixes insertado.", len(lote))
+        for fix, estado in zip(lote, movimientos):
+            if estado is not None:
+                await self.cola_notificar.put((fix, estado, usuarios[fix.nombre][1]))
+
+    # ---- notificar ----
+    async def notificar(self):
+        while True:
+            item = await self.cola_notificar.get()
+            if item is None:
+                break
+            fix, estado, fcm_token = item
+            log.info("Movimiento detectado para usuario %s", fix.nombre)
+            if estado == MOVIMIENTO_REPETIDO:
+                log.info("Ya había movimiento antes, no se envía notificación repetida.")
+            elif estado == MOVIMIENTO_NUEVO:
+                if fcm_token:
+                    self.despachador_fcm.enviar(
+                        fcm_token,
+                        "Alerta de movimiento",
+                        "Se detectó movimiento en tu vehículo, por favor revísalo."
+                    )
+                else:
+                    log.info("No hay token FCM registrado para este usuario.")
+
+    # ---- tareas de fondo ----
+    async def escuchar_usuarios(self):
+        # Como escucha_pg.EscuchaPostgres: si se pierde el LISTEN no sabemos
+        # qué cambió, así que al (re)conectar se vacía la cache entera
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(**config_asyncpg())
+                perdida = asyncio.Event()
+                conn.add_termination_listener(lambda _: perdida.set())
+                await conn.add_listener(CANAL_USUARIOS,
+                                        lambda _c, _pid, _canal, nombre: self.cache_usuarios.invalidar(nombre or None))
+                self.cache_usuarios.invalidar()
+                while not perdida.is_set():
+                    try:
+                        await asyncio.wait_for(perdida.wait(), 30)
+                    except asyncio.TimeoutError:
+                        await conn.execute("SELECT 1")
+                log.warning("Escucha de %s perdida, reconectando...", CANAL_USUARIOS)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                log.warning("Escucha de %s caída (%s), reconectando...", CANAL_USUARIOS, e)
+            finally:
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(5)
+
+    async def guardar_tiempos(self):
+        filas, fila_flota, cambiados = self.tiempos.tomar()
+        if not cambiados:
+            return
+        try:
+            async with self.pool.acquire() as conn:
+                await guardar_tiempos_asyncpg(conn, filas, fila_flota)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            log.warning("No se pudieron guardar los tiempos de los dispositivos: %s", e)
+            self.tiempos.devolver(cambiados)
+
+    async def mantenimiento(self):
+        proxima_purga = proximas_particiones = 0.0
+        proximos_tiempos = time.monotonic() + TIEMPOS_INTERVALO_S
+        while True:
+            await asyncio.sleep(INTERVALO_METRICAS_S)
+            log.info("Métricas ingesta: %s", self.resumen_metricas())
+            log.info("Métricas cache_usuarios: %s", self.cache_usuarios.resumen_metricas())
+            log.info("Métricas fcm: %s", self.despachador_fcm.resumen_metricas())
+            log.info("Métricas tiempos: %s", self.tiempos.resumen_metricas())
+            ahora = time.monotonic()
+            if ahora >= proximos_tiempos:
+                proximos_tiempos = ahora + TIEMPOS_INTERVALO_S
+                await self.guardar_tiempos()
+            try:
+                if ahora >= proxima_purga:
+                    await self.pool.execute("DELETE FROM lotes_ingesta WHERE aplicado_en < NOW() - INTERVAL '24 hours'")
+                    proxima_purga = ahora + 3600
+                if ahora >= proximas_particiones:
+                    proximas_particiones = ahora + PARTICIONES_INTERVALO_S
+                    creadas = await self.pool.fetchval("SELECT asegurar_particiones_ubicaciones($1)",
+                                                       PARTICIONES_MESES_ADELANTE)
+                    if creadas:
+                        log.info("Creadas %d particiones nuevas de ubicaciones.", creadas)
+            except asyncpg.UndefinedFunctionError:
+                log.warning("ubicaciones aún no está particionada (falta la migración 0003).")
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                log.error("Error en el mantenimiento de la ingesta: %s", e)
+
+    # ---- ciclo de vida ----
+    async def ejecutar(self):
+        """Hasta SIGINT/SIGTERM; luego vacía el pipeline etapa a etapa.
+        Devuelve False si alguna etapa se cayó."""
+        parar = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for senal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(senal, parar.set)
+
+        fondo = [asyncio.create_task(self.escuchar_usuarios()), asyncio.create_task(self.mantenimiento())]
+        recibir = asyncio.create_task(self.recibir())
+        decodificar = asyncio.create_task(self.decodificar())
+        escritores = [asyncio.create_task(self.escribir(i)) for i in range(len(self.colas_escritura))]
+        notificar = asyncio.create_task(self.notificar())
+        etapas = [recibir, decodificar, *escritores, notificar]
+
+        esperar_parada = asyncio.create_task(parar.wait())
+        hechas, _ = await asyncio.wait([esperar_parada, *etapas], return_when=asyncio.FIRST_COMPLETED)
+        bien = esperar_parada in hechas
+        if not bien:
+            for tarea in hechas:
+                log.error("Etapa de la ingesta caída: %r", tarea.exception())
+            for tarea in etapas + fondo + [esperar_parada]:
+                tarea.cancel()
+            await asyncio.gather(*etapas, *fondo, esperar_parada, return_exceptions=True)
+            return False
+
+        log.info("Parando: se vacían las colas...")
+        recibir.cancel()
+        await asyncio.gather(recibir, return_exceptions=True)
+        await self.cola_recibidos.put(None)
+        await decodificar
+        await asyncio.gather(*escritores)
+        await self.cola_notificar.put(None)
+        await notificar
+        for tarea in fondo:
+            tarea.cancel()
+        await asyncio.gather(*fondo, return_exceptions=True)
+        await self.guardar_tiempos()
+        log.info("Métricas ingesta: %s", self.resumen_metricas())
+        return True
+
+
+async def principal(escritores):
+    ventanas, anclas, segmentadores, tiempos = inicializar()
+    despachador_fcm = crear_despachador_fcm()
+    despachador_fcm.iniciar()
+    pool = await asyncpg.create_pool(**config_asyncpg(), min_size=1, max_size=escritores + 1)
+    consumidor = ConsumidorAsync(pool, ventanas, anclas, segmentadores, tiempos, despachador_fcm, escritores)
+    metricas.fuente("ingesta", consumidor.resumen_metricas)
+    metricas.fuente("cache_usuarios", consumidor.cache_usuarios.resumen_metricas)
+    metricas.fuente("fcm", despachador_fcm.resumen_metricas)
+    metricas.fuente("tiempos", tiempos.resumen_metricas)
+    metricas.fuente("pg_pool", lambda: {"usadas": pool.get_size() - pool.get_idle_size(),
+                                        "libres": pool.get_idle_size(), "max": pool.get_max_size()})
+    try:
+        return await consumidor.ejecutar()
+    finally:
+        await pool.close()
+        await asyncio.to_thread(despachador_fcm.detener)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consumidor MQTT de ubicaciones (asyncio)")
+    parser.add_argument("--escritores", type=int, default=ESCRITORES,
+                        help="transacciones de escritura en vuelo a la vez")
+    parser.add_argument("--log", help="nivel del log (DEBUG, INFO, WARNING...); por defecto NIVEL_LOG o INFO")
+    parser.add_argument("--metricas-puerto", type=int, default=METRICAS_PUERTO,
+                        help="puerto de /metrics; 0 para no servirlas")
+    args = parser.parse_args()
+    metricas.configurar_logging(args.log)
+    if args.metricas_puerto:
+        metricas.servir(args.metricas_puerto)
+    log.info("🔌 Conectando a %s:%s como %s...", MQTT_BROKER, MQTT_PORT, MQTT_USER)
+    if not asyncio.run(principal(args.escritores)):
+        sys.exit(1)
@@ -1,12 +1,33 @@
-import base64
+import argparse
+import functools
+import logging
+import os
+import signal
+import threading
+import time
+
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import psycopg2.pool
 import paho.mqtt.client as mqtt
-import time
-from datetime import datetime
-from google.oauth2 import service_account
-import google.auth.transport.requests
 import requests
 
+import decodificacion
+import metricas
+from cache_usuarios import CANAL_USUARIOS, CacheUsuarios
+from distancias import AcumuladorDistancias, cargar_anclas, crear_tabla_distancias
+from escucha_pg import EscuchaPostgres
+from estado_reciente import ESTADO_MOVIMIENTO, ESTADO_REPOSO, crear_tabla_estado, guardar_estados
+from ingesta import (DESCARTADOS, DURACION_MOVIMIENTO, MENSAJES, MENSAJES_INVALIDOS, EscritorLotes, crear_tabla_lotes,
+                     parsear_csv)
+from movimiento import MOVIMIENTO_NUEVO, MOVIMIENTO_REPETIDO, VentanaMovimiento, cargar_ventanas, segundos_del_dia
+from notificaciones import DespachadorFCM, TokenCuentaServicio
+from reparto import RepartidorProcesos
+from spool import Spool, crear_tabla_spool, leer_confirmado
+from tiempos import cargar_tiempos, guardar_tiempos
+from viajes import AcumuladorViajes, cargar_segmentadores
+
 
 # Configuración del broker
 MQTT_BROKER = "IP_SERVER"
@@ -20,184 +41,411 @@ PROJECT_ID = 'ID'
 # Clave de cifrado usada en el ESP32
 CLAVE_XOR = "CLAVE"
 
+# Ingesta por lotes
+INGESTA_TAM_COLA = 10000       # fixes pendientes como máximo antes de descartar
+INGESTA_TAM_LOTE = 500         # filas por INSERT multi-fila
+INGESTA_MAX_ESPERA_S = 1.0     # tiempo máximo que un fix espera a completar lote
+INGESTA_REINTENTOS = 5
+PG_POOL_MIN = 1
+PG_POOL_MAX = 4                # por proceso de ingesta
+# Procesos de ingesta (--workers). Con más de uno, este proceso solo recibe y
+# descifra, y reparte los fixes por dispositivo (ver reparto.py)
+INGESTA_WORKERS = 1
+# Spool en disco delante de Postgres (ver spool.py): con la BD lenta o caída
+# los fixes se siguen aceptando y se escriben cuando vuelve. Un subdirectorio
+# por proceso de ingesta; None para usar solo la cola en memoria. Si se baja
+# --workers con fixes pendientes, los de los directorios que sobran no se
+# reenvían hasta volver a subirlo.
+SPOOL_DIR = "/mnt/disk2/spool_ingesta"
+SPOOL_TAM_SEGMENTO = 64 * 1024 * 1024
+SPOOL_INTERVALO_SYNC_S = 1.0
+
+# Notificaciones FCM
+FCM_TAM_COLA = 1000
+FCM_MAX_POR_SEGUNDO = 20
+FCM_REINTENTOS = 4
+
+# Cache nombre de dispositivo -> (usuario_id, fcm_token)
+CACHE_USUARIOS_MAX = 10000
+CACHE_USUARIOS_TTL_S = 600
+
+# Particiones mensuales de ubicaciones (migración 0003): las de los próximos
+# meses se crean por adelantado; lo que caiga fuera va a ubicaciones_default
+PARTICIONES_MESES_ADELANTE = 2
+PARTICIONES_INTERVALO_S = 6 * 3600
+
+# Desfase del reloj e intervalo entre fixes de cada dispositivo (ver
+# tiempos.py): cada cuánto se guardan en tiempos_dispositivo/tiempos_flota
+TIEMPOS_INTERVALO_S = 60
+
+# /metrics del consumidor (ver metricas.py); con --workers el proceso de
+# ingesta i sirve las suyas en METRICAS_PUERTO + 1 + i. 0 para no servirlas.
+# El nivel del log se cambia con --log o NIVEL_LOG (DEBUG muestra cada mensaje).
+METRICAS_PUERTO = 9108
+
+log = logging.getLogger("consumidor")
+
+DURACION_DECODIFICAR = metricas.histograma("ingesta_decodificar_segundos", "Descifrar y parsear un mensaje")
+
 # =======================
 # CONEXIÓN A POSTGRESQL
 # =======================
+PG_CONFIG = {
+    "host": "SERVERIP",
+    "port": PORT,
+    "dbname": "DBNAME",
+    "user": "DBUSER",
+    "password": "PASSWD"
+}
+
 def get_pg_conn():
-    return psycopg2.connect(
-        host="SERVERIP",
-        port=PORT,
-        dbname="DBNAME",
-        user="DBUSER",
-        password="PASSWD"
-    )
+    return psycopg2.connect(**PG_CONFIG)
 
-# =======================
-# FUNCIONES AUXILIARES
-# =======================
-def descifrar_csv(b64_encoded, clave=CLAVE_XOR):
+def crear_pool():
+    return psycopg2.pool.ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, **PG_CONFIG)
+
+def inicializar_esquema():
+    conn = get_pg_conn()
+    with conn.cursor() as cursor:
+        crear_tabla_lotes(cursor)
+        crear_tabla_estado(cursor)
+        crear_tabla_distancias(cursor)
+        crear_tabla_spool(cursor)
+    conn.commit()
+    conn.close()
+
+def asegurar_particiones():
+    conn = get_pg_conn()
     try:
-        cifrado = base64.b64decode(b64_encoded).decode()
-        plano = ''.join(chr(ord(c) ^ ord(clave[i % len(clave)])) for i, c in enumerate(cifrado))
-        return plano
-    except Exception as e:
-        return f"[ERROR DESCIFRANDO] {e}"
-
-def insertar_datos(csv):
-    campos = csv.split(',')
-    if len(campos) != 7:
-        print("CSV mal formado, se esperaban 7 campos:", campos)
-        return
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT asegurar_particiones_ubicaciones(%s)", (PARTICIONES_MESES_ADELANTE,))
+            creadas = cursor.fetchone()[0]
+        conn.commit()
+        if creadas:
+            log.info("Creadas %d particiones nuevas de ubicaciones.", creadas)
+    except psycopg2.errors.UndefinedFunction:
+        log.warning("ubicaciones aún no está particionada (falta la migración 0003).")
+    except psycopg2.Error as e:
+        log.error("Error creando particiones de ubicaciones: %s", e)
+    finally:
+        conn.close()
 
-    nombre_usuario, hora_utc, lat, lon, alt, hdop, en_mov = campos
+def mantener_particiones(parar):
+    while not parar.wait(PARTICIONES_INTERVALO_S):
+        asegurar_particiones()
 
+def guardar_tiempos_pendientes():
+    filas, fila_flota, cambiados = tiempos.tomar()
+    if not cambiados:
+        return
     try:
-        lat, lon = float(lat), float(lon)
-        alt, hdop = float(alt), float(hdop)
-        en_mov = int(en_mov)
-    except ValueError:
-        print("Error de conversión de tipos en los campos numéricos.")
+        conn = pool.getconn()
+    except psycopg2.Error as e:
+        log.warning("No se pudieron guardar los tiempos de los dispositivos: %s", e)
+        tiempos.devolver(cambiados)
         return
+    try:
+        with conn.cursor() as cursor:
+            guardar_tiempos(cursor, filas, fila_flota)
+        conn.commit()
+        pool.putconn(conn)
+    except psycopg2.Error as e:
+        log.warning("No se pudieron guardar los tiempos de los dispositivos: %s", e)
+        tiempos.devolver(cambiados)
+        pool.putconn(conn, close=True)
 
-    conn = get_pg_conn()
-    cursor = conn.cursor()
+def mantener_tiempos(parar):
+    while not parar.wait(TIEMPOS_INTERVALO_S):
+        guardar_tiempos_pendientes()
+
+# =======================
+# FUNCIONES AUXILIARES
+# =======================
+def descifrar_csv(b64_encoded, clave=CLAVE_XOR):
+    return decodificacion.descifrar_csv(b64_encoded, clave)
 
-    # Verificar si el usuario existe
-    cursor.execute("SELECT id FROM usuarios WHERE nombre = %s", (nombre_usuario,))
-    fila = cursor.fetchone()
+def resolver_usuarios(cursor, nombres):
+    cursor.execute("SELECT nombre, id, fcm_token FROM usuarios WHERE nombre = ANY(%s)", (list(nombres),))
+    usuarios = {nombre: (usuario_id, fcm_token) for nombre, usuario_id, fcm_token in cursor.fetchall()}
 
-    if fila:
-        usuario_id = fila[0]
-    else:
-        cursor.execute("INSERT INTO usuarios (nombre, contraseña, correo) VALUES (%s, %s, %s) RETURNING id",
-                       (nombre_usuario, "default", "sin@email.com"))
-        usuario_id = cursor.fetchone()[0]
+    for nombre in nombres:
+        if nombre not in usuarios:
+            cursor.execute("INSERT INTO usuarios (nombre, contraseña, correo) VALUES (%s, %s, %s) RETURNING id",
+                           (nombre, "default", "sin@email.com"))
+            usuarios[nombre] = (cursor.fetchone()[0], None)
+    return usuarios
 
-    # Insertar el nuevo registro
-    cursor.execute('''
+def escribir_lote(cursor, lote):
+    # Se ejecuta dentro de la transacción del lote (ver ingesta.EscritorLotes)
+    generacion = cache_usuarios.generacion()
+    usuarios, faltan = {}, set()
+    for nombre in {fix.nombre for fix in lote}:
+        valor = cache_usuarios.obtener(nombre)
+        if valor:
+            usuarios[nombre] = valor
+        else:
+            faltan.add(nombre)
+
+    # Lo leído aquí solo entra en la cache tras el commit: un usuario creado en
+    # una transacción que luego se deshace no debe quedar cacheado.
+    leidos = resolver_usuarios(cursor, faltan) if faltan else {}
+    usuarios.update(leidos)
+    usuario_ids = [usuarios[fix.nombre][0] for fix in lote]
+    segundos = [segundos_del_dia(fix.hora_utc) for fix in lote]
+
+    # recibido_en se fija al recibir el mensaje y no con NOW(): todas las filas
+    # de un lote comparten transacción y NOW() las dejaría empatadas.
+    # hora_utc es TIME: una hora mal formada se guarda como NULL en vez de
+    # tumbar el lote entero.
+    psycopg2.extras.execute_values(cursor, '''
         INSERT INTO ubicaciones (usuario_id, hora_utc, latitud, longitud, altitud, hdop, en_movimiento, recibido_en)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
-    ''', (usuario_id, hora_utc, lat, lon, alt, hdop, en_mov))
-    conn.commit()
+        VALUES %s
+    ''', [
+        (uid, fix.hora_utc if seg is not None else None, fix.lat, fix.lon, fix.alt, fix.hdop, fix.en_mov, fix.recibido_en)
+        for uid, fix, seg in zip(usuario_ids, lote, segundos)
+    ], page_size=len(lote))
 
-    print(f"Datos insertados para usuario '{nombre_usuario}'.", flush=True)
-
-    # Evaluar últimos 3 registros para detección automática
-    cursor.execute("""
-        SELECT hora_utc, en_movimiento, hdop FROM ubicaciones 
-        WHERE usuario_id = %s
-        ORDER BY recibido_en DESC LIMIT 3
-    """, (usuario_id,))
-    ultimos_3 = cursor.fetchall()
-
-    if (
-        len(ultimos_3) == 3 and
-        all(r[1] == 1 and r[2] is not None and r[2] < 5.5 for r in ultimos_3)
-    ):
-        try:
-            h1 = datetime.strptime(ultimos_3[0][0], "%H:%M:%S")
-            h3 = datetime.strptime(ultimos_3[2][0], "%H:%M:%S")
-            if abs((h1 - h3).total_seconds()) <= 180:
-                print(f"Movimiento detectado para usuario {nombre_usuario}", flush=True)
-
-                # Verificar último estado registrado para evitar notificaciones duplicadas
-                cursor.execute("""
-                    SELECT en_movimiento FROM ubicaciones
-                    WHERE usuario_id = %s
-                    ORDER BY recibido_en DESC OFFSET 3 LIMIT 1
-                """, (usuario_id,))
-                ultimo_estado = cursor.fetchone()
-                if ultimo_estado and ultimo_estado[0] == 1:
-                    print("Ya había movimiento antes, no se envía notificación repetida.", flush=True)
-                else:
-                    # Obtener token FCM del usuario
-                    cursor.execute("SELECT fcm_token FROM usuarios WHERE id = %s", (usuario_id,))
-                    fcm = cursor.fetchone()
-                    fcm_token = fcm[0] if fcm and fcm[0] else None
-
-                    if fcm_token:
-                        enviar_notificacion_fcm_v1(
-                            fcm_token,
-                            "Alerta de movimiento",
-                            "Se detectó movimiento en tu vehículo, por favor revísalo."
-                        )
-                    else:
-                        print("No hay token FCM registrado para este usuario.", flush=True)
-        except Exception as e:
-            print(f"Error evaluando movimiento: {e}", flush=True)
-
-    cursor.close()
-    conn.close()
+    # Las ventanas se evalúan sobre copias: si la transacción se deshace el
+    # estado en memoria no cambia, y tras el commit se sustituyen.
+    # Igual con las anclas que usa el acumulado de distancias y con la
+    # segmentación en viajes.
+    inicio = time.perf_counter()
+    ventanas_lote, ultimos, movimientos = {}, {}, []
+    distancias = AcumuladorDistancias(anclas)
+    viajes = AcumuladorViajes(segmentadores)
+    for uid, fix, seg in zip(usuario_ids, lote, segundos):
+        ventana = ventanas_lote.get(fix.nombre)
+        if ventana is None:
+            actual = ventanas.get(fix.nombre)
+            ventana = ventanas_lote[fix.nombre] = actual.copia() if actual else VentanaMovimiento()
+        movimientos.append(ventana.registrar(seg, fix.en_mov, fix.hdop, fix.recibido_en))
+        distancias.sumar(fix.nombre, uid, fix.recibido_en.date(), fix.lat, fix.lon, fix.hdop)
+        viajes.registrar(fix.nombre, uid, fix.recibido_en, fix.lat, fix.lon, fix.hdop, fix.en_mov)
+        ultimos[fix.nombre] = (uid, fix)
+    DURACION_MOVIMIENTO.observar(time.perf_counter() - inicio)
+
+    distancias.guardar(cursor)
+    viajes.guardar(cursor)
+
+    guardar_estados(cursor, [
+        (uid, fix.hora_utc, fix.lat, fix.lon, fix.alt, fix.hdop, fix.en_mov, fix.recibido_en,
+         ESTADO_MOVIMIENTO if ventanas_lote[nombre].en_movimiento() else ESTADO_REPOSO,
+         ventanas_lote[nombre].ultima_vez_mov)
+        for nombre, (uid, fix) in ultimos.items()
+    ])
+    return usuarios, leidos, generacion, ventanas_lote, distancias.anclas, viajes.segmentadores, movimientos
+
+def tras_commit(lote, resultado):
+    usuarios, leidos, generacion, ventanas_lote, anclas_lote, segmentadores_lote, movimientos = resultado
+    for nombre, valor in leidos.items():
+        cache_usuarios.poner(nombre, valor, generacion)
+    ventanas.update(ventanas_lote)
+    anclas.update(anclas_lote)
+    segmentadores.update(segmentadores_lote)
+    tiempos.registrar_lote([usuarios[fix.nombre][0] for fix in lote], lote)
+
+    log.debug("Lote de %d fixes insertado.", len(lote))
+
+    for fix, estado in zip(lote, movimientos):
+        if estado is not None:
+            notificar_movimiento(fix, estado, usuarios[fix.nombre][1])
+
+def al_cambiar_usuario(canal, nombre):
+    cache_usuarios.invalidar(nombre or None)
+
+def notificar_movimiento(fix, estado, fcm_token):
+    log.info("Movimiento detectado para usuario %s", fix.nombre)
+    if estado == MOVIMIENTO_REPETIDO:
+        log.info("Ya había movimiento antes, no se envía notificación repetida.")
+    elif estado == MOVIMIENTO_NUEVO:
+        if fcm_token:
+            # Solo encola: el envío lo hace el hilo del despachador
+            despachador_fcm.enviar(
+                fcm_token,
+                "Alerta de movimiento",
+                "Se detectó movimiento en tu vehículo, por favor revísalo."
+            )
+        else:
+            log.info("No hay token FCM registrado para este usuario.")
+
+def crear_despachador_fcm(max_por_segundo=FCM_MAX_POR_SEGUNDO):
+    # Una sola sesión HTTP para el refresco OAuth y para los envíos
+    session = requests.Session()
+    token = TokenCuentaServicio(SERVICE_ACCOUNT_FILE, session)
+    return DespachadorFCM(
+        PROJECT_ID, token, session=session,
+        tam_cola=FCM_TAM_COLA,
+        max_por_segundo=max_por_segundo,
+        reintentos=FCM_REINTENTOS,
+    )
+
+def arrancar_ingesta(espera_encolar_s=0.05, fcm_max_por_segundo=FCM_MAX_POR_SEGUNDO, nombre_spool="ingesta"):
+    # Todo lo que usan escribir_lote y tras_commit: en modo multiproceso cada
+    # proceso de ingesta tiene lo suyo
+    global pool, ventanas, anclas, segmentadores, tiempos, cache_usuarios, escucha, despachador_fcm, spool, escritor
+    global parar_tiempos, hilo_tiempos
+    pool = crear_pool()
+
+    conn = pool.getconn()
+    with conn.cursor() as cursor:
+        ventanas = cargar_ventanas(cursor)
+        anclas = cargar_anclas(cursor)
+        segmentadores = cargar_segmentadores(cursor)
+        # Una fila de tiempos_flota por proceso, con el nombre de su spool
+        tiempos = cargar_tiempos(cursor, nombre_spool)
+        confirmado = leer_confirmado(cursor, nombre_spool) if SPOOL_DIR else 0
+    conn.rollback()
+    pool.putconn(conn)
+    log.info("Ventanas de movimiento cargadas para %d dispositivos.", len(ventanas))
+
+    spool = None
+    metricas_extra = {}
+    if SPOOL_DIR:
+        spool = Spool(os.path.join(SPOOL_DIR, nombre_spool), nombre_spool,
+                      tam_segmento=SPOOL_TAM_SEGMENTO, intervalo_sync_s=SPOOL_INTERVALO_SYNC_S)
+        spool.abrir(confirmado)
+        metricas_extra["spool"] = spool.resumen_metricas
+
+    cache_usuarios = CacheUsuarios(CACHE_USUARIOS_MAX, CACHE_USUARIOS_TTL_S)
+    # Si se pierde el LISTEN no sabemos qué cambió: se vacía la cache entera
+    escucha = EscuchaPostgres(get_pg_conn, [CANAL_USUARIOS], al_cambiar_usuario,
+                              al_reconectar=cache_usuarios.invalidar)
+    escucha.start()
 
-def enviar_notificacion_fcm_v1(token_fcm, titulo, cuerpo):
+    despachador_fcm = crear_despachador_fcm(fcm_max_por_segundo)
+    despachador_fcm.iniciar()
+
+    escritor = EscritorLotes(
+        pool, escribir_lote, tras_commit,
+        tam_cola=INGESTA_TAM_COLA,
+        tam_lote=INGESTA_TAM_LOTE,
+        max_espera_s=INGESTA_MAX_ESPERA_S,
+        reintentos=INGESTA_REINTENTOS,
+        espera_encolar_s=espera_encolar_s,
+        metricas_extra={
+            **metricas_extra,
+            "cache_usuarios": cache_usuarios.resumen_metricas,
+            "fcm": despachador_fcm.resumen_metricas,
+            "tiempos": tiempos.resumen_metricas,
+        },
+        spool=spool,
+    )
+    escritor.iniciar()
+
+    parar_tiempos = threading.Event()
+    hilo_tiempos = threading.Thread(target=mantener_tiempos, args=(parar_tiempos,), name="tiempos", daemon=True)
+    hilo_tiempos.start()
+
+    metricas.fuente("ingesta", escritor.resumen_metricas)
+    for nombre, funcion in escritor.metricas_extra.items():
+        metricas.fuente(nombre, funcion)
+    metricas.fuente("pg_pool", metricas.metricas_pool(pool))
+
+def detener_ingesta():
+    # Vaciar lo que quede en cola antes de salir (con spool, lo que no llegue
+    # a escribirse se reenvía al arrancar)
+    if escritor.detener() and spool:
+        spool.cerrar()
+    parar_tiempos.set()
+    hilo_tiempos.join()
+    guardar_tiempos_pendientes()
+    escucha.detener()
+    despachador_fcm.detener()
+    pool.closeall()
+
+def proceso_ingesta(indice, cola, workers, nivel_log=None, metricas_puerto=0):
+    # Ctrl+C llega a todo el grupo de procesos: aquí se ignora y se acaba
+    # cuando el proceso principal manda None tras dejar de recibir
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    metricas.configurar_logging(nivel_log)
+    log.info("Proceso de ingesta %d arrancado (pid %d).", indice, os.getpid())
+    if metricas_puerto:
+        metricas.servir(metricas_puerto + 1 + indice)
+    # El límite de FCM es del proyecto: se reparte entre los procesos
+    arrancar_ingesta(espera_encolar_s=None, fcm_max_por_segundo=FCM_MAX_POR_SEGUNDO / workers,
+                     nombre_spool=f"ingesta-{indice}")
     try:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/firebase.messaging']
-        )
-
-        request = google.auth.transport.requests.Request()
-        credentials.refresh(request)
-        access_token = credentials.token
-
-        message = {
-            "message": {
-                "token": token_fcm,
-                "notification": {
-                    "title": titulo,
-                    "body": cuerpo
-                }
-            }
-        }
-
-        url = f"https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send"
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json; UTF-8',
-        }
-
-        response = requests.post(url, headers=headers, json=message)
-        print(f"FCM Notificación enviada", flush=True)
-    except Exception as e:
-        print(f"Error enviando notificación FCM: {e}", flush=True)
+        while True:
+            fix = cola.get()
+            if fix is None:
+                break
+            escritor.encolar(fix)
+    finally:
+        detener_ingesta()
 
 
 # =======================
 # FUNCIONES MQTT
 # =======================
 def on_connect(client, userdata, flags, rc):
-    print("Conectado al broker MQTT. Código de estado:", rc, flush=True)
+    log.info("Conectado al broker MQTT. Código de estado: %s", rc)
     client.subscribe(MQTT_TOPIC)
 
-def on_message(client, userdata, msg):
-    print(f"\nMensaje recibido en '{msg.topic}'", flush=True)
+def on_message(client, destino, msg):
+    # destino: el EscritorLotes, o el RepartidorProcesos con --workers
+    MENSAJES.inc()
+    inicio = time.perf_counter()
     b64_payload = msg.payload.decode()
     csv = descifrar_csv(b64_payload)
-    print("CSV descifrado:", csv, flush=True)
+    fix = parsear_csv(csv) if not csv.startswith("[ERROR") else None
+    DURACION_DECODIFICAR.observar(time.perf_counter() - inicio)
+    log.debug("Mensaje recibido en '%s': %s", msg.topic, csv)
 
-    if not csv.startswith("[ERROR"):
-        for intento in range(3):
-            try:
-                insertar_datos(csv)
-                break
-            except psycopg2.OperationalError as e:
-                print("PostgreSQL ocupado, reintentando...", flush=True)
-                time.sleep(0.3)
-            except Exception as e:
-                print("Error al insertar en PostgreSQL:", e, flush=True)
-                break
-    else:
-        print(csv)
+    if fix is None:
+        MENSAJES_INVALIDOS.inc()
+        if csv.startswith("[ERROR"):
+            log.warning("%s", csv)
+    elif not destino.encolar(fix):
+        # Sin log por fix: con la cola llena serían miles por segundo
+        DESCARTADOS.inc()
 
 # =======================
 # MAIN
 # =======================
 if __name__ == "__main__":
-    client = mqtt.Client()
+    parser = argparse.ArgumentParser(description="Consumidor MQTT de ubicaciones")
+    parser.add_argument("--workers", type=int, default=INGESTA_WORKERS,
+                        help="procesos de ingesta; con más de uno se reparten los dispositivos entre ellos")
+    parser.add_argument("--log", help="nivel del log (DEBUG, INFO, WARNING...); por defecto NIVEL_LOG o INFO")
+    parser.add_argument("--metricas-puerto", type=int, default=METRICAS_PUERTO,
+                        help="puerto de /metrics; 0 para no servirlas")
+    args = parser.parse_args()
+    metricas.configurar_logging(args.log)
+    if args.metricas_puerto:
+        metricas.servir(args.metricas_puerto)
+
+    inicializar_esquema()
+    asegurar_particiones()
+
+    if args.workers > 1:
+        destino = RepartidorProcesos(args.workers,
+                                     functools.partial(proceso_ingesta, workers=args.workers, nivel_log=args.log,
+                                                       metricas_puerto=args.metricas_puerto),
+                                     tam_cola=INGESTA_TAM_COLA)
+        destino.iniciar()
+        detener = destino.detener
+        metricas.fuente("reparto", destino.resumen_metricas)
+        log.info("Ingesta repartida entre %d procesos.", args.workers)
+    else:
+        arrancar_ingesta()
+        destino = escritor
+        detener = detener_ingesta
+
+    parar_particiones = threading.Event()
+    threading.Thread(target=mantener_particiones, args=(parar_particiones,),
+                     name="particiones", daemon=True).start()
+
+    client = mqtt.Client(userdata=destino)
     client.username_pw_set(MQTT_USER, MQTT_PASS)
     client.on_connect = on_connect
     client.on_message = on_message
+    # SIGTERM (systemd, docker stop) sale de loop_forever y vacía las colas
+    signal.signal(signal.SIGTERM, lambda *_: client.disconnect())
 
-    print(f"🔌 Conectando a {MQTT_BROKER}:{MQTT_PORT} como {MQTT_USER}...", flush=True)
+    log.info("🔌 Conectando a %s:%s como %s...", MQTT_BROKER, MQTT_PORT, MQTT_USER)
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    client.loop_forever()
+    try:
+        client.loop_forever()
+    finally:
+        detener()
+        parar_particiones.set()
@@ -0,0 +1,276 @@
+"""Métricas en el formato de texto de Prometheus, y configuración del logging.
+
+Contadores, medidores e histogramas con etiquetas, en un registro por
+proceso. La API lo expone como un endpoint más (/metrics) y el consumidor
+con servir(), un servidor HTTP mínimo en su propio hilo. Con --workers cada
+proceso de ingesta tiene su propio registro y su propio puerto.
+
+Los componentes que ya llevan sus métricas en un dict (resumen_metricas de
+EscritorLotes, DespachadorFCM, Spool...) se exportan tal cual con fuente():
+se leen al pedir /metrics, no se cuentan dos veces.
+"""
+import bisect
+import http.server
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+# Cubos por defecto de los histogramas de latencia, en segundos
+LIMITES_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FORMATO_LOG = "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"
+
+
+def configurar_logging(nivel=None):
+    """Nivel: el dado, o NIVEL_LOG del entorno, o INFO. Con DEBUG se ve cada mensaje."""
+    nivel = (nivel or os.environ.get("NIVEL_LOG") or "INFO").upper()
+    logging.basicConfig(level=nivel, format=FORMATO_LOG, stream=sys.stdout, force=True)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _linea(nombre, etiquetas, valor):
+    if etiquetas:
+        texto = ",".join(f'{k}="{_escapar(v)}"' for k, v in etiquetas.items())
+        return f"{nombre}{{{texto}}} {valor}"
+    return f"{nombre} {valor}"
+
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+        # valores de las etiquetas, en orden -> valor
+        self._valores = {}
+
+    def _clave(self, etiquetas):
+        return tuple(str(etiquetas[e]) for e in self.etiquetas)
+
+    def _copia(self):
+        with self._lock:
+            return list(self._valores.items())
+
+    def lineas(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} {self.tipo}"
+        for clave, valor in self._copia():
+            yield _linea(self.nombre, dict(zip(self.etiquetas, clave)), valor)
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, n=1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + n
+
+
+class Medidor(_Metrica):
+    """Valor que sube y baja. Con `funcion` se lee al exportar en vez de fijarlo."""
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.funcion = funcion
+
+    def fijar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = valor
+
+    def _copia(self):
+        if self.funcion:
+            return [((), self.funcion())]
+        return super()._copia()
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=LIMITES_S):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.limites = tuple(limites)
+
+    def observar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        cubo = bisect.bisect_left(self.limites, valor)
+        with self._lock:
+            datos = self._valores.get(clave)
+            if datos is None:
+                # cuentas por cubo (el último es +Inf) y suma
+                datos = self._valores[clave] = [[0] * (len(self.limites) + 1), 0.0]
+            datos[0][cubo] += 1
+            datos[1] += valor
+
+    @contextmanager
+    def cronometrar(self, **etiquetas):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+    def _copia(self):
+        with self._lock:
+            return [(clave, (list(cuentas), suma)) for clave, (cuentas, suma) in self._valores.items()]
+
+    def lineas(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} {self.tipo}"
+        for clave, (cuentas, suma) in self._copia():
+            etiquetas = dict(zip(self.etiquetas, clave))
+            acumulado = 0
+            for limite, n in zip(self.limites + ("+Inf",), cuentas):
+                acumulado += n
+                yield _linea(f"{self.nombre}_bucket", {**etiquetas, "le": limite}, acumulado)
+            yield _linea(f"{self.nombre}_sum", etiquetas, round(suma, 6))
+            yield _linea(f"{self.nombre}_count", etiquetas, acumulado)
+
+
+class Registro:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metricas = {}
+        # prefijo -> función que devuelve un dict de métricas
+        self._fuentes = {}
+
+    def obtener(self, clase, nombre, *args, **kwargs):
+        # Si ya existe se devuelve la misma: los módulos las crean al importarse
+        with self._lock:
+            metrica = self._metricas.get(nombre)
+            if metrica is None:
+                metrica = self._metricas[nombre] = clase(nombre, *args, **kwargs)
+            return metrica
+
+    def fuente(self, prefijo, funcion):
+        with self._lock:
+            self._fuentes[prefijo] = funcion
+
+    def exponer(self):
+        with self._lock:
+            metricas = list(self._metricas.values())
+            fuentes = list(self._fuentes.items())
+        lineas = []
+        for metrica in metricas:
+            lineas.extend(metrica.lineas())
+        for prefijo, funcion in fuentes:
+            try:
+                datos = funcion()
+            except Exception as e:
+                logging.getLogger(__name__).warning("No se pudieron leer las métricas de %s: %s", prefijo, e)
+                continue
+            for clave, valor in datos.items():
+                nombre = f"{prefijo}_{clave}"
+                # Listas (p. ej. la profundidad de cada cola del reparto): una serie por posición
+                valores = enumerate(valor) if isinstance(valor, (list, tuple)) else [(None, valor)]
+                valores = [(i, v) for i, v in valores if isinstance(v, (int, float))]
+                if not valores:
+                    continue
+                lineas.append(f"# TYPE {nombre} untyped")
+                lineas.extend(_linea(nombre, {} if i is None else {"indice": i}, float(v)) for i, v in valores)
+        return "\n".join(lineas) + "\n"
+
+
+REGISTRO = Registro()
+
+
+def contador(nombre, ayuda, etiquetas=()):
+    return REGISTRO.obtener(Contador, nombre, ayuda, etiquetas)
+
+def medidor(nombre, ayuda, etiquetas=(), funcion=None):
+    return REGISTRO.obtener(Medidor, nombre, ayuda, etiquetas, funcion=funcion)
+
+def histograma(nombre, ayuda, etiquetas=(), limites=LIMITES_S):
+    return REGISTRO.obtener(Histograma, nombre, ayuda, etiquetas, limites=limites)
+
+def fuente(prefijo, funcion):
+    REGISTRO.fuente(prefijo, funcion)
+
+def exponer():
+    return REGISTRO.exponer()
+
+
+def metricas_pool(pool):
+    """Conexiones de un psycopg2.pool.ThreadedConnectionPool (usa sus atributos internos)."""
+    return lambda: {"usadas": len(pool._used), "libres": len(pool._pool), "max": pool.maxconn}
+
+
+# =======================
+# SERVIDOR DEL CONSUMIDOR
+# =======================
+class _Manejador(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = exponer().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", TIPO_CONTENIDO)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        pass
+
+
+def servir(puerto, host="0.0.0.0"):
+    """Sirve /metrics en un hilo aparte. Devuelve el servidor (shutdown() para pararlo)."""
+    servidor = http.server.ThreadingHTTPServer((host, puerto), _Manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    return servidor
+
+
+# =======================
+# MIDDLEWARE DE LA API
+# =======================
+PETICIONES = contador("http_peticiones_total", "Peticiones HTTP atendidas", ("metodo", "ruta", "codigo"))
+DURACION_PETICION = histograma("http_peticion_segundos", "Duración de las peticiones HTTP hasta el último byte",
+                               ("metodo", "ruta"))
+
+
+class MiddlewareMetricas:
+    """Middleware ASGI: latencia y código de cada petición por endpoint.
+
+    La ruta es la plantilla del endpoint (/ruta, no /ruta?dias=3), que el
+    router deja en scope["route"]; lo que no casa con ninguna va como
+    "sin_ruta" para no crear una serie por cada URL inventada. Las respuestas
+    en streaming cuentan hasta el último trozo.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        codigo = 500
+
+        async def enviar(mensaje):
+            nonlocal codigo
+            if mensaje["type"] == "http.response.start":
+                codigo = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            ruta = getattr(scope.get("route"), "path", "sin_ruta")
+            PETICIONES.inc(metodo=scope["method"], ruta=ruta, codigo=codigo)
+            DURACION_PETICION.observar(time.perf_counter() - inicio, metodo=scope["method"], ruta=ruta)
@@ -0,0 +1,135 @@
+from collections import deque
+
+# Regla de detección: 3 fixes seguidos en movimiento, con hdop < 5.5 y
+# separados como mucho 180 s entre el primero y el último (por hora_utc).
+FIXES_MOVIMIENTO = 3
+HDOP_MAX = 5.5
+VENTANA_S = 180
+
+# Resultados de VentanaMovimiento.registrar
+SIN_MOVIMIENTO = None
+MOVIMIENTO_REPETIDO = "repetido"
+MOVIMIENTO_NUEVO = "nuevo"
+
+
+def segundos_del_dia(hora_utc):
+    # Equivale a datetime.strptime(hora_utc, "%H:%M:%S") pero sin crear objetos
+    try:
+        h, m, s = hora_utc.split(':')
+        h, m, s = int(h), int(m), int(s)
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= h < 24 and 0 <= m < 60 and 0 <= s < 60):
+        return None
+    return h * 3600 + m * 60 + s
+
+
+class VentanaMovimiento:
+    """Últimos fixes de un dispositivo como (segundos_hora_utc, en_movimiento, hdop, recibido_en).
+
+    Guarda FIXES_MOVIMIENTO + 1 entradas: las 3 más recientes deciden si hay
+    movimiento y la anterior a ellas evita repetir la alerta.
+
+    Además lleva el estado que muestra la app: la misma regla pero medida con
+    recibido_en (`en_movimiento()`), y `ultima_vez_mov`, el recibido_en del
+    último fix con el que se cumplió.
+    """
+
+    __slots__ = ("fixes", "ultima_vez_mov")
+
+    def __init__(self, fixes=(), ultima_vez_mov=None):
+        self.fixes = deque(fixes, maxlen=FIXES_MOVIMIENTO + 1)
+        self.ultima_vez_mov = ultima_vez_mov
+
+    def copia(self):
+        return VentanaMovimiento(self.fixes, self.ultima_vez_mov)
+
+    def registrar(self, segundos, en_mov, hdop, recibido_en=None):
+        self.fixes.append((segundos, en_mov, hdop, recibido_en))
+        if self.en_movimiento():
+            self.ultima_vez_mov = recibido_en
+        return self.evaluar()
+
+    def _recientes_validos(self):
+        if len(self.fixes) < FIXES_MOVIMIENTO:
+            return None
+        recientes = list(self.fixes)[-FIXES_MOVIMIENTO:]
+        if not all(en_mov == 1 and hdop is not None and hdop < HDOP_MAX for _, en_mov, hdop, _ in recientes):
+            return None
+        return recientes
+
+    def evaluar(self):
+        recientes = self._recientes_validos()
+        if recientes is None:
+            return SIN_MOVIMIENTO
+
+        h_primero, h_ultimo = recientes[0][0], recientes[-1][0]
+        if h_primero is None or h_ultimo is None or abs(h_ultimo - h_primero) > VENTANA_S:
+            return SIN_MOVIMIENTO
+
+        if len(self.fixes) > FIXES_MOVIMIENTO and self.fixes[0][1] == 1:
+            return MOVIMIENTO_REPETIDO
+        return MOVIMIENTO_NUEVO
+
+    def en_movimiento(self):
+        recientes = self._recientes_validos()
+        if recientes is None:
+            return False
+        t_primero, t_ultimo = recientes[0][3], recientes[-1][3]
+        return t_primero is not None and t_ultimo is not None and \
+            abs((t_ultimo - t_primero).total_seconds()) <= VENTANA_S
+
+
+def cargar_ventanas(cursor):
+    """Reconstruye las ventanas de todos los dispositivos desde la BD.
+
+    Las ventanas son función de las últimas filas guardadas, así que tras un
+    reinicio se recuperan tal cual estaban sin persistir nada aparte.
+    `ultima_vez_mov` sale de estado_dispositivo; si un dispositivo aún no
+    tiene fila ahí se busca en sus últimos 50 fixes, como hacía la API.
+    """
+    cursor.execute("""
+        SELECT u.nombre, x.hora_utc, x.en_movimiento, x.hdop, x.recibido_en, e.ultima_vez_en_movimiento
+        FROM usuarios u
+        CROSS JOIN LATERAL (
+            SELECT hora_utc::text AS hora_utc, en_movimiento, hdop, recibido_en
+            FROM ubicaciones
+            WHERE usuario_id = u.id
+            ORDER BY recibido_en DESC LIMIT %s
+        ) x
+        LEFT JOIN estado_dispositivo e ON e.usuario_id = u.id
+        ORDER BY u.nombre, x.recibido_en ASC
+    """, (FIXES_MOVIMIENTO + 1,))
+
+    ventanas = {}
+    for nombre, hora_utc, en_mov, hdop, recibido_en, ultima_vez_mov in cursor.fetchall():
+        ventana = ventanas.get(nombre)
+        if ventana is None:
+            ventana = ventanas[nombre] = VentanaMovimiento(ultima_vez_mov=ultima_vez_mov)
+        ventana.fixes.append((segundos_del_dia(hora_utc), en_mov, hdop, recibido_en))
+
+    cursor.execute("""
+        SELECT DISTINCT ON (nombre) nombre, recibido_en
+        FROM (
+            SELECT u.nombre, x.recibido_en, x.en_movimiento, x.hdop,
+                   LEAD(x.en_movimiento, 1) OVER w AS m2, LEAD(x.hdop, 1) OVER w AS h2,
+                   LEAD(x.en_movimiento, 2) OVER w AS m3, LEAD(x.hdop, 2) OVER w AS h3,
+                   LEAD(x.recibido_en, 2) OVER w AS t3
+            FROM usuarios u
+            CROSS JOIN LATERAL (
+                SELECT recibido_en, en_movimiento, hdop FROM ubicaciones
+                WHERE usuario_id = u.id
+                ORDER BY recibido_en DESC LIMIT 50
+            ) x
+            WHERE NOT EXISTS (SELECT 1 FROM estado_dispositivo e WHERE e.usuario_id = u.id)
+            WINDOW w AS (PARTITION BY u.nombre ORDER BY x.recibido_en DESC)
+        ) t
+        WHERE en_movimiento = 1 AND m2 = 1 AND m3 = 1
+          AND hdop < %s AND h2 < %s AND h3 < %s
+          AND ABS(EXTRACT(EPOCH FROM recibido_en - t3)) <= %s
+        ORDER BY nombre, recibido_en DESC
+    """, (HDOP_MAX, HDOP_MAX, HDOP_MAX, VENTANA_S))
+    for nombre, recibido_en in cursor.fetchall():
+        if nombre in ventanas:
+            ventanas[nombre].ultima_vez_mov = recibido_en
+    return ventanas
@@ -0,0 +1,202 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+import metricas
+
+log = logging.getLogger(__name__)
+
+DURACION_ENVIO = metricas.histograma("fcm_envio_segundos", "Petición HTTP de envío a FCM, por intento")
+
+FCM_URL_BASE = "https://fcm.googleapis.com"
+FCM_SCOPES = ['https://www.googleapis.com/auth/firebase.messaging']
+# Espera máxima antes de un reintento aunque FCM pida más con Retry-After
+RETRY_AFTER_MAX_S = 30
+
+
+class TokenCuentaServicio:
+    """Access token OAuth de la cuenta de servicio, cacheado hasta poco antes de caducar.
+
+    El JSON se lee una sola vez; `credentials.refresh()` solo se hace cuando
+    faltan menos de `margen_s` segundos para que caduque el token (~1 h).
+    """
+
+    def __init__(self, fichero_cuenta, session, margen_s=300):
+        from google.oauth2 import service_account
+        import google.auth.transport.requests
+
+        self.credentials = service_account.Credentials.from_service_account_file(
+            fichero_cuenta, scopes=FCM_SCOPES
+        )
+        self.request = google.auth.transport.requests.Request(session=session)
+        self.margen = timedelta(seconds=margen_s)
+        self.refrescos = 0
+        self._lock = threading.Lock()
+
+    def obtener(self, forzar=False):
+        with self._lock:
+            expiry = self.credentials.expiry  # UTC sin tzinfo
+            if forzar or not self.credentials.token or expiry is None or expiry - datetime.utcnow() < self.margen:
+                self.credentials.refresh(self.request)
+                self.refrescos += 1
+            return self.credentials.token
+
+
+class DespachadorFCM:
+    """Envía notificaciones FCM v1 desde un hilo propio.
+
+    `enviar()` solo encola y nunca bloquea a quien lo llama. El hilo reutiliza
+    una única requests.Session (pool de conexiones keep-alive), limita el ritmo
+    a `max_por_segundo` y reintenta con backoff los 429/5xx y errores de red.
+    Un reintento no se espera en el hilo: se aparta con la hora a partir de
+    la que puede salir y mientras tanto se siguen enviando las demás; cada
+    intento, sea el primero o no, pasa por el límite de ritmo.
+
+    `token` es cualquier objeto con `obtener(forzar=False)`; así se puede
+    probar contra un servidor HTTP local (ver Utils/stub_fcm.py).
+    """
+
+    def __init__(self, project_id, token, session=None, url_base=FCM_URL_BASE, tam_cola=1000,
+                 max_por_segundo=20, reintentos=4, timeout_s=10):
+        self.url = f"{url_base}/v1/projects/{project_id}/messages:send"
+        self.token = token
+        self.session = session or requests.Session()
+        self.cola = queue.Queue(maxsize=tam_cola)
+        self.intervalo_min = 1.0 / max_por_segundo
+        self.reintentos = reintentos
+        self.timeout_s = timeout_s
+        self._ultimo_envio = 0.0
+        # (no antes de, orden, envío) de los reintentos; solo lo toca el hilo
+        self._reintentos = []
+        self._orden = itertools.count()
+        self._hilo = None
+        self.metricas = {
+            "encoladas": 0,
+            "enviadas": 0,
+            "fallidas": 0,
+            "descartadas_cola_llena": 0,
+            "tokens_invalidos": 0,
+            "reintentos": 0,
+        }
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._bucle, name="despachador-fcm", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout=10):
+        self.cola.put(None)
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def enviar(self, token_fcm, titulo, cuerpo):
+        try:
+            self.cola.put_nowait((token_fcm, titulo, cuerpo))
+        except queue.Full:
+            self.metricas["descartadas_cola_llena"] += 1
+            log.warning("Cola FCM llena, notificación descartada.")
+            return False
+        self.metricas["encoladas"] += 1
+        return True
+
+    def resumen_metricas(self):
+        datos = dict(self.metricas)
+        datos["pendientes"] = self.cola.qsize()
+        datos["reintentos_pendientes"] = len(self._reintentos)
+        datos["refrescos_token"] = getattr(self.token, "refrescos", None)
+        return datos
+
+    def _bucle(self):
+        # Al parar (None en la cola) se acaba lo encolado y los reintentos pendientes
+        parando = False
+        while True:
+            ahora = time.monotonic()
+            if self._reintentos and self._reintentos[0][0] <= ahora:
+                envio = heapq.heappop(self._reintentos)[2]
+            elif parando:
+                if not self._reintentos:
+                    break
+                time.sleep(self._reintentos[0][0] - ahora)
+                continue
+            else:
+                try:
+                    item = self.cola.get(timeout=self._reintentos[0][0] - ahora if self._reintentos else None)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    parando = True
+                    continue
+                envio = (*item, 0, False)
+
+            self._esperar_turno()
+            try:
+                self._intentar(*envio)
+            except Exception as e:
+                self.metricas["fallidas"] += 1
+                log.exception("Error enviando notificación FCM: %s", e)
+
+    def _esperar_turno(self):
+        espera = self._ultimo_envio + self.intervalo_min - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        self._ultimo_envio = time.monotonic()
+
+    def _reintentar(self, envio, intento, espera_s, forzar_token=False):
+        if intento >= self.reintentos:
+            self.metricas["fallidas"] += 1
+            log.error("No se pudo enviar la notificación FCM.")
+            return
+        self.metricas["reintentos"] += 1
+        heapq.heappush(self._reintentos, (time.monotonic() + espera_s, next(self._orden),
+                                          (*envio, intento + 1, forzar_token)))
+
+    def _intentar(self, token_fcm, titulo, cuerpo, intento, forzar_token):
+        """Un intento de envío; si hay que reintentar, lo aparta con _reintentar()."""
+        envio = (token_fcm, titulo, cuerpo)
+        message = {
+            "message": {
+                "token": token_fcm,
+                "notification": {
+                    "title": titulo,
+                    "body": cuerpo
+                }
+            }
+        }
+        headers = {
+            'Authorization': f'Bearer {self.token.obtener(forzar=forzar_token)}',
+            'Content-Type': 'application/json; UTF-8',
+        }
+
+        inicio = time.perf_counter()
+        try:
+            response = self.session.post(self.url, headers=headers, json=message, timeout=self.timeout_s)
+        except requests.RequestException as e:
+            log.warning("FCM sin respuesta (%s), se reintentará.", e)
+            self._reintentar(envio, intento, min(2 ** intento, 30))
+            return
+
+        DURACION_ENVIO.observar(time.perf_counter() - inicio)
+        if response.ok:
+            self.metricas["enviadas"] += 1
+            log.info("FCM Notificación enviada")
+        elif response.status_code == 401:
+            # Token revocado o caducado antes de tiempo: pedir uno nuevo
+            self._reintentar(envio, intento, 0, forzar_token=True)
+        elif response.status_code in (400, 404):
+            # UNREGISTERED / INVALID_ARGUMENT: el token FCM ya no sirve
+            self.metricas["tokens_invalidos"] += 1
+            log.warning("FCM rechaza el token (%s): %s", response.status_code, response.text)
+        elif response.status_code == 429 or response.status_code >= 500:
+            try:
+                espera = min(float(response.headers["Retry-After"]), RETRY_AFTER_MAX_S)
+            except (KeyError, ValueError):
+                espera = min(2 ** intento, 30)
+            self._reintentar(envio, intento, max(espera, 0))
+        else:
+            self.metricas["fallidas"] += 1
+            log.error("No se pudo enviar la notificación FCM (%s): %s", response.status_code, response.text)
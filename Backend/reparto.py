@@ -0,0 +1,172 @@
+"""Reparto de la ingesta entre varios procesos.
+
+Cada fix va al proceso crc32(nombre) % n: todos los de un dispositivo los
+escribe siempre el mismo proceso y en el orden en que llegaron, así que la
+ventana de movimiento y el ancla de distancias de cada dispositivo viven en
+un solo sitio. Las suscripciones compartidas de MQTT v5 no sirven para esto:
+Mosquitto las reparte por turnos y el nombre va dentro del payload cifrado.
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+def particion(nombre, n):
+    return zlib.crc32(nombre.encode("utf-8")) % n
+
+
+class RepartidorProcesos:
+    """Reparte fixes entre `n` procesos que ejecutan `objetivo(indice, cola)`.
+
+    `objetivo` lee fixes de su cola hasta recibir None. Un hilo supervisor
+    relanza con el mismo índice los procesos que mueren, esperando más cuanto
+    más seguidos caen; lo que el proceso tenía en memoria sin escribir se
+    pierde, igual que al reiniciar el consumidor de un solo proceso.
+    """
+
+    def __init__(self, n, objetivo, tam_cola=10000, espera_encolar_s=0.05, vida_minima_s=10,
+                 espera_reinicio_max_s=30, intervalo_metricas_s=60):
+        self.n = n
+        self.objetivo = objetivo
+        self.tam_cola = tam_cola
+        self.espera_encolar_s = espera_encolar_s
+        self.vida_minima_s = vida_minima_s
+        self.espera_reinicio_max_s = espera_reinicio_max_s
+        self.intervalo_metricas_s = intervalo_metricas_s
+        # Los procesos se relanzan desde aquí con hilos en marcha (paho, el
+        # supervisor, los alimentadores de las colas): con fork heredarían
+        # locks tomados.
+        self._ctx = multiprocessing.get_context("forkserver")
+        self.colas = [self._ctx.Queue(tam_cola) for _ in range(n)]
+        self.procesos = [None] * n
+        self._arrancado = [0.0] * n
+        self._caidas_seguidas = [0] * n
+        self._relanzar_en = [None] * n
+        self._parar = threading.Event()
+        self._hilo = None
+        # encolar() y el cambio de cola al relanzar no se pueden cruzar
+        self._lock_colas = threading.Lock()
+        self._lock_metricas = threading.Lock()
+        self.metricas = {
+            "encolados": 0,
+            "descartados_cola_llena": 0,
+            "reinicios": 0,
+        }
+
+    def _sumar(self, clave, n=1):
+        with self._lock_metricas:
+            self.metricas[clave] += n
+
+    def resumen_metricas(self):
+        with self._lock_metricas:
+            datos = dict(self.metricas)
+        datos["profundidad"] = [c.qsize() for c in self.colas]
+        datos["vivos"] = sum(1 for p in self.procesos if p is not None and p.is_alive())
+        return datos
+
+    # ---- lado productor (hilo MQTT) ----
+    def encolar(self, fix):
+        # Misma política que EscritorLotes.encolar: esperar un instante como
+        # mucho y descartar, para no bloquear el hilo de red de paho.
+        with self._lock_colas:
+            try:
+                self.colas[particion(fix.nombre, self.n)].put(fix, timeout=self.espera_encolar_s)
+            except queue.Full:
+                self._sumar("descartados_cola_llena")
+                return False
+        self._sumar("encolados")
+        return True
+
+    # ---- ciclo de vida ----
+    def iniciar(self):
+        for indice in range(self.n):
+            self._arrancar(indice)
+        self._hilo = threading.Thread(target=self._supervisar, name="supervisor-ingesta", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout=30):
+        """Pide a cada proceso que vacíe su cola y acabe; a los que no acaben a
+        tiempo se les mata."""
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join()
+        limite = time.monotonic() + timeout
+        for cola, proceso in zip(self.colas, self.procesos):
+            if proceso.is_alive():
+                try:
+                    cola.put(None, timeout=max(0.0, limite - time.monotonic()))
+                except queue.Full:
+                    pass
+        for indice, proceso in enumerate(self.procesos):
+            proceso.join(max(0.0, limite - time.monotonic()))
+            if proceso.is_alive():
+                log.warning("Proceso de ingesta %d no terminó a tiempo, se mata.", indice)
+                proceso.terminate()
+                proceso.join()
+
+    def _arrancar(self, indice):
+        proceso = self._ctx.Process(target=self.objetivo, args=(indice, self.colas[indice]),
+                                    name=f"ingesta-{indice}", daemon=True)
+        proceso.start()
+        self.procesos[indice] = proceso
+        self._arrancado[indice] = time.monotonic()
+
+    def _cambiar_cola(self, indice):
+        # Un proceso que muere esperando en get() (kill, OOM) deja tomado para
+        # siempre el lock de lectura de su cola: lo que llegue se manda a una
+        # cola nueva desde ya, y de la vieja se rescata lo que se pueda.
+        nueva = self._ctx.Queue(self.tam_cola)
+        with self._lock_colas:
+            vieja = self.colas[indice]
+            self.colas[indice] = nueva
+        rescatados = 0
+        while True:
+            try:
+                fix = vieja.get(timeout=0.1)
+            except (queue.Empty, OSError, EOFError):
+                break
+            try:
+                nueva.put_nowait(fix)
+                rescatados += 1
+            except queue.Full:
+                break
+        vieja.close()
+        vieja.cancel_join_thread()
+        return rescatados
+
+    def _supervisar(self):
+        proximo_resumen = time.monotonic() + self.intervalo_metricas_s
+        while not self._parar.is_set():
+            # Despierta en cuanto muere alguno (o cada segundo para los relanzamientos)
+            multiprocessing.connection.wait(
+                [p.sentinel for i, p in enumerate(self.procesos) if self._relanzar_en[i] is None], timeout=1.0)
+            if self._parar.is_set():
+                break
+            ahora = time.monotonic()
+            for indice, proceso in enumerate(self.procesos):
+                if self._relanzar_en[indice] is None:
+                    if proceso.is_alive():
+                        continue
+                    if ahora - self._arrancado[indice] < self.vida_minima_s:
+                        self._caidas_seguidas[indice] += 1
+                    else:
+                        self._caidas_seguidas[indice] = 0
+                    espera = min(2 ** self._caidas_seguidas[indice] - 1, self.espera_reinicio_max_s)
+                    rescatados = self._cambiar_cola(indice)
+                    log.error("Proceso de ingesta %d terminó (código %s, %d fixes rescatados de su cola), "
+                              "se relanza en %s s.", indice, proceso.exitcode, rescatados, espera)
+                    self._relanzar_en[indice] = ahora + espera
+                if ahora >= self._relanzar_en[indice]:
+                    self._relanzar_en[indice] = None
+                    self._arrancar(indice)
+                    self._sumar("reinicios")
+
+            if ahora >= proximo_resumen:
+                log.info("Métricas reparto: %s", self.resumen_metricas())
+                proximo_resumen = ahora + self.intervalo_metricas_s
@@ -0,0 +1,318 @@
+"""Spool local de la ingesta: cada fix se apunta en disco antes de ir a Postgres.
+
+Segmentos de tamaño fijo mapeados en memoria a los que solo se añade. Cada
+registro lleva su número de secuencia y un crc32; al abrir el spool se
+recorren los segmentos y se corta en el primer registro incompleto o corrupto
+(lo que quedó a medias al morir el proceso).
+
+El último seq escrito en Postgres se guarda en spool_confirmado en la misma
+transacción que las filas (ver ingesta.EscritorLotes): al arrancar se sigue
+justo desde ahí, así que nada se escribe dos veces ni se salta. Los segmentos
+confirmados enteros se borran.
+"""
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from ingesta import Fix
+
+log = logging.getLogger(__name__)
+
+MAGIA = b"SPOOL001"
+CABECERA = struct.Struct("<IIQ")    # longitud del payload, crc32, seq
+TAM_SEGMENTO = 64 * 1024 * 1024
+EPOCA = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def crear_tabla_spool(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS spool_confirmado (
+            nombre TEXT PRIMARY KEY,
+            seq BIGINT NOT NULL
+        )
+    ''')
+
+def leer_confirmado(cursor, nombre):
+    cursor.execute("SELECT seq FROM spool_confirmado WHERE nombre = %s", (nombre,))
+    fila = cursor.fetchone()
+    return fila[0] if fila else 0
+
+
+def codificar(fix):
+    recibido_us = (fix.recibido_en - EPOCA) // timedelta(microseconds=1)
+    return json.dumps([*fix[:7], recibido_us], separators=(",", ":")).encode("utf-8")
+
+def decodificar(payload):
+    *campos, recibido_us = json.loads(payload)
+    return Fix(*campos, EPOCA + timedelta(microseconds=recibido_us))
+
+def crc(seq, payload):
+    return zlib.crc32(payload, zlib.crc32(struct.pack("<Q", seq)))
+
+
+class _Segmento:
+    __slots__ = ("ruta", "mm", "fin", "primer_seq", "ultimo_seq")
+
+    def __init__(self, ruta, mm, fin, primer_seq, ultimo_seq):
+        self.ruta = ruta
+        self.mm = mm
+        self.fin = fin                  # offset donde va el siguiente registro
+        self.primer_seq = primer_seq
+        self.ultimo_seq = ultimo_seq    # None si está vacío
+
+    def registros(self, desde=len(MAGIA)):
+        """(offset, siguiente offset, seq, payload) de los registros válidos a
+        partir de `desde`, hasta el primero que no lo es."""
+        pos, anterior = desde, None
+        while pos + CABECERA.size <= len(self.mm):
+            longitud, suma, seq = CABECERA.unpack_from(self.mm, pos)
+            siguiente = pos + CABECERA.size + longitud
+            if longitud == 0 or siguiente > len(self.mm):
+                return
+            payload = self.mm[pos + CABECERA.size:siguiente]
+            if crc(seq, payload) != suma or (anterior is not None and seq != anterior + 1):
+                return
+            yield pos, siguiente, seq, payload
+            pos, anterior = siguiente, seq
+
+    def cerrar(self):
+        self.mm.flush()
+        self.mm.close()
+
+
+class Spool:
+    """Cola FIFO persistente de fixes con un solo lector.
+
+    `anotar(fix)` nunca espera a la base de datos: solo copia el registro al
+    segmento actual. `leer()` devuelve lo siguiente sin leer y `confirmar(seq)`
+    marca como escrito en Postgres todo hasta `seq`.
+    """
+
+    def __init__(self, directorio, nombre, tam_segmento=TAM_SEGMENTO, intervalo_sync_s=1.0):
+        self.directorio = directorio
+        self.nombre = nombre
+        self.tam_segmento = tam_segmento
+        self.intervalo_sync_s = intervalo_sync_s
+        self._lock = threading.Lock()
+        self._hay_datos = threading.Condition(self._lock)
+        self._segmentos = []
+        self._ultimo_seq = 0
+        self._confirmado = 0
+        self._leido = 0
+        # Posición de lectura: segmento y offset del siguiente registro sin leer
+        self._seg_lectura = None
+        self._pos_lectura = 0
+        self._ultimo_sync = time.monotonic()
+        self._ultimo_resumen = (time.monotonic(), 0)
+        self.metricas = {
+            "anotados": 0,
+            "bytes_anotados": 0,
+            "confirmados": 0,
+            "segmentos_creados": 0,
+            "segmentos_borrados": 0,
+            "segmentos_truncados": 0,
+        }
+
+    # ---- arranque ----
+    def abrir(self, confirmado):
+        """Recupera los segmentos del directorio y deja la lectura justo después
+        de `confirmado` (el seq guardado en spool_confirmado)."""
+        os.makedirs(self.directorio, exist_ok=True)
+        with self._lock:
+            for ruta in sorted(glob.glob(os.path.join(self.directorio, "*.seg"))):
+                segmento = self._recuperar(ruta)
+                if segmento is None:
+                    continue
+                if segmento.ultimo_seq is not None and segmento.ultimo_seq <= self._ultimo_seq:
+                    log.warning("Spool: %s repite secuencias ya vistas, se ignora.", ruta)
+                    segmento.cerrar()
+                    continue
+                self._segmentos.append(segmento)
+                if segmento.ultimo_seq is not None:
+                    self._ultimo_seq = segmento.ultimo_seq
+
+            # Si se borró el directorio, seguir numerando tras lo ya confirmado
+            self._ultimo_seq = max(self._ultimo_seq, confirmado)
+            self._confirmado = self._leido = confirmado
+            self._compactar()
+            self._posicionar(confirmado)
+            pendientes = self._ultimo_seq - confirmado
+        log.info("Spool %s: %d segmentos, %d fixes por reenviar desde el seq %d.",
+                 self.nombre, len(self._segmentos), pendientes, confirmado + 1)
+        return pendientes
+
+    def _recuperar(self, ruta):
+        fd = os.open(ruta, os.O_RDWR)
+        try:
+            if os.fstat(fd).st_size < len(MAGIA) + CABECERA.size:
+                log.warning("Spool: %s incompleto, se descarta.", ruta)
+                os.unlink(ruta)
+                return None
+            mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        if mm[:len(MAGIA)] != MAGIA:
+            log.warning("Spool: %s no es un segmento, se ignora.", ruta)
+            mm.close()
+            return None
+
+        segmento = _Segmento(ruta, mm, len(MAGIA), None, None)
+        for _, siguiente, seq, _ in segmento.registros():
+            if segmento.primer_seq is None:
+                segmento.primer_seq = seq
+            segmento.ultimo_seq, segmento.fin = seq, siguiente
+        if segmento.fin + CABECERA.size <= len(mm) and any(mm[segmento.fin:segmento.fin + CABECERA.size]):
+            # Registro a medias (o basura tras él): se pone a cero para que lo
+            # que se anote encima no pueda acabar empalmado con restos viejos
+            log.warning("Spool: %s cortado en el byte %d tras el seq %d.",
+                        ruta, segmento.fin, segmento.ultimo_seq)
+            mm[segmento.fin:] = bytes(len(mm) - segmento.fin)
+            self.metricas["segmentos_truncados"] += 1
+        return segmento
+
+    def _posicionar(self, confirmado):
+        self._seg_lectura, self._pos_lectura = None, 0
+        for segmento in self._segmentos:
+            if segmento.ultimo_seq is None or segmento.ultimo_seq <= confirmado:
+                continue
+            self._seg_lectura, self._pos_lectura = segmento, len(MAGIA)
+            for pos, _, seq, _ in segmento.registros():
+                if seq > confirmado:
+                    self._pos_lectura = pos
+                    break
+            return
+
+    # ---- escritura ----
+    def _nuevo_segmento(self, primer_seq):
+        if self._segmentos:
+            self._segmentos[-1].mm.flush()
+        ruta = os.path.join(self.directorio, f"{primer_seq:020d}.seg")
+        fd = os.open(ruta, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Reservar el espacio ya: con el disco lleno, escribir en un hueco
+            # de un fichero disperso mapeado mata el proceso con SIGBUS
+            os.posix_fallocate(fd, 0, self.tam_segmento)
+            mm = mmap.mmap(fd, self.tam_segmento)
+        except OSError:
+            os.close(fd)
+            os.unlink(ruta)
+            raise
+        os.close(fd)
+        mm[:len(MAGIA)] = MAGIA
+        segmento = _Segmento(ruta, mm, len(MAGIA), None, None)
+        self._segmentos.append(segmento)
+        self.metricas["segmentos_creados"] += 1
+        return segmento
+
+    def anotar(self, fix):
+        """Añade `fix` al spool y devuelve su seq. OSError si no hay disco."""
+        payload = codificar(fix)
+        tam = CABECERA.size + len(payload)
+        if tam > self.tam_segmento - len(MAGIA):
+            raise ValueError(f"registro de {tam} bytes no cabe en un segmento")
+        with self._lock:
+            seq = self._ultimo_seq + 1
+            segmento = self._segmentos[-1] if self._segmentos else None
+            # Dentro de un segmento los seq van seguidos (así se detecta la cola
+            # rota al recuperar): si la numeración salta, segmento nuevo
+            if segmento is None or segmento.fin + tam > self.tam_segmento or \
+                    (segmento.ultimo_seq is not None and segmento.ultimo_seq != seq - 1):
+                segmento = self._nuevo_segmento(seq)
+            pos = segmento.fin
+            segmento.mm[pos + CABECERA.size:pos + tam] = payload
+            CABECERA.pack_into(segmento.mm, pos, len(payload), crc(seq, payload), seq)
+            segmento.fin += tam
+            if segmento.primer_seq is None:
+                segmento.primer_seq = seq
+            segmento.ultimo_seq = self._ultimo_seq = seq
+            if self._seg_lectura is None:
+                self._seg_lectura, self._pos_lectura = segmento, pos
+            self.metricas["anotados"] += 1
+            self.metricas["bytes_anotados"] += tam
+
+            # Ante una caída del proceso basta con la cache de páginas; el
+            # msync periódico acota lo que se pierde si cae la máquina
+            ahora = time.monotonic()
+            if ahora - self._ultimo_sync >= self.intervalo_sync_s:
+                segmento.mm.flush()
+                self._ultimo_sync = ahora
+            self._hay_datos.notify()
+        return seq
+
+    # ---- lectura ----
+    def leer(self, max_n, espera_s):
+        """Hasta `max_n` fixes sin leer, esperando como mucho `espera_s` a que
+        haya alguno. Devuelve (fixes, seqs)."""
+        with self._hay_datos:
+            if self._leido == self._ultimo_seq:
+                self._hay_datos.wait(espera_s)
+            crudos = []
+            while len(crudos) < max_n and self._leido < self._ultimo_seq:
+                segmento = self._seg_lectura
+                if self._pos_lectura >= segmento.fin:
+                    # Segmento leído entero: el siguiente empieza por su cabecera
+                    segmento = self._segmentos[self._segmentos.index(segmento) + 1]
+                    self._seg_lectura, self._pos_lectura = segmento, len(MAGIA)
+                longitud, _, seq = CABECERA.unpack_from(segmento.mm, self._pos_lectura)
+                inicio = self._pos_lectura + CABECERA.size
+                crudos.append((seq, segmento.mm[inicio:inicio + longitud]))
+                self._pos_lectura = inicio + longitud
+                self._leido = seq
+        return [decodificar(p) for _, p in crudos], [s for s, _ in crudos]
+
+    # ---- confirmación y compactación ----
+    def registrar_confirmado(self, cursor, seq):
+        """Apunta `seq` en spool_confirmado dentro de la transacción del lote."""
+        cursor.execute('''
+            INSERT INTO spool_confirmado (nombre, seq) VALUES (%s, %s)
+            ON CONFLICT (nombre) DO UPDATE SET seq = GREATEST(spool_confirmado.seq, EXCLUDED.seq)
+        ''', (self.nombre, seq))
+
+    def confirmar(self, seq):
+        """Todo hasta `seq` ya está en Postgres: se borran los segmentos que
+        quedan confirmados enteros."""
+        with self._lock:
+            if seq <= self._confirmado:
+                return
+            self.metricas["confirmados"] += seq - self._confirmado
+            self._confirmado = seq
+            self._compactar()
+
+    def _compactar(self):
+        # El segmento en que se escribe y el que se está leyendo se quedan
+        while len(self._segmentos) > 1 and self._segmentos[0] is not self._seg_lectura:
+            segmento = self._segmentos[0]
+            if segmento.ultimo_seq is not None and segmento.ultimo_seq > self._confirmado:
+                break
+            segmento.mm.close()
+            os.unlink(segmento.ruta)
+            self._segmentos.pop(0)
+            self.metricas["segmentos_borrados"] += 1
+
+    # ---- métricas y cierre ----
+    def resumen_metricas(self):
+        with self._lock:
+            datos = dict(self.metricas)
+            datos["profundidad"] = self._ultimo_seq - self._confirmado
+            datos["sin_leer"] = self._ultimo_seq - self._leido
+            datos["segmentos"] = len(self._segmentos)
+            datos["mb_en_disco"] = round(len(self._segmentos) * self.tam_segmento / 2 ** 20, 1)
+            ahora, confirmados = time.monotonic(), self.metricas["confirmados"]
+        antes, confirmados_antes = self._ultimo_resumen
+        self._ultimo_resumen = (ahora, confirmados)
+        datos["reenvio_filas_s"] = round((confirmados - confirmados_antes) / max(ahora - antes, 1e-9), 1)
+        return datos
+
+    def cerrar(self):
+        with self._lock:
+            for segmento in self._segmentos:
+                segmento.cerrar()
+            self._segmentos = []
+            self._seg_lectura = None
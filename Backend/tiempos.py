@@ -0,0 +1,449 @@
+"""Desfase del reloj y cadencia de cada dispositivo, medidos durante la ingesta.
+
+De cada fix salen dos valores:
+- desfase: recibido_en menos hora_utc (la hora GNSS que manda el
+  dispositivo), como segundos del día UTC y llevado a ±12 h. Lo normal son
+  unos segundos de módem y red; si va creciendo, el módem acumula retraso,
+  y si salta a horas o a negativo falla la hora GNSS (un dispositivo que
+  manda hora local sale en múltiplos de 3600).
+- intervalo: segundos desde el recibido_en del fix anterior del mismo
+  dispositivo.
+
+De cada uno se lleva la media y la varianza (Welford) y un t-digest para
+p50/p95, en memoria fija por dispositivo. Las dos cosas se combinan sin
+perder nada, así que la flota es un TiemposDispositivo más al que van los
+valores de todos. Cuenta lo de la última ventana: se lleva por medias
+ventanas de VENTANA_S / 2 y al empezar una se tira la más antigua, de forma
+que un dispositivo que se arregla deja de salir en pocas horas.
+
+Se guarda cada cierto tiempo (no en cada lote: el estado ocupa unos KB por
+dispositivo) en tiempos_dispositivo, con el resumen ya calculado para
+leerlo sin más, y la flota en tiempos_flota, una fila por proceso de
+ingesta que se combinan al leer. Las dos tablas las crea
+BD/migraciones/0007_tiempos.sql.
+"""
+import itertools
+import math
+import struct
+import threading
+from array import array
+from datetime import datetime, timezone
+
+import psycopg2.extras
+
+from movimiento import segundos_del_dia
+
+VENTANA_S = 24 * 3600
+COMPRESION_DISPOSITIVO = 25   # ~25 centroides por t-digest: unos KB por dispositivo
+COMPRESION_FLOTA = 200
+TROZO_TOMAR = 200
+
+# Por cada magnitud: n, media, desviación típica, p50, p95 (en segundos)
+COLUMNAS_RESUMEN = tuple(f"{c}_{magnitud}" for magnitud in ("desfase", "intervalo")
+                         for c in ("n", "media", "desviacion", "p50", "p95"))
+COLUMNAS_TIEMPOS = COLUMNAS_RESUMEN + ("ultimo_fix", "estado")
+
+_VERSION_ESTADO = 1
+_CABECERA = struct.Struct("<Bqd")       # versión, media ventana actual, último recibido_en (epoch)
+_WELFORD = struct.Struct("<qdd")        # n, media, m2
+_DIGEST = struct.Struct("<Iddd")        # centroides, peso total, mínimo, máximo
+
+_ACTUALIZAR = f"""
+        DO UPDATE SET {", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNAS_TIEMPOS)},
+            actualizado_en = NOW()"""
+
+
+class TDigest:
+    """Cuantiles aproximados en memoria acotada (t-digest con la escala k1:
+    centroides pequeños en las colas, así p95 sale más fino que p50).
+
+    Los valores esperan en un búfer y al llenarse se funden con los
+    centroides, que nunca pasan de unos `compresion`. fusionar() combina
+    dos digests como si se hubiera apuntado todo en uno.
+    """
+
+    __slots__ = ("compresion", "medias", "pesos", "total", "minimo", "maximo", "_bufer")
+
+    def __init__(self, compresion):
+        self.compresion = compresion
+        self.medias = array("d")
+        self.pesos = array("d")
+        self.total = 0.0
+        self.minimo = math.inf
+        self.maximo = -math.inf
+        self._bufer = []
+
+    def anotar(self, x):
+        self._bufer.append(x)
+        if x < self.minimo:
+            self.minimo = x
+        if x > self.maximo:
+            self.maximo = x
+        if len(self._bufer) >= self.compresion:
+            self._comprimir()
+
+    def fusionar(self, otro):
+        otro._comprimir()
+        self.minimo = min(self.minimo, otro.minimo)
+        self.maximo = max(self.maximo, otro.maximo)
+        self._comprimir(zip(otro.medias, otro.pesos))
+
+    def _limite(self, q):
+        """Hasta qué cuantil puede llegar un centroide que empieza en q (k1 + 1)."""
+        k = self.compresion / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self.compresion / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self.compresion) + 1) / 2
+
+    def _comprimir(self, extra=None):
+        """Funde el búfer (y los centroides `extra`, de fusionar()) con los centroides."""
+        if not self._bufer and extra is None:
+            return
+        puntos = sorted(itertools.chain(zip(self.medias, self.pesos), ((x, 1.0) for x in self._bufer), extra or ()))
+        self._bufer.clear()
+        if not puntos:
+            return
+        total = sum(p for _, p in puntos)
+        medias, pesos = array("d"), array("d")
+        media, peso = puntos[0]
+        acumulado = 0.0
+        limite = total * self._limite(0.0)
+        for m, p in itertools.islice(puntos, 1, None):
+            if acumulado + peso + p <= limite:
+                peso += p
+                media += (m - media) * p / peso
+            else:
+                medias.append(media)
+                pesos.append(peso)
+                acumulado += peso
+                limite = total * self._limite(acumulado / total)
+                media, peso = m, p
+        medias.append(media)
+        pesos.append(peso)
+        self.medias, self.pesos, self.total = medias, pesos, total
+
+    def cuantil(self, q):
+        return cuantiles([self], (q,))[0]
+
+    def a_bytes(self):
+        self._comprimir()
+        return (_DIGEST.pack(len(self.medias), self.total, self.minimo, self.maximo)
+                + self.medias.tobytes() + self.pesos.tobytes())
+
+    @classmethod
+    def desde_bytes(cls, compresion, datos, inicio=0):
+        """(digest, posición siguiente) leyendo lo que escribió a_bytes()."""
+        digest = cls(compresion)
+        n, digest.total, digest.minimo, digest.maximo = _DIGEST.unpack_from(datos, inicio)
+        inicio += _DIGEST.size
+        digest.medias.frombytes(datos[inicio:inicio + 8 * n])
+        digest.pesos.frombytes(datos[inicio + 8 * n:inicio + 16 * n])
+        return digest, inicio + 16 * n
+
+
+def cuantiles(digests, qs):
+    """Los cuantiles `qs` (en orden) de varios digests como si fueran uno,
+    sin fundirlos: basta con recorrer sus centroides juntos."""
+    centroides, total, minimo, maximo = [], 0.0, math.inf, -math.inf
+    for digest in digests:
+        digest._comprimir()
+        centroides.extend(zip(digest.medias, digest.pesos))
+        total += digest.total
+        minimo, maximo = min(minimo, digest.minimo), max(maximo, digest.maximo)
+    if not centroides:
+        return [None] * len(qs)
+    centroides.sort()
+    if len(centroides) == 1:
+        return [centroides[0][0]] * len(qs)
+
+    # Cada centroide está centrado en la mitad de su peso; antes del primero
+    # y después del último se interpola hacia el mínimo y el máximo
+    resultado = []
+    (m0, p0), (m_ult, p_ult) = centroides[0], centroides[-1]
+    i, acumulado = 0, p0 / 2
+    for q in qs:
+        objetivo = q * total
+        if objetivo < p0 / 2:
+            resultado.append(minimo + (m0 - minimo) * objetivo / (p0 / 2))
+            continue
+        if objetivo > total - p_ult / 2:
+            resultado.append(maximo - (maximo - m_ult) * (total - objetivo) / (p_ult / 2))
+            continue
+        while i < len(centroides) - 1:
+            (m, p), (m_sig, p_sig) = centroides[i], centroides[i + 1]
+            paso = (p + p_sig) / 2
+            if objetivo <= acumulado + paso:
+                resultado.append(m + (m_sig - m) * (objetivo - acumulado) / paso)
+                break
+            acumulado += paso
+            i += 1
+        else:
+            resultado.append(m_ult)
+    return resultado
+
+
+class Serie:
+    """Media y varianza en línea (Welford) más un TDigest de una magnitud."""
+
+    __slots__ = ("n", "media", "m2", "digest")
+
+    def __init__(self, compresion):
+        self.n = 0
+        self.media = 0.0
+        self.m2 = 0.0
+        self.digest = TDigest(compresion)
+
+    def anotar(self, x):
+        self.n += 1
+        delta = x - self.media
+        self.media += delta / self.n
+        self.m2 += delta * (x - self.media)
+        self.digest.anotar(x)
+
+    def fusionar(self, otra):
+        # Chan et al.: la combinación de dos Welford es exacta
+        if otra.n:
+            n = self.n + otra.n
+            delta = otra.media - self.media
+            self.media += delta * otra.n / n
+            self.m2 += otra.m2 + delta * delta * self.n * otra.n / n
+            self.n = n
+            self.digest.fusionar(otra.digest)
+
+    @staticmethod
+    def resumir(series):
+        """(n, media, desviación típica, p50, p95) del conjunto de `series`;
+        sin datos, n = 0 y lo demás None."""
+        n, media, m2 = 0, 0.0, 0.0
+        for serie in series:
+            # Chan et al., como fusionar()
+            if serie.n:
+                delta = serie.media - media
+                media += delta * serie.n / (n + serie.n)
+                m2 += serie.m2 + delta * delta * n * serie.n / (n + serie.n)
+                n += serie.n
+        if not n:
+            return 0, None, None, None, None
+        p50, p95 = cuantiles([s.digest for s in series if s.n], (0.5, 0.95))
+        return n, round(media, 3), round(math.sqrt(max(m2, 0.0) / n), 3), round(p50, 3), round(p95, 3)
+
+    def a_bytes(self):
+        return _WELFORD.pack(self.n, self.media, self.m2) + self.digest.a_bytes()
+
+    @classmethod
+    def desde_bytes(cls, compresion, datos, inicio=0):
+        serie = cls.__new__(cls)
+        serie.n, serie.media, serie.m2 = _WELFORD.unpack_from(datos, inicio)
+        serie.digest, inicio = TDigest.desde_bytes(compresion, datos, inicio + _WELFORD.size)
+        return serie, inicio
+
+
+class TiemposDispositivo:
+    """Desfase e intervalo de un dispositivo (o de la flota) en la ventana.
+
+    `desfase` e `intervalo` son [media ventana anterior, actual]; `periodo`
+    el número de la actual (epoch // (VENTANA_S / 2)) y `ultimo` el
+    recibido_en (epoch) más reciente, para el intervalo.
+    """
+
+    __slots__ = ("compresion", "periodo", "ultimo", "desfase", "intervalo")
+
+    def __init__(self, compresion=COMPRESION_DISPOSITIVO):
+        self.compresion = compresion
+        self.periodo = 0
+        self.ultimo = None
+        self.desfase = [Serie(compresion), Serie(compresion)]
+        self.intervalo = [Serie(compresion), Serie(compresion)]
+
+    def _avanzar(self, periodo):
+        if periodo <= self.periodo:
+            return
+        for series in (self.desfase, self.intervalo):
+            series[0] = series[1] if periodo == self.periodo + 1 else Serie(self.compresion)
+            series[1] = Serie(self.compresion)
+        self.periodo = periodo
+
+    def anotar(self, periodo, desfase, intervalo):
+        """Valores ya calculados (None si no hay); así se alimenta la flota."""
+        self._avanzar(periodo)
+        if desfase is not None:
+            self.desfase[1].anotar(desfase)
+        if intervalo is not None:
+            self.intervalo[1].anotar(intervalo)
+
+    def registrar(self, recibido_en, hora_utc):
+        """Apunta un fix; devuelve (periodo, desfase, intervalo) para anotarlos en la flota."""
+        recibido_s = recibido_en.timestamp()
+        periodo = int(recibido_s // (VENTANA_S / 2))
+        hora_s = segundos_del_dia(hora_utc)
+        desfase = None
+        if hora_s is not None:
+            desfase = (recibido_s - hora_s + 43200) % 86400 - 43200
+        intervalo = None
+        if self.ultimo is None or recibido_s > self.ultimo:
+            if self.ultimo is not None:
+                intervalo = recibido_s - self.ultimo
+            self.ultimo = recibido_s
+        self.anotar(periodo, desfase, intervalo)
+        return periodo, desfase, intervalo
+
+    def fusionar(self, otro):
+        if otro.periodo > self.periodo:
+            self._avanzar(otro.periodo)
+        for mias, suyas in ((self.desfase, otro.desfase), (self.intervalo, otro.intervalo)):
+            # Solo las medias ventanas que siguen dentro de la ventana de self
+            for i, serie in enumerate(suyas):
+                destino = i - (self.periodo - otro.periodo)
+                if destino >= 0:
+                    mias[destino].fusionar(serie)
+        if otro.ultimo is not None and (self.ultimo is None or otro.ultimo > self.ultimo):
+            self.ultimo = otro.ultimo
+
+    def resumen(self):
+        """Tupla en el orden de COLUMNAS_RESUMEN, de toda la ventana."""
+        return Serie.resumir(self.desfase) + Serie.resumir(self.intervalo)
+
+    def fila(self, clave):
+        """Tupla (clave, *COLUMNAS_TIEMPOS) para tiempos_dispositivo o tiempos_flota."""
+        ultimo = datetime.fromtimestamp(self.ultimo, timezone.utc) if self.ultimo is not None else None
+        return (clave, *self.resumen(), ultimo, self.a_bytes())
+
+    def a_bytes(self):
+        partes = [_CABECERA.pack(_VERSION_ESTADO, self.periodo, math.nan if self.ultimo is None else self.ultimo)]
+        partes.extend(s.a_bytes() for s in (*self.desfase, *self.intervalo))
+        return b"".join(partes)
+
+    @classmethod
+    def desde_bytes(cls, datos, compresion=COMPRESION_DISPOSITIVO):
+        datos = bytes(datos)
+        version, periodo, ultimo = _CABECERA.unpack_from(datos)
+        if version != _VERSION_ESTADO:
+            raise ValueError(f"versión de estado desconocida: {version}")
+        tiempos = cls.__new__(cls)
+        tiempos.compresion = compresion
+        tiempos.periodo = periodo
+        tiempos.ultimo = None if math.isnan(ultimo) else ultimo
+        series, inicio = [], _CABECERA.size
+        for _ in range(4):
+            serie, inicio = Serie.desde_bytes(compresion, datos, inicio)
+            series.append(serie)
+        tiempos.desfase, tiempos.intervalo = series[:2], series[2:]
+        return tiempos
+
+
+class RegistroTiempos:
+    """Los TiemposDispositivo de un proceso de ingesta (usuario_id -> ...) y
+    su parte de la flota.
+
+    registrar_lote() va tras el commit de cada lote y tomar() desde el hilo
+    que lo guarda, así que los dos pasan por un lock. tomar() devuelve solo
+    lo que cambió desde la vez anterior; si no se llega a guardar, se
+    devuelve con devolver() para el siguiente intento.
+    """
+
+    def __init__(self, proceso, dispositivos=None, flota=None):
+        self.proceso = proceso
+        self.dispositivos = dispositivos if dispositivos is not None else {}
+        self.flota = flota or TiemposDispositivo(COMPRESION_FLOTA)
+        self.cambiados = set()
+        self._lock = threading.Lock()
+
+    def registrar_lote(self, usuario_ids, lote):
+        with self._lock:
+            for usuario_id, fix in zip(usuario_ids, lote):
+                tiempos = self.dispositivos.get(usuario_id)
+                if tiempos is None:
+                    tiempos = self.dispositivos[usuario_id] = TiemposDispositivo()
+                self.flota.anotar(*tiempos.registrar(fix.recibido_en, fix.hora_utc))
+                if self.flota.ultimo is None or tiempos.ultimo > self.flota.ultimo:
+                    self.flota.ultimo = tiempos.ultimo
+                self.cambiados.add(usuario_id)
+
+    def tomar(self):
+        """(filas de tiempos_dispositivo, fila de tiempos_flota o None, usuario_ids)."""
+        with self._lock:
+            cambiados, self.cambiados = self.cambiados, set()
+        if not cambiados:
+            return [], None, cambiados
+        # Por trozos, soltando el lock entre uno y otro: con miles de
+        # dispositivos el escritor no espera a que se serialicen todos
+        filas, pendientes = [], list(cambiados)
+        for i in range(0, len(pendientes), TROZO_TOMAR):
+            with self._lock:
+                filas.extend(self.dispositivos[u].fila(u) for u in pendientes[i:i + TROZO_TOMAR])
+        with self._lock:
+            return filas, self.flota.fila(self.proceso), cambiados
+
+    def devolver(self, usuario_ids):
+        with self._lock:
+            self.cambiados |= usuario_ids
+
+    def resumen_metricas(self):
+        with self._lock:
+            resumen = self.flota.resumen()
+            datos = {"dispositivos": len(self.dispositivos), "pendientes": len(self.cambiados)}
+        datos.update(zip(COLUMNAS_RESUMEN, resumen))
+        return datos
+
+
+def cargar_tiempos(cursor, proceso):
+    """RegistroTiempos con lo guardado: todos los dispositivos y la flota de `proceso`."""
+    cursor.execute("SELECT usuario_id, estado FROM tiempos_dispositivo")
+    dispositivos = {u: TiemposDispositivo.desde_bytes(estado) for u, estado in cursor.fetchall()}
+    cursor.execute("SELECT estado FROM tiempos_flota WHERE proceso = %s", (proceso,))
+    fila = cursor.fetchone()
+    flota = TiemposDispositivo.desde_bytes(fila[0], COMPRESION_FLOTA) if fila else None
+    return RegistroTiempos(proceso, dispositivos, flota)
+
+
+def guardar_tiempos(cursor, filas, fila_flota):
+    if filas:
+        psycopg2.extras.execute_values(cursor, f'''
+            INSERT INTO tiempos_dispositivo (usuario_id, {", ".join(COLUMNAS_TIEMPOS)}) VALUES %s
+            ON CONFLICT (usuario_id) {_ACTUALIZAR}
+        ''', filas, page_size=1000)
+    if fila_flota:
+        cursor.execute(f'''
+            INSERT INTO tiempos_flota (proceso, {", ".join(COLUMNAS_TIEMPOS)})
+            VALUES ({", ".join(["%s"] * (len(COLUMNAS_TIEMPOS) + 1))})
+            ON CONFLICT (proceso) {_ACTUALIZAR}
+        ''', fila_flota)
+
+
+async def guardar_tiempos_asyncpg(conn, filas, fila_flota):
+    """guardar_tiempos() para una conexión de asyncpg (ingesta_async.py)."""
+    tipos = ["bigint", *("bigint" if c.startswith("n_") else "float8" for c in COLUMNAS_RESUMEN),
+             "timestamptz", "bytea"]
+    if filas:
+        await conn.execute(f'''
+            INSERT INTO tiempos_dispositivo (usuario_id, {", ".join(COLUMNAS_TIEMPOS)})
+            SELECT * FROM unnest({", ".join(f"${i}::{t}[]" for i, t in enumerate(tipos, 1))})
+            ON CONFLICT (usuario_id) {_ACTUALIZAR}
+        ''', *(list(columna) for columna in zip(*filas)))
+    if fila_flota:
+        await conn.execute(f'''
+            INSERT INTO tiempos_flota (proceso, {", ".join(COLUMNAS_TIEMPOS)})
+            VALUES ({", ".join(f"${i}" for i in range(1, len(tipos) + 1))})
+            ON CONFLICT (proceso) {_ACTUALIZAR}
+        ''', *fila_flota)
+
+
+def leer_flota(cursor):
+    """Resumen de la flota (en el orden de COLUMNAS_RESUMEN) y su último fix,
+    combinando la fila de cada proceso de ingesta; None si no hay ninguna.
+
+    Las de procesos que ya no escriben (menos --workers que antes) se
+    ignoran pasada la ventana.
+    """
+    cursor.execute("""
+        SELECT estado FROM tiempos_flota
+        WHERE actualizado_en > NOW() - %s * INTERVAL '1 second'
+    """, (VENTANA_S,))
+    filas = cursor.fetchall()
+    if not filas:
+        return None
+    flota = TiemposDispositivo(COMPRESION_FLOTA)
+    for (estado,) in filas:
+        flota.fusionar(TiemposDispositivo.desde_bytes(estado, COMPRESION_FLOTA))
+    ultimo = datetime.fromtimestamp(flota.ultimo, timezone.utc) if flota.ultimo is not None else None
+    return flota.resumen(), ultimo
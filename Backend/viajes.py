@@ -0,0 +1,229 @@
+"""Viajes y paradas de cada dispositivo, segmentados durante la ingesta.
+
+Hay movimiento cuando el vehículo se desplaza de verdad desde el último
+punto aceptado (más de UMBRAL_JITTER_M y con hdop bueno) y además el sensor
+lo marca o la velocidad pasa de VELOCIDAD_MIN_KMH: el sensor solo no basta,
+aparcado da falsos positivos. Un viaje empieza con el primer movimiento y
+acaba cuando pasan PARADA_MIN_S sin ninguno; su final es el último fix en
+movimiento. Lo que queda entre dos viajes es una parada, en el punto donde
+acabó el primero. Los de menos de VIAJE_MIN_KM (maniobras, saltos del GPS)
+no se guardan.
+
+Los km salen con la misma regla de jitter que distancias.py: lo que suman
+los viajes de un día es lo de su cubo de distancia_diaria menos los
+desplazamientos sueltos que no llegan a viaje.
+
+`viajes` tiene una fila por viaje con su resumen; la del viaje en curso se
+reescribe en cada lote (en_curso). El resto del estado de cada dispositivo
+(ancla y último fix visto) va en viajes_estado, para retomarlo tal cual
+tras un reinicio. Un viaje que aún no llega a VIAJE_MIN_KM solo está en
+memoria: si se reinicia entonces, empieza de nuevo con el siguiente fix.
+
+Las dos tablas las crea BD/migraciones/0006_viajes.sql.
+"""
+import psycopg2.extras
+
+from geo import HDOP_MAX, UMBRAL_JITTER_M, haversine
+
+PARADA_MIN_S = 600
+VELOCIDAD_MIN_KMH = 5.0
+VIAJE_MIN_KM = 0.3
+
+COLUMNAS_VIAJES = ("usuario_id", "inicio", "fin", "km", "puntos", "latitud_inicio", "longitud_inicio",
+                   "latitud_fin", "longitud_fin", "latitud_min", "longitud_min", "latitud_max", "longitud_max",
+                   "en_curso")
+
+_ACTUALIZAR_VIAJE = f"""
+        ON CONFLICT (usuario_id, inicio) DO UPDATE SET
+            {", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNAS_VIAJES[2:])}"""
+_ACTUALIZAR_ESTADO = """
+        ON CONFLICT (usuario_id) DO UPDATE SET
+            latitud = EXCLUDED.latitud, longitud = EXCLUDED.longitud,
+            ancla_en = EXCLUDED.ancla_en, visto_en = EXCLUDED.visto_en"""
+
+
+class Viaje:
+    """Resumen de un viaje mientras se va construyendo."""
+
+    __slots__ = ("inicio", "fin", "km", "puntos", "latitud_inicio", "longitud_inicio", "latitud_fin",
+                 "longitud_fin", "latitud_min", "longitud_min", "latitud_max", "longitud_max")
+
+    def __init__(self, inicio, lat, lon):
+        self.inicio = self.fin = inicio
+        self.km = 0.0
+        self.puntos = 1
+        self.latitud_inicio = self.latitud_fin = self.latitud_min = self.latitud_max = lat
+        self.longitud_inicio = self.longitud_fin = self.longitud_min = self.longitud_max = lon
+
+    def copia(self):
+        viaje = Viaje.__new__(Viaje)
+        for campo in Viaje.__slots__:
+            setattr(viaje, campo, getattr(self, campo))
+        return viaje
+
+    def sumar(self, km, lat, lon):
+        self.km += km
+        self.puntos += 1
+        self.latitud_fin, self.longitud_fin = lat, lon
+        self.latitud_min, self.latitud_max = min(self.latitud_min, lat), max(self.latitud_max, lat)
+        self.longitud_min, self.longitud_max = min(self.longitud_min, lon), max(self.longitud_max, lon)
+
+    def fila(self, usuario_id, en_curso):
+        """Tupla en el orden de COLUMNAS_VIAJES."""
+        return (usuario_id, self.inicio, self.fin, self.km, self.puntos, self.latitud_inicio,
+                self.longitud_inicio, self.latitud_fin, self.longitud_fin, self.latitud_min,
+                self.longitud_min, self.latitud_max, self.longitud_max, en_curso)
+
+    @classmethod
+    def desde_fila(cls, fila):
+        """Al revés que fila(), sin usuario_id ni en_curso."""
+        viaje = cls.__new__(cls)
+        for campo, valor in zip(COLUMNAS_VIAJES[1:-1], fila):
+            setattr(viaje, campo, valor)
+        return viaje
+
+
+class SegmentadorViajes:
+    """Estado de la segmentación de un dispositivo.
+
+    `ancla` es (lat, lon, recibido_en) del último punto aceptado, como en
+    distancias.py; `visto` el recibido_en del último fix, aceptado o no; y
+    `viaje` el viaje abierto, si hay uno.
+    """
+
+    __slots__ = ("ancla", "visto", "viaje")
+
+    def __init__(self, ancla=None, visto=None, viaje=None):
+        self.ancla = ancla
+        self.visto = visto
+        self.viaje = viaje
+
+    def copia(self):
+        return SegmentadorViajes(self.ancla, self.visto, self.viaje and self.viaje.copia())
+
+    def registrar(self, recibido_en, lat, lon, hdop, en_mov):
+        """Procesa un fix; devuelve el viaje que se cierra con él, o None."""
+        if self.visto is not None and recibido_en <= self.visto:
+            # Repetido o fuera de orden: la segmentación solo avanza
+            return None
+        cerrado = None
+        if self.viaje is not None and (recibido_en - self.viaje.fin).total_seconds() >= PARADA_MIN_S:
+            cerrado, self.viaje = self.viaje, None
+        previo, self.visto = self.visto, recibido_en
+
+        if hdop is not None and hdop >= HDOP_MAX:
+            return cerrado
+        if self.ancla is None:
+            self.ancla = (lat, lon, recibido_en)
+            return cerrado
+
+        lat_ancla, lon_ancla, t_ancla = self.ancla
+        km = haversine(lat_ancla, lon_ancla, lat, lon)
+        desplazado = km >= UMBRAL_JITTER_M / 1000.0
+        if desplazado:
+            self.ancla = (lat, lon, recibido_en)
+        horas = (recibido_en - t_ancla).total_seconds() / 3600
+        moviendose = desplazado and (en_mov == 1 or km / horas >= VELOCIDAD_MIN_KMH)
+
+        if self.viaje is None:
+            if not moviendose:
+                return cerrado
+            # Empieza donde estaba aparcado, en el fix anterior si es reciente
+            # (si el dispositivo estuvo apagado, en este)
+            reciente = previo is not None and (recibido_en - previo).total_seconds() < PARADA_MIN_S
+            self.viaje = Viaje(previo if reciente else recibido_en, lat_ancla, lon_ancla)
+
+        if desplazado:
+            self.viaje.sumar(km, lat, lon)
+        if moviendose:
+            self.viaje.fin = recibido_en
+        return cerrado
+
+    def fila_estado(self, usuario_id):
+        lat, lon, ancla_en = self.ancla or (None, None, None)
+        return (usuario_id, lat, lon, ancla_en, self.visto)
+
+
+def cargar_segmentadores(cursor):
+    """nombre de dispositivo -> SegmentadorViajes, desde viajes_estado y el viaje en curso."""
+    cursor.execute(f"""
+        SELECT u.nombre, e.latitud, e.longitud, e.ancla_en, e.visto_en,
+               {", ".join(f"v.{c}" for c in COLUMNAS_VIAJES[1:-1])}
+        FROM viajes_estado e
+        JOIN usuarios u ON u.id = e.usuario_id
+        LEFT JOIN viajes v ON v.usuario_id = e.usuario_id AND v.en_curso
+    """)
+    segmentadores = {}
+    for nombre, lat, lon, ancla_en, visto_en, *viaje in cursor.fetchall():
+        segmentadores[nombre] = SegmentadorViajes(
+            (lat, lon, ancla_en) if ancla_en is not None else None, visto_en,
+            Viaje.desde_fila(viaje) if viaje[0] is not None else None)
+    return segmentadores
+
+
+class AcumuladorViajes:
+    """Segmentación de los fixes de un lote.
+
+    Trabaja sobre copias de `segmentadores` (nombre -> SegmentadorViajes)
+    sin modificarlo; las copias quedan en `self.segmentadores` para
+    aplicarlas tras el commit, como las anclas de AcumuladorDistancias.
+    """
+
+    def __init__(self, segmentadores):
+        self.base = segmentadores
+        self.segmentadores = {}
+        self.usuario_ids = {}
+        self.cerrados = []
+
+    def registrar(self, nombre, usuario_id, recibido_en, lat, lon, hdop, en_mov):
+        segmentador = self.segmentadores.get(nombre)
+        if segmentador is None:
+            actual = self.base.get(nombre)
+            segmentador = self.segmentadores[nombre] = actual.copia() if actual else SegmentadorViajes()
+            self.usuario_ids[nombre] = usuario_id
+        cerrado = segmentador.registrar(recibido_en, lat, lon, hdop, en_mov)
+        if cerrado is not None and cerrado.km >= VIAJE_MIN_KM:
+            self.cerrados.append(cerrado.fila(usuario_id, False))
+
+    def filas_viajes(self):
+        filas = list(self.cerrados)
+        for nombre, segmentador in self.segmentadores.items():
+            if segmentador.viaje is not None and segmentador.viaje.km >= VIAJE_MIN_KM:
+                filas.append(segmentador.viaje.fila(self.usuario_ids[nombre], True))
+        return filas
+
+    def filas_estado(self):
+        return [s.fila_estado(self.usuario_ids[n]) for n, s in self.segmentadores.items() if s.visto is not None]
+
+    def guardar(self, cursor):
+        filas = self.filas_viajes()
+        if filas:
+            psycopg2.extras.execute_values(cursor, f'''
+                INSERT INTO viajes ({", ".join(COLUMNAS_VIAJES)}) VALUES %s
+                {_ACTUALIZAR_VIAJE}
+            ''', filas, page_size=len(filas))
+        estado = self.filas_estado()
+        if estado:
+            psycopg2.extras.execute_values(cursor, f'''
+                INSERT INTO viajes_estado (usuario_id, latitud, longitud, ancla_en, visto_en) VALUES %s
+                {_ACTUALIZAR_ESTADO}
+            ''', estado, page_size=len(estado))
+
+    async def guardar_asyncpg(self, conn):
+        """guardar() para una conexión de asyncpg (ingesta_async.py)."""
+        filas = self.filas_viajes()
+        if filas:
+            await conn.execute(f'''
+                INSERT INTO viajes ({", ".join(COLUMNAS_VIAJES)})
+                SELECT * FROM unnest($1::bigint[], $2::timestamptz[], $3::timestamptz[], $4::float8[],
+                                     $5::integer[], $6::float8[], $7::float8[], $8::float8[], $9::float8[],
+                                     $10::float8[], $11::float8[], $12::float8[], $13::float8[], $14::boolean[])
+                {_ACTUALIZAR_VIAJE}
+            ''', *(list(columna) for columna in zip(*filas)))
+        estado = self.filas_estado()
+        if estado:
+            await conn.execute(f'''
+                INSERT INTO viajes_estado (usuario_id, latitud, longitud, ancla_en, visto_en)
+                SELECT * FROM unnest($1::bigint[], $2::float8[], $3::float8[], $4::timestamptz[], $5::timestamptz[])
+                {_ACTUALIZAR_ESTADO}
+            ''', *(list(columna) for columna in zip(*estado)))